@@ -0,0 +1,38 @@
+"""Benchmark for GET /v1/datasets in its three modes.
+
+Times dataset_service.get_datasets with the full metadata-extended list, a ?fields= projection and simple=true. The
+metadata cache is cleared before every call so each one pays for its S3 reads, unless --warm is given. A database
+with the dataset rows and access to the S3 buckets are needed, along with the app's environment variables:
+
+    python3 -m benchmarks.dataset_list
+    python3 -m benchmarks.dataset_list --warm
+"""
+import sys
+import timeit
+from ulapd_api.main import app
+from ulapd_api.services import dataset_service
+
+ITERATIONS = 20
+
+MODES = [
+    ('full', {}),
+    ('fields=name,title', {'fields': ['name', 'title']}),
+    ('fields=name,last_updated', {'fields': ['name', 'last_updated']}),
+    ('simple=true', {'simple': True})
+]
+
+
+def main(warm=False):
+    with app.app_context():
+        for name, kwargs in MODES:
+            def call():
+                if not warm:
+                    dataset_service.metadata_cache.invalidate()
+                dataset_service.get_datasets(**kwargs)
+
+            seconds = timeit.timeit(call, number=ITERATIONS)
+            print('{:<26} {:8.1f} ms per call'.format(name, seconds / ITERATIONS * 1000))
+
+
+if __name__ == '__main__':
+    main(warm='--warm' in sys.argv[1:])
@@ -0,0 +1,62 @@
+"""Benchmark for GET /v1/users with a large user base.
+
+Compares the previous way of listing users, one user_type query per user, with user_service.get_all_users, which
+joins the user types in and streams the rows from a server-side cursor. The users are inserted before timing starts
+and deleted again afterwards, so a database the app can write to is needed, along with the app's environment
+variables:
+
+    python3 -m benchmarks.get_all_users
+    python3 -m benchmarks.get_all_users --users 10000
+"""
+import argparse
+import time
+from ulapd_api.main import app
+from ulapd_api.extensions import db
+from ulapd_api.models.user_details import UserDetails
+from ulapd_api.models.user_type import UserType
+from ulapd_api.services import user_service
+
+LDAP_PREFIX = 'benchmark-user-'
+
+
+def list_users_per_row_type():
+    users = []
+    for user in UserDetails.get_user_details_all():
+        users.append({'user_details': user.as_dict(),
+                      'user_type': UserType.get_user_type_by_id(user.user_type_id).as_dict()})
+    db.session.close()
+    return users
+
+
+def seed(count):
+    user_type_id = UserType.get_all_user_types()[0].user_type_id
+    db.session.bulk_insert_mappings(UserDetails, [{
+        'user_type_id': user_type_id, 'ldap_id': '{}{}'.format(LDAP_PREFIX, i), 'api_key': 'benchmark-{}'.format(i),
+        'email': 'benchmark-{}@example.com'.format(i), 'title': 'Mx', 'first_name': 'Bench', 'last_name': 'Mark',
+        'contactable': False, 'telephone_number': '0', 'address_line_1': '1', 'city': 'Town', 'postcode': 'AA1 1AA'
+    } for i in range(count)])
+    db.session.commit()
+
+
+def remove():
+    UserDetails.query.filter(UserDetails.ldap_id.like(LDAP_PREFIX + '%')).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def main(count):
+    with app.app_context():
+        seed(count)
+        try:
+            for name, func in [('query per user type', list_users_per_row_type),
+                               ('joined and streamed', user_service.get_all_users)]:
+                started = time.monotonic()
+                users = func()
+                print('{:<20} {:8.2f} s for {} users'.format(name, time.monotonic() - started, len(users)))
+        finally:
+            remove()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    main(parser.parse_args().users)
@@ -0,0 +1,40 @@
+"""Micro-benchmark for the download-link signing path.
+
+Compares building a new boto3 client for every presigned URL (the previous behaviour of S3.get_s3_session) with the
+per-process client now returned by S3.get_s3_session. Signing happens locally, so no network access is needed, but
+credentials must be resolvable and the app's environment variables must be set:
+
+    AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x python3 -m benchmarks.s3_client
+"""
+import boto3
+import timeit
+from ulapd_api.app import app
+from ulapd_api.dependencies.s3 import S3, _create_client
+
+ITERATIONS = 200
+
+
+def sign_with_new_client():
+    s3 = S3()
+    client = _create_client(s3.S3_REGION, boto3.session.Session())
+    return client.generate_presigned_url(ClientMethod='get_object',
+                                         Params={'Bucket': s3.BUCKET_NAME, 'Key': 'ccod/a.zip'},
+                                         ExpiresIn=s3.S3_URL_EXPIRATION)
+
+
+def sign_with_shared_client():
+    return S3().build_presigned_url('ccod/a.zip')
+
+
+def main():
+    with app.app_context():
+        # Build the shared client up front so its creation is not counted
+        S3().get_s3_session()
+        for name, func in [('new client per call', sign_with_new_client),
+                           ('shared client', sign_with_shared_client)]:
+            seconds = timeit.timeit(func, number=ITERATIONS)
+            print('{:<22} {:8.3f} ms per presigned URL'.format(name, seconds / ITERATIONS * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import unittest
+from sqlalchemy import event
+from sqlalchemy.orm import Query
+from ulapd_api.main import app
+from ulapd_api.extensions import db
+from ulapd_api.models.activity import Activity
+from ulapd_api.models.contact import Contact
+from ulapd_api.models.dataset import Dataset
+from ulapd_api.models.dataset_metadata import DatasetMetadata
+from ulapd_api.models.licence import Licence
+from ulapd_api.models.user_details import UserDetails
+from ulapd_api.models.user_terms_link import UserTermsLink
+from ulapd_api.models.user_type import UserType
+
+MODELS = [Activity, Contact, Dataset, DatasetMetadata, Licence, UserDetails, UserTermsLink, UserType]
+
+# Arguments for each getter that looks rows up by a column, all of which must be able to use an index
+INDEXED_GETTERS = {
+    'Activity.get_activity_by_id': (1,),
+    'Activity.get_activity_by_user_id': (1,),
+    'Activity.get_user_activity_by_dataset': (1, 'ccod'),
+    'Activity.get_user_downloads': (1,),
+    'Contact.get_contact_preference_by_id': (1,),
+    'Contact.get_contact_preferences_for_user': (1,),
+    'Dataset.get_dataset_by_id': (1,),
+    'Dataset.get_dataset_by_name': ('ccod',),
+    'Dataset.get_datasets_by_names': (['ccod', 'ocod'],),
+    'Dataset.get_dataset_with_metadata': ('ccod',),
+    'Licence.get_licence_by_licence_name': ('ccod',),
+    'UserDetails.get_all_with_user_type': (100, 1, 10),
+    'UserDetails.get_missing_user_type_id': (1, 10),
+    'UserDetails.get_user_with_contacts': ('api_key', 'query-plan-api-key'),
+    'UserDetails.get_user_details_by_id': (1,),
+    'UserDetails.get_user_details_by_ldap_id': ('query-plan-ldap-id',),
+    'UserDetails.get_user_details_by_api_key': ('query-plan-api-key',),
+    'UserDetails.get_user_details_by_email': ('query-plan@example.com',),
+    'UserTermsLink.get_user_terms_by_user_id': (1,),
+    'UserTermsLink.get_user_terms_by_licence_name': (1, 'ccod'),
+    'UserTermsLink.get_latest_user_terms_by_user_id': (1,),
+    'UserType.get_user_type_by_id': (1,)
+}
+
+# Getters that read a whole table on purpose. The reference tables hold a few dozen rows and are served from the
+# in-memory snapshot
+FULL_SCANS = {
+    'Activity.get_all_activity',
+    'Dataset.get_all',
+    'Dataset.get_all_datasets',
+    'Dataset.get_all_with_metadata',
+    'DatasetMetadata.get_all',
+    'Licence.get_all_licences',
+    'UserDetails.get_user_details_all',
+    'UserType.get_all_user_types'
+}
+
+# Getters that filter on a column with no index. Nothing in the app calls them, so they are left unindexed rather
+# than adding indexes that every write would have to maintain. Move one to INDEXED_GETTERS, with an index, if it
+# comes into use
+UNINDEXED_LOOKUPS = {
+    'Activity.get_activity_by_type',
+    'Dataset.get_dataset_by_licence_name',
+    'Licence.get_licences_by_dataset_name',
+    'UserType.get_user_id_by_type'
+}
+
+
+def _getters():
+    for model in MODELS:
+        for name in vars(model):
+            if name.startswith('get_'):
+                yield '{}.{}'.format(model.__name__, name), getattr(model, name)
+
+
+class TestQueryPlans(unittest.TestCase):
+    """Fails when a model getter's query can only be answered with a sequential scan.
+
+    Sequential scans are turned off for the transaction, so the planner only picks one when no index fits the
+    query. That makes the plans independent of how many rows the tables of the database under test hold.
+    """
+
+    def test_every_getter_is_covered(self):
+        for name, _ in _getters():
+            with self.subTest(getter=name):
+                self.assertIn(name, set(INDEXED_GETTERS) | FULL_SCANS | UNINDEXED_LOOKUPS,
+                              'Add {} to INDEXED_GETTERS, or FULL_SCANS if it reads the whole table'.format(name))
+
+    def test_getters_are_listed_once(self):
+        listed = [set(INDEXED_GETTERS), FULL_SCANS, UNINDEXED_LOOKUPS]
+        for index, getters in enumerate(listed):
+            for others in listed[index + 1:]:
+                self.assertFalse(getters & others)
+
+    def test_indexed_getters_do_not_scan_tables(self):
+        getters = dict(_getters())
+        with app.app_context():
+            for name, args in INDEXED_GETTERS.items():
+                with self.subTest(getter=name):
+                    for statement, plan in self._explain(getters[name], args):
+                        self.assertNotIn('Seq Scan', plan, '{} ran a sequential scan for:\n{}\n\n{}'.format(
+                            name, statement, plan))
+            db.session.remove()
+
+    def _explain(self, getter, args):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *_):
+            statements.append((statement, parameters))
+
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            result = getter(*args)
+            if isinstance(result, Query):
+                list(result)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        connection = db.session.connection()
+        plans = [(statement, '\n'.join(row[0] for row in connection.execute('EXPLAIN ' + statement, parameters)))
+                 for statement, parameters in statements]
+        db.session.rollback()
+        return plans
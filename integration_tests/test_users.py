@@ -6,6 +6,7 @@ from os import path
 from flask import current_app, g
 from ulapd_api.main import app
 from ulapd_api.services import user_service as service
+from ulapd_api.utilities.reference_data import reload_reference_data
 from integration_tests.utilities import helpers
 
 
@@ -72,6 +73,37 @@ class TestUsers(unittest.TestCase):
         self.assertIn('user_details', response_body)
         self.assertIn('datasets', response_body)
 
+    def test_get_user_query_count(self):
+        user_key = {'key': 'user_details_id', 'value': self.user_details_id}
+        with app.app_context():
+            reload_reference_data()
+            with helpers.count_queries() as one_licence:
+                service.get_user_by_key(user_key)
+
+            helpers.insert_licence_agreement(self.user_details_id, 'ocod')
+            helpers.insert_licence_agreement(self.user_details_id, 'ccod')
+            with helpers.count_queries() as three_licences:
+                profile = service.get_user_by_key(user_key)
+
+        self.assertEqual(len(one_licence), 2)
+        self.assertEqual(len(three_licences), 2)
+        self.assertIn('ocod', profile['datasets'])
+
+    def test_get_users_dataset_access_query_count(self):
+        with app.app_context():
+            reload_reference_data()
+            with helpers.count_queries() as one_licence:
+                expected = service.get_users_dataset_access(self.user_details_id)
+
+            helpers.insert_licence_agreement(self.user_details_id, 'ocod')
+            helpers.insert_licence_agreement(self.user_details_id, 'ccod')
+            with helpers.count_queries() as three_licences:
+                service.get_users_dataset_access(self.user_details_id)
+
+        self.assertEqual(len(one_licence), 2)
+        self.assertEqual(len(three_licences), 2)
+        self.assertEqual(expected[-1]['name'], 'licenced')
+
     def test_get_user_licences(self):
         url = '{}/users/licence/{}'.format(self.URL_ULAPD_PREFIX, self.user_details_id)
         response = self.client.get(url, headers=self.headers)
@@ -118,6 +150,22 @@ class TestUsers(unittest.TestCase):
         self.assertEqual(result[0]['download_history'][1]['file'], 'CCOD_COU_2019_09.zip')
         self.assertEqual(result[0]['licence_agreed'], True)
 
+    def test_get_user_dataset_activity_query_count(self):
+        with app.app_context():
+            reload_reference_data()
+            with helpers.count_queries() as no_downloads:
+                service.get_dataset_activity(self.user_details_id)
+
+            helpers.insert_user_activity(self.user_details_id, 'CCOD_COU_2019_09.zip', 'ccod')
+            helpers.insert_user_activity(self.user_details_id, 'OCOD_COU_2019_09.zip', 'ocod')
+            with helpers.count_queries() as two_datasets:
+                activity = service.get_dataset_activity(self.user_details_id)
+
+        self.assertEqual(len(no_downloads), 3)
+        self.assertEqual(len(two_datasets), 3)
+        ocod = next(dataset for dataset in activity if dataset['name'] == 'ocod')
+        self.assertEqual(ocod['download_history'][0]['file'], 'OCOD_COU_2019_09.zip')
+
     def test_create_user(self):
         self.tearDown()
         url = '{}/users'.format(self.URL_ULAPD_PREFIX)
@@ -1,6 +1,8 @@
 import json
 import os
 import uuid
+from contextlib import contextmanager
+from sqlalchemy import event
 
 from ulapd_api.main import app
 from ulapd_api.models.user_details import UserDetails
@@ -21,11 +23,11 @@ def insert_user_row(user_data):
     return user_details_id
 
 
-def insert_licence_agreement(user_details_id):
+def insert_licence_agreement(user_details_id, licence_id='ccod'):
     with app.app_context():
         terms_data = {
             'user_details_id': user_details_id,
-            'licence_id': 'ccod'
+            'licence_id': licence_id
         }
         user_terms = UserTermsLink(terms_data)
         db.session.add(user_terms)
@@ -96,3 +98,18 @@ def get_json_from_file(directory, file_path):
 
 def make_uuid():
     return uuid.uuid4()
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run inside the block into the list it yields. Needs an app context."""
+    statements = []
+
+    def record(conn, cursor, statement, *_):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
@@ -2,9 +2,11 @@ import os
 from flask_script import Manager
 from ulapd_api.main import app
 from flask_migrate import Migrate, MigrateCommand
-from ulapd_api.models import (user_details, user_type, user_terms_link, dataset, activity, licence)  # noqa
+from ulapd_api.models import (user_details, user_type, user_terms_link, dataset, activity, licence,  # noqa
+                              dataset_metadata)
 
 from ulapd_api.extensions import db
+from ulapd_api.services import dataset_service
 
 migrate = Migrate(app, db)
 
@@ -24,5 +26,11 @@ def runserver(port=9998):
     app.run(debug=True, port=int(port))
 
 
+@manager.command
+def sync_metadata():
+    """Copy each dataset's metadata.json from S3 into the dataset_metadata table"""
+    print(dataset_service.sync_metadata())
+
+
 if __name__ == "__main__":
     manager.run()
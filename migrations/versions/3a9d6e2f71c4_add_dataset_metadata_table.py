@@ -0,0 +1,34 @@
+"""add dataset metadata table
+
+Revision ID: 3a9d6e2f71c4
+Revises: c0ed71b44ab2
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9d6e2f71c4'
+down_revision = 'c0ed71b44ab2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('dataset_metadata',
+                    sa.Column('dataset_name', sa.String(), nullable=False),
+                    sa.Column('bucket', sa.String(), nullable=False),
+                    sa.Column('etag', sa.String(), nullable=False),
+                    sa.Column('content', sa.JSON(), nullable=False),
+                    sa.Column('synced', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('dataset_name')
+                    )
+    op.execute("GRANT SELECT, UPDATE, INSERT, DELETE ON TABLE dataset_metadata TO " +
+               current_app.config.get('APP_SQL_USERNAME'))
+
+
+def downgrade():
+    op.drop_table('dataset_metadata')
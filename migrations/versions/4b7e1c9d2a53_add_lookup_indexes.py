@@ -0,0 +1,37 @@
+"""add indexes for user, licence agreement and activity lookups
+
+Revision ID: 4b7e1c9d2a53
+Revises: 3a9d6e2f71c4
+Create Date: 2026-10-18 15:42:09.381027
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e1c9d2a53'
+down_revision = '3a9d6e2f71c4'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_user_details_api_key', 'user_details', ['api_key']),
+    ('ix_user_details_ldap_id', 'user_details', ['ldap_id']),
+    ('ix_user_details_email', 'user_details', ['email']),
+    ('ix_contact_user_details_id', 'contact', ['user_details_id']),
+    ('ix_user_terms_link_user_licence_date', 'user_terms_link', ['user_details_id', 'licence_name', 'date_agreed']),
+    ('ix_activity_user_dataset_timestamp', 'activity', ['user_details_id', 'dataset_name', 'timestamp'])
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY does not block writes but cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
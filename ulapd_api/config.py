@@ -38,6 +38,36 @@ S3_BUCKET = os.environ['S3_BUCKET']
 S3_BUCKET_RESTRICTED = os.environ['S3_BUCKET_RESTRICTED']
 S3_BUCKET_REGION = os.environ['S3_BUCKET_REGION']
 S3_URL_EXPIRATION = int(os.environ['S3_URL_EXPIRATION'])
+# A signed download URL is handed out again while more than this fraction of S3_URL_EXPIRATION is left on it
+S3_URL_REUSE_FRACTION = float(os.environ['S3_URL_REUSE_FRACTION'])
+# Size of the connection pool held by each process's shared S3 client
+S3_MAX_POOL_CONNECTIONS = int(os.environ['S3_MAX_POOL_CONNECTIONS'])
+# Most files a single POST /v1/datasets/download/batch may ask for links to
+DOWNLOAD_BATCH_LIMIT = int(os.environ['DOWNLOAD_BATCH_LIMIT'])
+
+# Seconds a dataset's metadata.json is served from memory before being revalidated against S3
+METADATA_CACHE_TTL = int(os.environ['METADATA_CACHE_TTL'])
+# Seconds past its TTL that metadata keeps being served while S3 cannot be reached
+METADATA_CACHE_MAX_STALENESS = int(os.environ['METADATA_CACHE_MAX_STALENESS'])
+# Seconds between sweeps of the background thread that renews metadata before it expires, or 0 to disable it
+METADATA_CACHE_REFRESH_INTERVAL = int(os.environ['METADATA_CACHE_REFRESH_INTERVAL'])
+# Number of metadata.json files fetched in parallel for a dataset list, and the seconds allowed for all of them
+METADATA_FETCH_CONCURRENCY = int(os.environ['METADATA_FETCH_CONCURRENCY'])
+METADATA_FETCH_DEADLINE = int(os.environ['METADATA_FETCH_DEADLINE'])
+# Number of parallel S3 calls made while rebuilding the history caches, and attempts made for each one
+HISTORY_CACHE_CONCURRENCY = int(os.environ['HISTORY_CACHE_CONCURRENCY'])
+HISTORY_CACHE_RETRIES = int(os.environ['HISTORY_CACHE_RETRIES'])
+# Seconds a dataset_metadata copy is used after it was last synced, after which reads go back to S3 until the next sync
+METADATA_SYNC_MAX_AGE = int(os.environ['METADATA_SYNC_MAX_AGE'])
+# Attempts made to fetch each dataset's metadata.json while syncing
+METADATA_SYNC_RETRIES = int(os.environ['METADATA_SYNC_RETRIES'])
+# Seconds the in-memory licence, dataset and user type snapshot is used before being reloaded from the database
+REFERENCE_DATA_TTL = int(os.environ['REFERENCE_DATA_TTL'])
+# Number of users read from the database cursor at a time, and the largest page of users that can be asked for
+USER_BATCH_SIZE = int(os.environ['USER_BATCH_SIZE'])
+USER_PAGE_LIMIT = int(os.environ['USER_PAGE_LIMIT'])
+# Set to yes to have each worker listen for writes made by other workers and drop what they make out of date
+CACHE_INVALIDATION_LISTEN = os.environ['CACHE_INVALIDATION_LISTEN'] == 'yes'
 
 # Account-api
 ACCOUNT_API_URL = os.environ['ACCOUNT_API_URL']
@@ -56,6 +86,8 @@ COMMIT = os.environ['COMMIT']
 APP_NAME = os.environ['APP_NAME']
 MAX_HEALTH_CASCADE = int(os.environ['MAX_HEALTH_CASCADE'])
 DEFAULT_TIMEOUT = int(os.environ['DEFAULT_TIMEOUT'])
+# Set to yes to open database connections, build the S3 client and load reference data and dataset metadata at startup
+WARM_UP_ON_START = os.environ['WARM_UP_ON_START'] == 'yes'
 
 # Following is an example of building the dependency structure used by the cascade route
 # SELF can be used to demonstrate how it works (i.e. it will call it's own casecade
@@ -7,10 +7,10 @@ class ContextualFilter(logging.Filter):
     def filter(self, log_record):
         """Provide some extra variables to be placed into the log message """
 
-        # If we have an app context (because we're servicing an http request) then get the trace id we have
-        # set in g (see app.py)
+        # If we have an app context then get the trace id we have set in g (see main.py). Only requests set one, so
+        # an app context pushed by a command or background thread logs without it
         if ctx.has_app_context():
-            log_record.trace_id = g.trace_id
+            log_record.trace_id = g.get('trace_id', 'N/A')
         else:
             log_record.trace_id = 'N/A'
         return True
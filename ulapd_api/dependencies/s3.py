@@ -1,10 +1,22 @@
 import boto3
 from botocore.client import Config
+from botocore.credentials import RefreshableCredentials
 from botocore.errorfactory import ClientError
-import requests
 from ulapd_api.app import app
 from flask import current_app
+import datetime
 import json
+import os
+import threading
+import time
+
+# Clients are shared by every request in a process, along with the session each was created from. They are keyed by
+# process id as well as region because boto3 clients are thread safe but must not be carried across a gunicorn fork.
+_clients = {}
+_clients_lock = threading.Lock()
+
+_fetch_stats = {'requests': 0, 'not_modified': 0, 'bytes': 0, 'seconds': 0.0}
+_fetch_stats_lock = threading.Lock()
 
 
 class S3(object):
@@ -16,32 +28,70 @@ class S3(object):
         self.S3_URL_EXPIRATION = app.config.get('S3_URL_EXPIRATION')
 
     def get_s3_session(self):
-        return boto3.client('s3', config=Config(signature_version='s3v4',
-                                                region_name=self.S3_REGION))
+        client, _ = self._get_client()
+        return client
+
+    def _get_client(self):
+        client_key = (os.getpid(), self.S3_REGION)
+        entry = _clients.get(client_key)
+        if entry is None:
+            with _clients_lock:
+                entry = _clients.get(client_key)
+                if entry is None:
+                    # The default boto3 session is not thread safe, so each client gets a session of its own
+                    session = boto3.session.Session()
+                    entry = (_create_client(self.S3_REGION, session), session)
+                    _clients[client_key] = entry
+        return entry
 
     def get_s3_resource(self, dataset_id, resource, restricted_bucket=False):
-        key = dataset_id + resource
-        try:
-            s3 = self.get_s3_session()
+        content, _ = self.get_s3_resource_if_modified(dataset_id, resource, restricted_bucket=restricted_bucket)
+        return content
 
-            bucket = self.S3_BUCKET_RESTRICTED if restricted_bucket else self.BUCKET_NAME
+    def get_s3_resource_if_modified(self, dataset_id, resource, etag=None, restricted_bucket=False):
+        """Fetch and parse a JSON resource unless it still matches etag.
 
-            url = s3.generate_presigned_url(ClientMethod='get_object',
-                                            Params={'Bucket': bucket, 'Key': key},
-                                            ExpiresIn=self.S3_URL_EXPIRATION)
+        Returns a (content, etag) tuple, where content is None if S3 reports the resource as not modified.
+        """
+        body, etag = self.get_s3_bytes_if_modified(dataset_id, resource, etag, restricted_bucket)
+        if body is None:
+            return None, etag
+        return json.loads(body.decode('utf-8')), etag
 
-            resp = requests.get(url)
+    def get_s3_bytes_if_modified(self, dataset_id, resource, etag=None, restricted_bucket=False, missing_ok=False):
+        """Fetch the raw bytes of a resource unless it still matches etag.
+
+        Returns a (body, etag) tuple, where body is None if S3 reports the resource as not modified. With missing_ok
+        set, a resource that does not exist is returned as (None, None) rather than raising.
+        """
+        key = dataset_id + resource
+        params = {'Bucket': self.get_bucket(restricted_bucket), 'Key': key}
+        if etag:
+            params['IfNoneMatch'] = etag
 
-            try:
-                json_resp = resp.json()
-                return json_resp
-            except ValueError as e:
-                current_app.logger.error('Something went wrong getting a resource from S3: ' + str(e))
-                return resp.text
+        started = time.monotonic()
+        try:
+            res = self.get_s3_session().get_object(**params)
+            body = res['Body'].read()
+        except ClientError as e:
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if status == 304:
+                _record_fetch(key, 0, time.monotonic() - started, not_modified=True)
+                return None, etag
+            if missing_ok and e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None, None
+            current_app.logger.error('Something went wrong getting a resource from S3: ' + str(e))
+            raise e
         except Exception as e:
-            current_app.logger.error(str(e))
+            current_app.logger.error('Something went wrong getting a resource from S3: ' + str(e))
             raise e
 
+        _record_fetch(key, len(body), time.monotonic() - started)
+        return body, res['ETag']
+
+    def get_bucket(self, restricted_bucket=False):
+        return self.S3_BUCKET_RESTRICTED if restricted_bucket else self.BUCKET_NAME
+
     def build_presigned_url(self, path, restricted_bucket=False):
         s3 = self.get_s3_session()
 
@@ -56,6 +106,19 @@ class S3(object):
                                         ExpiresIn=self.S3_URL_EXPIRATION)
         return url
 
+    def signing_credentials_valid_for(self):
+        """Return how many seconds the credentials presigned URLs are signed with remain valid.
+
+        Returns None for static credentials, which do not expire. Temporary credentials, such as an IAM role's,
+        carry an expiry time, after which any URL signed with them is rejected.
+        """
+        # The client was created from this session, so it signs with the credentials the session holds
+        _, session = self._get_client()
+        expiry = _expiry_time(session.get_credentials())
+        if expiry is None:
+            return None
+        return (expiry - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
     def fetch_s3_file(self, path, bucket):
         try:
             s3 = self.get_s3_session()
@@ -68,6 +131,26 @@ class S3(object):
             current_app.logger.error("Something went wrong fetching the S3 file: {}".format(e))
             raise e
 
+    def get_s3_json(self, path, bucket):
+        """Fetch and parse a JSON file, returning None if it does not exist.
+
+        Unlike fetch_s3_file, any other error is raised, so throttling and server errors can be retried.
+        """
+        try:
+            res = self.get_s3_session().get_object(Bucket=bucket, Key=path)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise e
+        return json.loads(res['Body'].read())
+
+    def s3_file_exists(self, path, bucket):
+        try:
+            self.get_s3_session().head_object(Bucket=bucket, Key=path)
+            return True
+        except ClientError:
+            return False
+
     def write_to_s3(self, path, content, bucket):
         try:
             s3 = self.get_s3_session()
@@ -75,3 +158,38 @@ class S3(object):
         except Exception as e:
             current_app.logger.error("Something went wrong writing to the S3 bucket: {}".format(e))
             raise e
+
+
+def _create_client(region, session):
+    return session.client('s3', config=Config(
+        signature_version='s3v4',
+        region_name=region,
+        max_pool_connections=app.config.get('S3_MAX_POOL_CONNECTIONS'),
+        connect_timeout=app.config.get('DEFAULT_TIMEOUT'),
+        read_timeout=app.config.get('DEFAULT_TIMEOUT')))
+
+
+def _expiry_time(credentials):
+    # Only temporary credentials expire. botocore has no public accessor for when, so should the attribute go away
+    # the credentials are treated as not expiring, leaving URLs to be reused for the usual time
+    if not isinstance(credentials, RefreshableCredentials):
+        return None
+    try:
+        return credentials._expiry_time
+    except AttributeError:
+        return None
+
+
+def get_fetch_stats():
+    with _fetch_stats_lock:
+        return dict(_fetch_stats)
+
+
+def _record_fetch(key, size, seconds, not_modified=False):
+    with _fetch_stats_lock:
+        _fetch_stats['requests'] += 1
+        _fetch_stats['bytes'] += size
+        _fetch_stats['seconds'] += seconds
+        if not_modified:
+            _fetch_stats['not_modified'] += 1
+    current_app.logger.debug('Fetched {} from S3: {} bytes in {:.3f}s'.format(key, size, seconds))
@@ -1,4 +1,7 @@
+from flask import current_app, g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
 from ulapd_api.custom_extensions.enhanced_logging.main import EnhancedLogging
 
 # Create empty extension objects here
@@ -16,6 +19,20 @@ def register_extensions(app):
 
     # Database
     db.init_app(app)
+    # Count the connections each request checks out of the pool, and log the total once it has been handled
+    event.listen(Pool, 'checkout', _count_checkout)
+    app.after_request(_log_checkouts)
 
     # All done!
     app.logger.info("Extensions registered")
+
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    if has_request_context():
+        g.db_checkouts = g.get('db_checkouts', 0) + 1
+
+
+def _log_checkouts(response):
+    current_app.logger.debug('{} {} checked out {} database connection(s)'.format(
+        request.method, request.path, g.get('db_checkouts', 0)))
+    return response
@@ -4,10 +4,18 @@ from ulapd_api.app import app
 from ulapd_api.blueprints import register_blueprints
 from ulapd_api.exceptions import register_exception_handlers
 from ulapd_api.extensions import register_extensions
+from ulapd_api.utilities.invalidation import start_listener
+from ulapd_api.utilities.warm_up import warm_up
 
 # Now we register any extensions we use into the app
 register_extensions(app)
 # Register the exception handlers
 register_exception_handlers(app)
-# Finally we register our blueprints to get our routes up and running.
+# Then we register our blueprints to get our routes up and running.
 register_blueprints(app)
+# Optionally open connections and fill caches now, rather than on the first requests after a deploy
+if app.config.get('WARM_UP_ON_START'):
+    warm_up(app)
+# Each worker starts listening for other workers' writes when it serves its first request
+if app.config.get('CACHE_INVALIDATION_LISTEN'):
+    app.before_request(start_listener)
@@ -13,6 +13,7 @@ class Activity(db.Model):
     ip_address = db.Column(db.String, nullable=False)
     api = db.Column(db.Boolean, nullable=False)
     file = db.Column(db.String, nullable=False)
+    __table_args__ = (db.Index('ix_activity_user_dataset_timestamp', user_details_id, dataset_name, timestamp),)
 
     def __init__(self, activity_data):
         self.user_details_id = activity_data['user_details_id']
@@ -47,6 +48,13 @@ class Activity(db.Model):
         return Activity.query.filter_by(user_details_id=user_details_id,
                                         dataset_name=dataset).order_by(desc(Activity.timestamp)).all()
 
+    @staticmethod
+    def get_user_downloads(user_details_id):
+        # Only the columns the download history needs, newest first within each dataset
+        return Activity.query.with_entities(Activity.dataset_name, Activity.timestamp, Activity.file).filter_by(
+            user_details_id=user_details_id, activity_type='download').order_by(
+            Activity.dataset_name, desc(Activity.timestamp)).all()
+
     def as_dict(self):
         return {
             'activity_id': self.activity_id,
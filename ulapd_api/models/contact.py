@@ -5,7 +5,8 @@ from ulapd_api.extensions import db
 class Contact(db.Model):
     __tablename__ = 'contact'
     contact_id = db.Column(db.Integer, primary_key=True)
-    user_details_id = db.Column(db.Integer, db.ForeignKey('user_details.user_details_id'), nullable=False)
+    user_details_id = db.Column(db.Integer, db.ForeignKey('user_details.user_details_id'), nullable=False,
+                                index=True)
     contact_type = db.Column(db.String, nullable=False)
     date_added = db.Column(db.DateTime(timezone=False), default=datetime.datetime.now)
 
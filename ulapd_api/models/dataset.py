@@ -1,5 +1,6 @@
 import datetime
 from ulapd_api.extensions import db
+from ulapd_api.models.dataset_metadata import DatasetMetadata
 
 
 class Dataset(db.Model):
@@ -33,6 +34,20 @@ class Dataset(db.Model):
     def get_all(external=False):
         return Dataset.query.filter_by(external=external).all()
 
+    @staticmethod
+    def get_all_datasets():
+        return Dataset.query.all()
+
+    @staticmethod
+    def get_all_with_metadata(external=False):
+        return db.session.query(Dataset, DatasetMetadata).outerjoin(
+            DatasetMetadata, DatasetMetadata.dataset_name == Dataset.name).filter(Dataset.external == external).all()
+
+    @staticmethod
+    def get_dataset_with_metadata(name):
+        return db.session.query(Dataset, DatasetMetadata).outerjoin(
+            DatasetMetadata, DatasetMetadata.dataset_name == Dataset.name).filter(Dataset.name == name).first()
+
     @staticmethod
     def get_dataset_by_id(dataset_id):
         return Dataset.query.filter_by(dataset_id=dataset_id).first()
@@ -41,6 +56,10 @@ class Dataset(db.Model):
     def get_dataset_by_name(name):
         return Dataset.query.filter_by(name=name).first()
 
+    @staticmethod
+    def get_datasets_by_names(names):
+        return Dataset.query.filter(Dataset.name.in_(names)).all()
+
     @staticmethod
     def get_dataset_by_licence_name(licence_name):
         return Dataset.query.filter_by(licence_name=licence_name).first()
@@ -0,0 +1,31 @@
+import datetime
+from ulapd_api.extensions import db
+
+
+class DatasetMetadata(db.Model):
+    """Copy of a dataset's metadata.json, refreshed from S3 by dataset_service.sync_metadata."""
+    __tablename__ = 'dataset_metadata'
+    dataset_name = db.Column(db.String, primary_key=True)
+    bucket = db.Column(db.String, nullable=False)
+    etag = db.Column(db.String, nullable=False)
+    content = db.Column(db.JSON, nullable=False)
+    synced = db.Column(db.DateTime(timezone=False), default=datetime.datetime.utcnow,
+                       onupdate=datetime.datetime.utcnow)
+
+    def __init__(self, metadata):
+        self.dataset_name = metadata['dataset_name']
+        self.bucket = metadata['bucket']
+        self.etag = metadata['etag']
+        self.content = metadata['content']
+
+    @staticmethod
+    def get_all():
+        return DatasetMetadata.query.all()
+
+    def as_dict(self):
+        return {
+            'dataset_name': self.dataset_name,
+            'bucket': self.bucket,
+            'etag': self.etag,
+            'synced': self.synced
+        }
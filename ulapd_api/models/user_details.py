@@ -1,14 +1,16 @@
 import datetime
 from ulapd_api.extensions import db
+from ulapd_api.models.user_type import UserType
+from ulapd_api.models.contact import Contact
 
 
 class UserDetails(db.Model):
     __tablename__ = 'user_details'
     user_details_id = db.Column(db.Integer, primary_key=True)
     user_type_id = db.Column(db.Integer, nullable=False)
-    ldap_id = db.Column(db.String, nullable=False)
-    api_key = db.Column(db.String, nullable=False)
-    email = db.Column(db.String, nullable=True)
+    ldap_id = db.Column(db.String, nullable=False, index=True)
+    api_key = db.Column(db.String, nullable=False, index=True)
+    email = db.Column(db.String, nullable=True, index=True)
     title = db.Column(db.String, nullable=False)
     first_name = db.Column(db.String, nullable=False)
     last_name = db.Column(db.String, nullable=False)
@@ -51,6 +53,35 @@ class UserDetails(db.Model):
     def get_user_details_all():
         return UserDetails.query.all()
 
+    @staticmethod
+    def get_all_with_user_type(batch_size, after=None, limit=None):
+        # Streamed from a server-side cursor, batch_size rows at a time
+        query = db.session.query(UserDetails, UserType).outerjoin(
+            UserType, UserType.user_type_id == UserDetails.user_type_id)
+        if after is not None:
+            query = query.filter(UserDetails.user_details_id > after)
+        return query.order_by(UserDetails.user_details_id).limit(limit).yield_per(batch_size)
+
+    @staticmethod
+    def get_missing_user_type_id(after=None, limit=None):
+        # The user_type_id of the first user in the page whose user type does not exist, or None if they all do
+        page = db.session.query(UserDetails.user_type_id)
+        if after is not None:
+            page = page.filter(UserDetails.user_details_id > after)
+        page = page.order_by(UserDetails.user_details_id).limit(limit).subquery()
+        return db.session.query(page.c.user_type_id).outerjoin(
+            UserType, UserType.user_type_id == page.c.user_type_id).filter(
+            UserType.user_type_id.is_(None)).limit(1).scalar()
+
+    @staticmethod
+    def get_user_with_contacts(key, value):
+        # One (user, contact) row per contact preference, or a single (user, None) row when there are none
+        user_id = db.session.query(UserDetails.user_details_id).filter(
+            getattr(UserDetails, key) == value).limit(1).as_scalar()
+        return db.session.query(UserDetails, Contact).outerjoin(
+            Contact, Contact.user_details_id == UserDetails.user_details_id).filter(
+            UserDetails.user_details_id == user_id).order_by(Contact.contact_id).all()
+
     @staticmethod
     def get_user_details_by_id(user_details_id):
         return UserDetails.query.filter_by(user_details_id=user_details_id).first()
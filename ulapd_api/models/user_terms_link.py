@@ -9,6 +9,7 @@ class UserTermsLink(db.Model):
     user_details_id = db.Column(db.Integer, db.ForeignKey('user_details.user_details_id'), nullable=False)
     licence_name = db.Column(db.String, nullable=True)
     date_agreed = db.Column(db.DateTime(timezone=False), default=datetime.datetime.utcnow)
+    __table_args__ = (db.Index('ix_user_terms_link_user_licence_date', user_details_id, licence_name, date_agreed),)
 
     def __init__(self, user_terms_data):
         self.user_details_id = user_terms_data['user_details_id']
@@ -23,6 +24,12 @@ class UserTermsLink(db.Model):
         return UserTermsLink.query.filter_by(user_details_id=user_details_id,
                                              licence_name=licence).order_by(desc(UserTermsLink.date_agreed)).first()
 
+    @staticmethod
+    def get_latest_user_terms_by_user_id(user_details_id):
+        # The most recent agreement to each licence, using Postgres' DISTINCT ON
+        return UserTermsLink.query.filter_by(user_details_id=user_details_id).distinct(
+            UserTermsLink.licence_name).order_by(UserTermsLink.licence_name, desc(UserTermsLink.date_agreed)).all()
+
     @staticmethod
     def delete_user_by_user_id(user_details_id):
         return UserTermsLink.query.filter_by(user_details_id=user_details_id).delete()
@@ -18,6 +18,10 @@ class UserType(db.Model):
     def get_user_id_by_type(user_type):
         return UserType.query.filter_by(user_type=user_type).first()
 
+    @staticmethod
+    def get_all_user_types():
+        return UserType.query.all()
+
     def as_dict(self):
         return {
             'user_type_id': self.user_type_id,
@@ -1,36 +1,118 @@
 from ulapd_api.models.dataset import Dataset
+from ulapd_api.models.dataset_metadata import DatasetMetadata
 from ulapd_api.extensions import db
 from ulapd_api.exceptions import ApplicationError
 from ulapd_api.utilities.decorators import handle_errors
 from ulapd_api.utilities.helpers import format_file_size, format_last_updated_date
-from ulapd_api.dependencies.s3 import S3
+from ulapd_api.utilities.cache import MetadataCache, PresignedUrlCache
+from ulapd_api.utilities.concurrency import map_concurrently
+from ulapd_api.utilities.invalidation import notify, subscribe
+from ulapd_api.utilities.reference_data import reload_reference_data
+from ulapd_api.dependencies.s3 import S3, get_fetch_stats
 from ulapd_api.app import app
+from flask import g, has_app_context, json as flask_json
+from botocore.exceptions import ClientError, ConnectionError as S3ConnectionError, HTTPClientError
+import datetime
+import hashlib
 import json
+import random
+import time
+from concurrent import futures
 from common_utilities import errors
 
+# Fields of a dataset taken from its row, as returned by Dataset.as_dict
+ROW_FIELDS = ('dataset_id', 'name', 'title', 'version', 'url', 'description', 'licence_id', 'state', 'type',
+              'private', 'metadata_created', 'external')
+
+# Fields of a dataset computed from its metadata.json
+METADATA_FIELDS = {
+    'file_count': lambda metadata: metadata.get('file_count'),  # Not always populated
+    'last_updated': lambda metadata: format_last_updated_date(metadata['last_updated']),
+    'fee': lambda metadata: metadata['fee'],
+    'tech_spec_url': lambda metadata: metadata['tech_spec_url'],
+    'format': lambda metadata: metadata['format'],
+    'update_frequency': lambda metadata: metadata['update_frequency'],
+    'file_size': lambda metadata: format_file_size(metadata['file_size']),
+    'resources': lambda metadata: list(map(_map_resources, metadata['resources'])),
+    'public_resources': lambda metadata: list(map(_map_resources, metadata['public_resources']))
+}
+
+metadata_cache = MetadataCache(app.config.get('METADATA_CACHE_TTL'), app.config.get('METADATA_CACHE_MAX_STALENESS'),
+                               app.config.get('METADATA_CACHE_REFRESH_INTERVAL'), app.app_context)
+# S3 error codes for throttling and server faults, which may succeed when retried
+RETRYABLE_S3_ERRORS = {'SlowDown', 'InternalError', 'ServiceUnavailable'}
+download_url_cache = PresignedUrlCache(app.config.get('S3_URL_EXPIRATION'), app.config.get('S3_URL_REUSE_FRACTION'))
+
 
 @handle_errors(is_get=True)
-def get_datasets(external=False, simple=False):
-    if simple:
-        return _extract_rows(Dataset.get_all(external))
-    else:
-        return _extract_rows(Dataset.get_all(external), _metadata_extend)
+def get_datasets(external=False, simple=False, fields=None):
+    """Return every dataset, extended with its metadata unless simple is set.
+
+    Metadata is read from the dataset_metadata table kept by sync_metadata, falling back to metadata.json in S3 for
+    datasets that have not been synced. fields, if given, overrides simple and limits each dataset to the named
+    fields, and metadata is then only read when one of them comes from it.
+    """
+    if fields is not None:
+        _check_fields(fields)
+    if _with_metadata(simple, fields):
+        return _datasets_from_results(Dataset.get_all_with_metadata(external), simple, fields)
+    return _datasets_from_results([(dataset, None) for dataset in Dataset.get_all(external)], simple, fields)
 
 
 @handle_errors(is_get=True)
 def get_dataset_by_name(name):
-    dataset = Dataset.get_dataset_by_name(name)
-    if dataset:
-        return _metadata_extend(dataset.as_dict())
-    else:
-        raise ApplicationError(*errors.get('ulapd_api', 'DATASET_NOT_FOUND', filler=name), http_code=404)
+    return _extend_rows([_get_dataset_with_metadata(name)])[0]
+
+
+@handle_errors(is_get=True)
+def get_datasets_with_etag(external=False, simple=False, fields=None, if_none_match=()):
+    """Return a strong ETag for get_datasets along with the datasets, or with None if the ETag is in if_none_match.
+
+    Both come from one read of the datasets. The ETag is None when it cannot be worked out without going to S3 until
+    the datasets have been built.
+    """
+    if fields is not None:
+        _check_fields(fields)
+    results = Dataset.get_all_with_metadata(external)
+    etag = _rows_etag(results, simple, fields)
+    if etag is not None and etag in if_none_match:
+        return etag, None
+
+    datasets = _datasets_from_results(results, simple, fields)
+    # Building the datasets leaves the metadata cache fresh, so a missing ETag can now be worked out
+    return etag or _rows_etag(results, simple, fields), datasets
+
+
+@handle_errors(is_get=True)
+def get_dataset_with_etag(name, if_none_match=()):
+    """Return a strong ETag for get_dataset_by_name along with the dataset, as get_datasets_with_etag does."""
+    result = _get_dataset_with_metadata(name)
+    etag = _rows_etag([result])
+    if etag is not None and etag in if_none_match:
+        return etag, None
+
+    dataset = _extend_rows([result])[0]
+    return etag or _rows_etag([result]), dataset
 
 
 @handle_errors(is_get=True)
 def get_dataset_history(name):
+    """Return the dataset with its history as an encoded JSON document.
+
+    The history is pre-rendered by update_historical_cache, so its bytes are passed through without being parsed.
+    """
     dataset = Dataset.get_dataset_by_name(name)
     if dataset:
-        return _metadata_extend_history(dataset.as_dict())
+        row = dataset.as_dict()
+        if row['external']:
+            return flask_json.dumps(row).encode('utf-8')
+
+        dataset_history = _get_rendered_history(row['name'], _history_restricted(row))
+        if dataset_history is None:
+            # The history caches have not been rebuilt since pre-rendering was added
+            return flask_json.dumps(_metadata_extend_history(row)).encode('utf-8')
+
+        return flask_json.dumps(row).encode('utf-8')[:-1] + b', "dataset_history": ' + dataset_history + b'}'
     else:
         raise ApplicationError(*errors.get('ulapd_api', 'DATASET_NOT_FOUND', filler=name), http_code=404)
 
@@ -44,119 +126,425 @@ def create_dataset(data):
 
     new_dataset = Dataset(data)
     db.session.add(new_dataset)
+    notify(db.session, 'dataset', data['name'])
     db.session.commit()
+    reload_reference_data()
+    _evict_metadata(data['name'])
     return new_dataset.as_dict()
 
 
 @handle_errors(is_get=True)
 def get_download_link(dataset_name, file_name, date=None):
-    if date:
-        path = '{}/history/{}/{}'.format(dataset_name, date, file_name)
-    else:
-        path = '{}/{}'.format(dataset_name, file_name)
+    return _sign_download(S3(), _download_path(dataset_name, file_name, date), _is_private(dataset_name))
+
 
-    is_private = get_dataset_by_name(dataset_name).get('private')
-    return S3().build_presigned_url(path, is_private)
+@handle_errors(is_get=True)
+def get_download_links(files):
+    """Return a presigned link for each {name, file, date} in files, in the same order.
+
+    Privacy is looked up with one query for all the datasets named, and every link is signed with the same client.
+    """
+    if not isinstance(files, list) or not all(isinstance(item, dict) and item.get('name') and item.get('file')
+                                              for item in files):
+        raise ApplicationError('Expected a list of objects with a name, file and optional date', 'E102',
+                               http_code=400)
+    limit = app.config.get('DOWNLOAD_BATCH_LIMIT')
+    if len(files) > limit:
+        raise ApplicationError('At most {} files can be asked for at once'.format(limit), 'E102', http_code=400)
+
+    names = {item['name'] for item in files}
+    privacy = {dataset.name: dataset.private for dataset in Dataset.get_datasets_by_names(names)}
+    missing = sorted(names - set(privacy))
+    if missing:
+        raise ApplicationError(*errors.get('ulapd_api', 'DATASET_NOT_FOUND', filler=', '.join(missing)),
+                               http_code=404)
 
+    s3 = S3()
+    links = []
+    for item in files:
+        path = _download_path(item['name'], item['file'], item.get('date'))
+        links.append({'name': item['name'],
+                      'file': item['file'],
+                      'date': item.get('date'),
+                      'link': _sign_download(s3, path, privacy[item['name']])})
+    return links
 
-@handle_errors(is_get=False)
-def update_historical_cache():
 
+@handle_errors(is_get=False)
+def update_historical_cache(full=False):
     s3 = S3()
-    session = s3.get_s3_session()
-    buckets = [s3.BUCKET_NAME, s3.S3_BUCKET_RESTRICTED]
-
-    for bucket in buckets:
-        datasets = _fetch_prefixes(session.list_objects_v2(Bucket=bucket, Delimiter='/'))
-        app.logger.info('Found {} datasets {}, updating cache.'.format(len(datasets), datasets))
-
-        for dataset in datasets:
-            months = _fetch_prefixes(session.list_objects_v2(Bucket=bucket, Prefix=dataset + 'history/',
-                                                             Delimiter='/'))
-            app.logger.info('Months found: ' + str(months))
-
-            def fetch_metadata(month):
-                if month is not None:
-                    try:
-                        return s3.fetch_s3_file(month + 'metadata.json', bucket)
-                    except Exception as e:
-                        app.logger.error('Error: {} '.format(str(e)))
-                        pass
-            historical_metadata = list(filter(lambda x: x is not None, map(fetch_metadata, months)))
-            app.logger.info('Historical Metadata Created: ' + str(historical_metadata))
-
-            try:
-                app.logger.info('writing to S3: ' + str(json.dumps(historical_metadata)))
-                s3.write_to_s3('{}history/history_cache.json'.format(dataset), json.dumps(historical_metadata), bucket)
-            except Exception:
-                return {
-                    'result': 'Failed to write cache, please check logs'
-                }
+    concurrency = app.config.get('HISTORY_CACHE_CONCURRENCY')
+
+    datasets = []
+    for bucket in [s3.BUCKET_NAME, s3.S3_BUCKET_RESTRICTED]:
+        inventory = _with_retries(app.config.get('HISTORY_CACHE_RETRIES'), _inventory_history, s3.get_s3_session(),
+                                  bucket)
+        app.logger.info('Found {} datasets {}, updating cache.'.format(len(inventory), sorted(inventory)))
+        datasets.extend({'bucket': bucket, 'dataset': dataset, 'months': months, 'fetched': {}}
+                        for dataset, months in sorted(inventory.items()))
+
+    def read_cache(dataset):
+        # Past months never change, so unless a full rebuild is asked for only months missing from the existing
+        # cache, or whose metadata.json has a new ETag, are fetched
+        if full:
+            return None, 0
+        return _timed(_read_history_cache, s3, dataset['bucket'], dataset['dataset'])
+
+    # Every month of every dataset goes through one bounded pool, so a dataset with a long history does not hold
+    # up the others
+    fetches = []
+    results = map_concurrently(read_cache, datasets, concurrency)
+    for dataset, (existing, seconds) in zip(datasets, results):
+        cached = _index_history_cache(existing)
+        dataset['existing'] = existing
+        dataset['cached'] = {month['month']: cached[month['month']] for month in dataset['months']
+                             if cached.get(month['month'], {}).get('history_etag') == month['etag']}
+        dataset['seconds'] = seconds
+        fetches.extend((dataset, month) for month in dataset['months'] if month['month'] not in dataset['cached'])
+
+    def fetch_metadata(fetch):
+        dataset, month = fetch
+        return _timed(_fetch_month_metadata, s3, dataset['bucket'], dataset['dataset'], month)
+
+    results = map_concurrently(fetch_metadata, fetches, concurrency)
+    for (dataset, month), (metadata, seconds) in zip(fetches, results):
+        dataset['seconds'] += seconds
+        if metadata is not None:
+            dataset['fetched'][month['month']] = metadata
+
+    for dataset in datasets:
+        months = [month['month'] for month in dataset['months']]
+        dataset['metadata'] = [dataset['cached'].get(month) or dataset['fetched'][month] for month in months
+                               if month in dataset['cached'] or month in dataset['fetched']]
+        # Months whose metadata.json could not be fetched are left out of the cache until a later run
+        dataset['dropped'] = [month for month in months
+                              if month not in dataset['cached'] and month not in dataset['fetched']]
+
+    def write_cache(dataset):
+        if dataset['metadata'] == dataset['existing'] and \
+                s3.s3_file_exists('{}history/dataset_history.json'.format(dataset['dataset']), dataset['bucket']):
+            return None, 0
+        return _timed(_write_history_cache, s3, dataset['bucket'], dataset['dataset'], dataset['metadata'])
+
+    failed = []
+    incomplete = []
+    timings = {}
+    results = map_concurrently(write_cache, datasets, concurrency)
+    for dataset, (written, seconds) in zip(datasets, results):
+        name = '{}/{}'.format(dataset['bucket'], dataset['dataset'].rstrip('/'))
+        if written is False:
+            failed.append(name)
+        if dataset['dropped']:
+            incomplete.append(name)
+        timings[name] = {
+            'months': len(dataset['metadata']),
+            'fetched': len(dataset['fetched']),
+            'dropped': dataset['dropped'],
+            'bytes': sum(month['size'] for month in dataset['months'] if month['month'] in dataset['fetched']),
+            'updated': bool(written),
+            'seconds': round(dataset['seconds'] + seconds, 3)
+        }
+
+    if failed:
+        return {
+            'result': 'Failed to write cache, please check logs',
+            'failed': failed,
+            'datasets': timings
+        }
+
+    if incomplete:
+        return {
+            'result': 'Some months could not be fetched, please check logs',
+            'incomplete': incomplete,
+            'datasets': timings
+        }
 
     return {
         'result': 'ok',
+        'datasets': timings
+    }
+
+
+@handle_errors(is_get=False)
+def sync_metadata():
+    """Copy every dataset's metadata.json from S3 into the dataset_metadata table.
+
+    Documents are fetched conditionally on the ETag of the stored copy, so only changed ones are downloaded and
+    written. Copies for datasets that no longer exist, or have become external, are removed.
+    """
+    s3 = S3()
+    existing = {synced.dataset_name: synced for synced in DatasetMetadata.get_all()}
+    targets = []
+    for row in _extract_rows(Dataset.get_all(False)):
+        bucket = s3.get_bucket(row['private'])
+        synced = existing.get(row['name'])
+        etag = synced.etag if synced is not None and synced.bucket == bucket else None
+        targets.append({'name': row['name'], 'private': row['private'], 'bucket': bucket, 'etag': etag})
+
+    def fetch(target):
+        try:
+            return _with_retries(app.config.get('METADATA_SYNC_RETRIES'), s3.get_s3_resource_if_modified,
+                                 target['name'], '/metadata.json', target['etag'], target['private'])
+        except Exception as e:
+            app.logger.error('Failed to fetch metadata for {}: {}'.format(target['name'], str(e)))
+            return None
+
+    fetched = map_concurrently(fetch, targets, app.config.get('METADATA_FETCH_CONCURRENCY'))
+    now = datetime.datetime.utcnow()
+
+    updated = []
+    failed = []
+    for target, result in zip(targets, fetched):
+        if result is None:
+            failed.append(target['name'])
+            continue
+        content, etag = result
+        if content is None:
+            # Unchanged, but checked, so the copy is good for another METADATA_SYNC_MAX_AGE
+            existing[target['name']].synced = now
+            continue
+
+        synced = existing.get(target['name'])
+        if synced is None:
+            db.session.add(DatasetMetadata({'dataset_name': target['name'], 'bucket': target['bucket'],
+                                            'etag': etag, 'content': content}))
+        else:
+            synced.bucket = target['bucket']
+            synced.etag = etag
+            synced.content = content
+        updated.append(target['name'])
+
+    removed = sorted(set(existing) - {target['name'] for target in targets})
+    for name in removed:
+        db.session.delete(existing[name])
+    db.session.commit()
+
+    app.logger.info('Synced metadata for {} datasets, updated {}, removed {}.'.format(len(targets), updated, removed))
+    result = {
+        'result': 'ok',
+        'updated': updated,
+        'unchanged': len(targets) - len(updated) - len(failed),
+        'removed': removed
     }
+    if failed:
+        result['result'] = 'Failed to sync metadata for some datasets, please check logs'
+        result['failed'] = failed
+    return result
+
+
+def get_metadata_cache_stats():
+    return {
+        'cache': metadata_cache.stats(),
+        'download_urls': download_url_cache.stats(),
+        's3': get_fetch_stats()
+    }
+
+
+def _get_dataset_with_metadata(name):
+    result = Dataset.get_dataset_with_metadata(name)
+    if not result:
+        raise ApplicationError(*errors.get('ulapd_api', 'DATASET_NOT_FOUND', filler=name), http_code=404)
+    return result
+
+
+def _with_metadata(simple, fields):
+    # fields, if given, overrides simple
+    if fields is None:
+        return not simple
+    return any(field in METADATA_FIELDS for field in fields)
+
+
+def _datasets_from_results(results, simple, fields):
+    # results are (Dataset, DatasetMetadata) pairs, whose metadata is only used if _with_metadata
+    if not _with_metadata(simple, fields):
+        rows = _extract_rows(dataset for dataset, _ in results)
+    elif fields is None:
+        rows = _extend_rows(results)
+    else:
+        rows = _extend_rows(results, [field for field in fields if field in METADATA_FIELDS])
+    if fields is None:
+        return rows
+    return [{field: row[field] for field in fields if field in row} for row in rows]
 
 
 def _extract_rows(rows, map_func=lambda _: _):
     return [map_func(row.as_dict()) for row in rows]
 
 
-def _metadata_extend(row):
-    if not row['external']:
-        metadata = S3().get_s3_resource(row['name'], '/metadata.json', row['private'])
+def _extend_rows(results, fields=None):
+    # results are (Dataset, DatasetMetadata) pairs from the joined query, with None for datasets never synced
+    rows = []
+    unsynced = []
+    for dataset, synced in results:
+        row = dataset.as_dict()
+        rows.append(row)
+        if row['external']:
+            continue
+        metadata = _synced_metadata(row, synced)
+        if metadata is None:
+            unsynced.append(row)
+        else:
+            _apply_metadata(row, metadata, fields)
+
+    ages = []
+    _map_rows_concurrently(unsynced, lambda row: _metadata_extend(row, fields, ages))
+    _note_stale_metadata(ages)
+    return rows
+
+
+def _synced_metadata(row, synced):
+    # A copy taken from the other bucket is out of date once a dataset's privacy has changed, and one that has not
+    # been synced for METADATA_SYNC_MAX_AGE may be. Either way the dataset is read through the metadata cache instead
+    if synced is None or synced.bucket != S3().get_bucket(row['private']):
+        return None
+    max_age = datetime.timedelta(seconds=app.config.get('METADATA_SYNC_MAX_AGE'))
+    if synced.synced is None or datetime.datetime.utcnow() - synced.synced > max_age:
+        return None
+    return synced.content
+
+
+def _map_rows_concurrently(rows, map_func):
+    # Fetch every dataset's metadata in parallel so the request takes as long as the slowest fetch, not their sum
+    try:
+        return map_concurrently(map_func, rows,
+                                app.config.get('METADATA_FETCH_CONCURRENCY'),
+                                app.config.get('METADATA_FETCH_DEADLINE'))
+    except futures.TimeoutError as e:
+        app.logger.error('Fetching dataset metadata timed out: {}'.format(str(e)))
+        raise ApplicationError('Timed out fetching dataset metadata', 'S3', http_code=504)
+
+
+def _is_private(name):
+    # Only the private flag is needed to pick the bucket, so the S3 metadata is not fetched
+    dataset = Dataset.get_dataset_by_name(name)
+    if not dataset:
+        raise ApplicationError(*errors.get('ulapd_api', 'DATASET_NOT_FOUND', filler=name), http_code=404)
+    return dataset.private
+
+
+def _download_path(dataset_name, file_name, date=None):
+    if date:
+        return '{}/history/{}/{}'.format(dataset_name, date, file_name)
+    return '{}/{}'.format(dataset_name, file_name)
 
-        # Top level elements
-        row['file_count'] = metadata.get('file_count')  # Not always populated
-        row['last_updated'] = format_last_updated_date(metadata['last_updated'])
-        row['fee'] = metadata['fee']
-        row['tech_spec_url'] = metadata['tech_spec_url']
-        row['format'] = metadata['format']
-        row['update_frequency'] = metadata['update_frequency']
-        row['file_size'] = format_file_size(metadata['file_size'])
 
-        # Array elements
-        row['resources'] = list(map(lambda x: _map_resources(x), metadata['resources']))
-        row['public_resources'] = list(map(lambda x: _map_resources(x), metadata['public_resources']))
+def _sign_download(s3, path, is_private):
+    return download_url_cache.get(s3.get_bucket(is_private), path, lambda: s3.build_presigned_url(path, is_private),
+                                  s3.signing_credentials_valid_for)
+
+
+def _metadata_extend(row, fields=None, ages=None):
+    if not row['external']:
+        metadata, age = _get_metadata(row['name'], row['private'])
+        _apply_metadata(row, metadata, fields)
+        if ages is not None:
+            ages.append(age)
 
     return row
 
 
+def _note_stale_metadata(ages):
+    # Metadata past its TTL is only served when S3 could not be reached, and the view reports it with an Age header
+    age = max(ages, default=0)
+    if age >= metadata_cache.ttl and has_app_context():
+        g.metadata_age = max(int(age), g.get('metadata_age', 0))
+
+
+def _apply_metadata(row, metadata, fields=None):
+    for field, extract in METADATA_FIELDS.items():
+        if fields is None or field in fields:
+            row[field] = extract(metadata)
+
+
+def _check_fields(fields):
+    unknown = set(fields) - set(ROW_FIELDS) - set(METADATA_FIELDS)
+    if unknown:
+        raise ApplicationError('Unknown dataset fields: {}'.format(', '.join(sorted(unknown))), 'E102',
+                               http_code=400)
+
+
+def _rows_etag(results, simple=False, fields=None):
+    # The payload is built from the rows plus each dataset's metadata.json, so hashing the rows with the ETags of
+    # the metadata identifies it. Metadata read from S3 that is outside its cache TTL would be revalidated by a real
+    # request, so no ETag is given until that has happened.
+    with_metadata = _with_metadata(simple, fields)
+    rows = []
+    versions = []
+    s3 = S3()
+    for dataset, synced in results:
+        row = dataset.as_dict()
+        rows.append(row)
+        if with_metadata and not row['external']:
+            if _synced_metadata(row, synced) is not None:
+                etag = synced.etag
+            else:
+                etag = metadata_cache.peek_etag(s3.get_bucket(row['private']), row['name'] + '/metadata.json')
+            if etag is None:
+                return None
+            versions.append(etag)
+
+    digest = hashlib.sha256(flask_json.dumps([simple, fields, rows, versions], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _get_metadata(name, private):
+    s3 = S3()
+
+    def fetch(etag):
+        return s3.get_s3_resource_if_modified(name, '/metadata.json', etag, private)
+
+    return metadata_cache.get_with_age(s3.get_bucket(private), name + '/metadata.json', fetch)
+
+
 def _metadata_extend_history(row):
     if not row['external']:
-        if row['type'] == 'open':
-            metadata = S3().get_s3_resource(row['name'], '/history/history_cache.json')
-        else:
-            metadata = S3().get_s3_resource(row['name'], '/history/history_cache.json', row['private'])
-
-        dataset_history = []
-        for file in metadata:
-            resource_list = []
-            for resource in file['resources']:
-                resource_list.append({
-                    "file_size": format_file_size(resource['file_size']),
-                    "file_name": resource['file_name'],
-                    "format": resource['format']
-                })
-
-            last_updated_pattern = {
-                "Daily": "%d %B %Y",
-                "Monthly": "%B %Y",
-                "Every 3 months": "%B %Y"
-            }
-
-            pattern = last_updated_pattern[file['update_frequency']]
-
-            dataset_history.append({
-                "unsorted_date": file['last_updated'],
-                "last_updated": format_last_updated_date(file['last_updated'], pattern=pattern),
-                "resource_list": resource_list
+        metadata = S3().get_s3_resource(row['name'], '/history/history_cache.json', _history_restricted(row))
+        row['dataset_history'] = _render_history(metadata)
+    return row
+
+
+def _history_restricted(row):
+    # Open datasets keep their history in the public bucket even when the dataset itself is private
+    return False if row['type'] == 'open' else row['private']
+
+
+def _get_rendered_history(name, private):
+    s3 = S3()
+
+    def fetch(etag):
+        return s3.get_s3_bytes_if_modified(name, '/history/dataset_history.json', etag, private, missing_ok=True)
+
+    return metadata_cache.get(s3.get_bucket(private), name + '/history/dataset_history.json', fetch)
+
+
+def _render_history(history_cache):
+    # Shapes the entries of a history_cache.json into the dataset_history returned by GET /<name>/history
+    dataset_history = []
+    for file in history_cache:
+        resource_list = []
+        for resource in file['resources']:
+            resource_list.append({
+                "file_size": format_file_size(resource['file_size']),
+                "file_name": resource['file_name'],
+                "format": resource['format']
             })
 
-        dataset_history.reverse()
-        row['dataset_history'] = dataset_history
-        return row
-    return row
+        last_updated_pattern = {
+            "Daily": "%d %B %Y",
+            "Monthly": "%B %Y",
+            "Every 3 months": "%B %Y"
+        }
+
+        pattern = last_updated_pattern[file['update_frequency']]
+
+        dataset_history.append({
+            "unsorted_date": file['last_updated'],
+            "last_updated": format_last_updated_date(file['last_updated'], pattern=pattern),
+            "resource_list": resource_list
+        })
+
+    dataset_history.reverse()
+    return dataset_history
 
 
 def _map_resources(resource):
@@ -170,5 +558,108 @@ def _map_resources(resource):
     }
 
 
-def _fetch_prefixes(list_obj):
-    return list(map(lambda x: x['Prefix'], list_obj['CommonPrefixes']))
+def _fetch_month_metadata(s3, bucket, dataset, month):
+    try:
+        metadata = _with_retries(app.config.get('HISTORY_CACHE_RETRIES'), s3.get_s3_json,
+                                 '{}history/{}/metadata.json'.format(dataset, month['month']), bucket)
+    except Exception as e:
+        app.logger.error('Error: {} '.format(str(e)))
+        return None
+
+    if metadata is not None:
+        # Record which version of which month the entry came from so later runs can tell what is already cached
+        metadata['history_month'] = month['month']
+        metadata['history_etag'] = month['etag']
+    return metadata
+
+
+def _read_history_cache(s3, bucket, dataset):
+    try:
+        return _with_retries(app.config.get('HISTORY_CACHE_RETRIES'), s3.get_s3_json,
+                             '{}history/history_cache.json'.format(dataset), bucket)
+    except Exception as e:
+        app.logger.error('Could not read the history cache for {}, rebuilding it: {}'.format(dataset, str(e)))
+
+
+def _index_history_cache(history_cache):
+    # Caches written before entries were tagged with their month cannot be diffed, so are rebuilt in full
+    if not isinstance(history_cache, list) or \
+            not all(isinstance(entry, dict) and 'history_month' in entry for entry in history_cache):
+        return {}
+    return {entry['history_month']: entry for entry in history_cache}
+
+
+def _inventory_history(session, bucket):
+    """List the whole bucket once and group its history/<month>/metadata.json objects by dataset.
+
+    Returns a dict of dataset prefix (e.g. 'ccod/') to that dataset's months in key order. Every top level folder is
+    included, even one with no history.
+    """
+    inventory = {}
+    for page in session.get_paginator('list_objects_v2').paginate(Bucket=bucket):
+        for obj in page.get('Contents', []):
+            parts = obj['Key'].split('/')
+            if len(parts) < 2:
+                continue
+            months = inventory.setdefault(parts[0] + '/', [])
+            if len(parts) == 4 and parts[1] == 'history' and parts[3] == 'metadata.json':
+                months.append({'month': parts[2], 'etag': obj['ETag'], 'size': obj['Size']})
+    return inventory
+
+
+def _write_history_cache(s3, bucket, dataset, historical_metadata):
+    app.logger.info('Writing {} months of history for {} to S3'.format(len(historical_metadata), dataset))
+    try:
+        s3.write_to_s3('{}history/history_cache.json'.format(dataset), json.dumps(historical_metadata), bucket)
+        # Also store the history exactly as GET /<name>/history returns it, so reads need no processing
+        s3.write_to_s3('{}history/dataset_history.json'.format(dataset),
+                       json.dumps(_render_history(historical_metadata)), bucket)
+        metadata_cache.invalidate(bucket, '{}history/dataset_history.json'.format(dataset))
+        return True
+    except Exception as e:
+        app.logger.error('Failed to write the history cache for {}: {}'.format(dataset, str(e)))
+        return False
+
+
+def _with_retries(attempts, func, *args, **kwargs):
+    # Retry transient failures with exponential backoff and full jitter, so parallel workers do not retry in step
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not _is_transient(e):
+                raise e
+            delay = random.uniform(0, 0.2 * 2 ** attempt)
+            app.logger.info('Attempt {} failed with error {}, retrying in {:.2f}s'.format(attempt + 1, e, delay))
+            time.sleep(delay)
+
+
+def _is_transient(error):
+    # Failing to reach S3, or S3 throttling or failing, may not happen again. Any other error, such as AccessDenied,
+    # would fail the same way on every attempt
+    if isinstance(error, (S3ConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in RETRYABLE_S3_ERRORS or status >= 500
+    return False
+
+
+def _timed(func, *args):
+    started = time.monotonic()
+    result = func(*args)
+    return result, time.monotonic() - started
+
+
+def _evict_metadata(name):
+    # The dataset may have changed bucket, so its metadata.json is dropped from both
+    if name is None:
+        metadata_cache.invalidate()
+        return
+    s3 = S3()
+    for private in (False, True):
+        metadata_cache.invalidate(s3.get_bucket(private), name + '/metadata.json')
+
+
+subscribe('dataset', _evict_metadata)
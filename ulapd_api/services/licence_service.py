@@ -1,6 +1,8 @@
 from ulapd_api.extensions import db
 from ulapd_api.models.licence import Licence
 from ulapd_api.utilities.decorators import handle_errors
+from ulapd_api.utilities.invalidation import notify
+from ulapd_api.utilities.reference_data import reload_reference_data
 
 
 @handle_errors(is_get=False)
@@ -12,5 +14,7 @@ def create_licence(data):
 
     new_licence = Licence(data)
     db.session.add(new_licence)
+    notify(db.session, 'licence', data['licence_id'])
     db.session.commit()
+    reload_reference_data()
     return new_licence.as_dict()
@@ -5,55 +5,62 @@ from ulapd_api.app import app
 from ulapd_api.exceptions import ApplicationError
 from ulapd_api.extensions import db
 from ulapd_api.models.user_details import UserDetails
-from ulapd_api.models.user_type import UserType
-from ulapd_api.models.licence import Licence
 from ulapd_api.models.user_terms_link import UserTermsLink
-from ulapd_api.models.dataset import Dataset
 from ulapd_api.models.activity import Activity
 from ulapd_api.models.contact import Contact
 from ulapd_api.utilities.decorators import handle_errors
+from ulapd_api.utilities.invalidation import notify
+from ulapd_api.utilities.reference_data import get_reference_data
 from ulapd_api.dependencies.account_api import AccountAPI, update_groups_for_ldap
 from ulapd_api.dependencies.verification_api import VerificationAPI
 
+# Columns a single user can be looked up by
+USER_KEYS = ('user_details_id', 'email', 'api_key', 'ldap_id')
+
 
 @handle_errors(is_get=True)
-def get_all_users():
-    users = _extract_rows(UserDetails.get_user_details_all())
-    user_list = []
-    for user in users:
-        user_type = get_user_type(user['user_type_id'])
-        user_dict = {
-            'user_details': user,
-            'user_type': user_type
-        }
-        user_list.append(user_dict)
+def get_all_users(after=None, limit=None):
+    """Return users in user_details_id order, optionally only the first limit with an id greater than after."""
+    _check_page(after, limit)
+    return [_user_with_type(user, user_type)
+            for user, user_type in UserDetails.get_all_with_user_type(app.config.get('USER_BATCH_SIZE'), after, limit)]
+
+
+def stream_all_users(after=None, limit=None):
+    """Return an iterator over the users get_all_users would return, read from the cursor as they are needed.
 
-    return user_list
+    The iterator manages the session itself rather than through handle_errors, which would close it before the
+    first row was read, and closes it once it finishes or is closed. A user whose user type does not exist is
+    reported here, as once the response has started streaming an error can no longer be returned.
+    """
+    _check_page(after, limit)
+    missing = UserDetails.get_missing_user_type_id(after, limit)
+    if missing is not None:
+        _user_type_not_found(missing)
+    return _stream_users(after, limit)
 
 
 @handle_errors(is_get=True)
 def get_user_by_key(user_data):
-    if user_data['key'] == 'user_details_id':
-        user = UserDetails.get_user_details_by_id(user_data['value'])
-    elif user_data['key'] == 'email':
-        user = UserDetails.get_user_details_by_email(user_data['value'])
-    elif user_data['key'] == 'api_key':
-        user = UserDetails.get_user_details_by_api_key(user_data['value'])
-    elif user_data['key'] == 'ldap_id':
-        user = UserDetails.get_user_details_by_ldap_id(user_data['value'])
-    else:
+    """Return a user's details, user type, contact preferences and datasets.
+
+    Two queries are made however many licences the user holds: one for the user and their contact preferences, and
+    one for their licence agreements. Licences, datasets and user types come from the reference data snapshot.
+    """
+    if user_data['key'] not in USER_KEYS:
         raise ApplicationError('Incorrect key: {}'.format(user_data['key']), 'E101', http_code=404)
 
-    if user:
-        user_details = user.as_dict()
-        user_type = get_user_type(user_details['user_type_id'])
-        user_details['user_type'] = user_type
+    rows = UserDetails.get_user_with_contacts(user_data['key'], user_data['value'])
+    if rows:
+        user_details = rows[0][0].as_dict()
+        user_details['user_type'] = _get_user_type(user_details['user_type_id'])
         contact_preferences = _build_contact_preferences(
-            _extract_rows(Contact.get_contact_preferences_for_user(user_details['user_details_id'])))
+            _extract_rows(contact for _, contact in rows if contact is not None))
         user_details['contact_preferences'] = contact_preferences
+        user_licences = _extract_rows(UserTermsLink.get_user_terms_by_user_id(user_details['user_details_id']))
         user_dict = {
             'user_details': user_details,
-            'datasets': _build_users_datasets(user_details['user_details_id'])
+            'datasets': _build_users_datasets(user_licences)
         }
         return user_dict
     else:
@@ -74,14 +81,7 @@ def get_user_details(user_id):
 
 @handle_errors(is_get=True)
 def get_user_type(type_id):
-    user_type = UserType.get_user_type_by_id(type_id)
-    if user_type:
-        result = user_type.as_dict()
-    else:
-        app.logger.error("User type '{}' not found".format(type_id))
-        raise ApplicationError(*errors.get('ulapd_api', 'USER_TYPE_NOT_FOUND', filler=type_id), http_code=404)
-
-    return result
+    return _get_user_type(type_id)
 
 
 @handle_errors(is_get=True)
@@ -116,7 +116,7 @@ def manage_licence_agreement(data):
 
         # check to see if user already has this type of licence
         ldap_update_needed = True
-        licence_data = _extract_rows(Licence.get_licences_by_dataset_name(data['licence_id']))
+        licence_data = get_reference_data().licences_by_dataset.get(data['licence_id'], ())
         for rows in licence_data:
             user_licence = UserTermsLink.get_user_terms_by_licence_name(user.user_details_id, rows['licence_id'])
             if user_licence:
@@ -135,6 +135,7 @@ def manage_licence_agreement(data):
                                                                                          stored_licence_id))
             _handle_ldap_group(stored_licence_id, user.ldap_id, True)
 
+        notify(db.session, 'user', user.user_details_id)
         db.session.commit()
         data['link_id'] = licence.user_terms_link_id
         return data
@@ -158,10 +159,8 @@ def manage_multi_licence_agreement(data):
         current_licences = _extract_rows(UserTermsLink.get_user_terms_by_user_id(data['user_details_id']))
         current_list = [d['licence_id'] for d in current_licences]
 
-        all_licences = Licence.get_all_licences()
-        licence_dict = {}
-        for rows in all_licences:
-            licence_dict[rows.licence_name] = rows.dataset_name
+        licence_dict = {name: licence['dataset_name']
+                        for name, licence in get_reference_data().licence_by_name.items()}
 
         groups = {}
         for row in data['licences']:
@@ -191,6 +190,7 @@ def manage_multi_licence_agreement(data):
         else:
             app.logger.info('No groups to update in ldap for user {}'.format(user.user_details_id))
 
+        notify(db.session, 'user', user.user_details_id)
         db.session.commit()
         return groups
     except Exception as e:
@@ -236,6 +236,7 @@ def create_new_user(user_data):
                 }
                 contact_preference = Contact(contact)
                 db.session.add(contact_preference)
+        notify(db.session, 'user', user_data['user_details_id'])
         db.session.commit()
         app.logger.info('Finished adding user {} to the ulapd database...'.format(user_data['email']))
 
@@ -278,6 +279,7 @@ def delete_user(user_id):
             db.session.rollback()
             db.session.close()
             raise ApplicationError(*errors.get('ulapd_api', 'USER_NOT_FOUND', filler=user_id), http_code=404)
+        notify(db.session, 'user', user_id)
         db.session.commit()
         return {'user_id': user_id, 'message': 'user deleted'}
     except Exception as e:
@@ -302,6 +304,7 @@ def update_contact_preference(user_data):
             db.session.add(contact_preference)
 
         user.contactable = user_data['contactable']
+        notify(db.session, 'user', user_data['user_id'])
         db.session.commit()
         user_details = user.as_dict()
         user_details['contact_preferences'] = user_data['contact_preferences']
@@ -316,6 +319,7 @@ def update_api_key(user_id):
         user = UserDetails.get_user_details_by_id(user_id)
         if user:
             user.api_key = _create_api_key()
+            notify(db.session, 'user', user_id)
             db.session.commit()
             return get_user_details(user_id)
         else:
@@ -329,22 +333,24 @@ def update_api_key(user_id):
 def get_users_dataset_access(user_id):
     user = UserDetails.get_user_details_by_id(user_id)
     if user:
-        datasets = Dataset.get_all()
+        reference_data = get_reference_data()
+        agreements = _get_licence_agreements(user_id)
+        datasets = [row for row in reference_data.datasets if not row['external']]
         dataset_access = []
 
         for row in datasets:
-            if row.type != 'open':
+            if row['type'] != 'open':
                 dataset_dict = {
-                    'id': row.dataset_id,
-                    'name': row.name,
-                    'title': row.title,
-                    'type': row.type
+                    'id': row['dataset_id'],
+                    'name': row['name'],
+                    'title': row['title'],
+                    'type': row['type']
                 }
-                licence_names = _extract_rows(Licence.get_licences_by_dataset_name(row.name))
+                licence_names = reference_data.licences_by_dataset.get(row['name'], ())
 
                 licence_dict = {}
                 for licence_rows in licence_names:
-                    licence = get_licence_agreement(user_id, licence_rows['licence_id'])
+                    licence = _licence_agreement(agreements, licence_rows['licence_id'])
                     licence_dict[licence_rows['licence_id']] = {
                         'title': licence_rows['title'],
                         'agreed': licence['valid_licence']
@@ -370,11 +376,36 @@ def _extract_rows(rows):
     return [row.as_dict() for row in rows]
 
 
+def _check_page(after, limit):
+    if after is not None and after < 0:
+        raise ApplicationError('after must be a user_details_id', 'E102', http_code=400)
+    page_limit = app.config.get('USER_PAGE_LIMIT')
+    if limit is not None and not 0 < limit <= page_limit:
+        raise ApplicationError('limit must be between 1 and {}'.format(page_limit), 'E102', http_code=400)
+
+
+def _stream_users(after, limit):
+    try:
+        for user, user_type in UserDetails.get_all_with_user_type(app.config.get('USER_BATCH_SIZE'), after, limit):
+            yield _user_with_type(user, user_type)
+    finally:
+        db.session.close()
+
+
+def _user_with_type(user, user_type):
+    if user_type is None:
+        _user_type_not_found(user.user_type_id)
+    return {
+        'user_details': user.as_dict(),
+        'user_type': user_type.as_dict()
+    }
+
+
 def _check_agreement(licence_name, date_agreed):
     converted_date = date_agreed.date()
     agreed = False
-    licence = Licence.get_licence_by_licence_name(licence_name)
-    if licence and licence.last_updated <= converted_date:
+    licence = get_reference_data().licence_by_name.get(licence_name)
+    if licence and licence['last_updated'] <= converted_date:
         agreed = True
     return agreed
 
@@ -394,32 +425,47 @@ def _process_new_user_data(user_data):
 
 
 def _get_user_type_id(user_type):
-    user_type_data = UserType.get_user_id_by_type(user_type)
-    user_type_dict = user_type_data.as_dict()
-    return user_type_dict['user_type_id']
+    return get_reference_data().user_type_by_name[user_type]['user_type_id']
 
 
 def _create_api_key():
     return str(uuid.uuid4())
 
 
-def _build_users_datasets(user_id):
-    user_licences = _extract_rows(UserTermsLink.get_user_terms_by_user_id(user_id))
+def _get_user_type(type_id):
+    user_type = get_reference_data().user_type_by_id.get(type_id)
+    if user_type:
+        result = dict(user_type)
+    else:
+        _user_type_not_found(type_id)
+
+    return result
+
+
+def _user_type_not_found(type_id):
+    app.logger.error("User type '{}' not found".format(type_id))
+    raise ApplicationError(*errors.get('ulapd_api', 'USER_TYPE_NOT_FOUND', filler=type_id), http_code=404)
+
+
+def _build_users_datasets(user_licences):
+    reference_data = get_reference_data()
+    latest_agreements = _latest_agreements(user_licences)
     dataset_access = {}
     for rows in user_licences:
-        licence = get_licence_agreement(user_id, rows['licence_id'])
+        date_agreed = latest_agreements[rows['licence_id']]
+        licence = {'date_agreed': date_agreed, 'valid_licence': _check_agreement(rows['licence_id'], date_agreed)}
         if licence['valid_licence']:
-            licence_data = Licence.get_licence_by_licence_name(rows['licence_id'])
-            dataset_data = Dataset.get_dataset_by_name(licence_data.dataset_name)
-            if dataset_data.name in dataset_access:
-                dataset_access[dataset_data.name]['licences'].append(licence_data.title)
-                dataset_access[dataset_data.name]['date_agreed'] = None
+            licence_data = reference_data.licence_by_name[rows['licence_id']]
+            dataset_data = reference_data.dataset_by_name[licence_data['dataset_name']]
+            if dataset_data['name'] in dataset_access:
+                dataset_access[dataset_data['name']]['licences'].append(licence_data['title'])
+                dataset_access[dataset_data['name']]['date_agreed'] = None
             else:
-                dataset_access[dataset_data.name] = {'date_agreed': str(licence['date_agreed']),
-                                                     'private': dataset_data.private,
-                                                     'valid_licence': licence['valid_licence'],
-                                                     'licence_type': dataset_data.type,
-                                                     'licences': [licence_data.title]}
+                dataset_access[dataset_data['name']] = {'date_agreed': str(licence['date_agreed']),
+                                                        'private': dataset_data['private'],
+                                                        'valid_licence': licence['valid_licence'],
+                                                        'licence_type': dataset_data['type'],
+                                                        'licences': [licence_data['title']]}
 
     # Need to sort freemium licences into their correct order
     for key, value in dataset_access.items():
@@ -428,6 +474,26 @@ def _build_users_datasets(user_id):
     return dataset_access
 
 
+def _get_licence_agreements(user_id):
+    # get_licence_agreement's result for every licence the user has agreed to, from a single query
+    return {agreement.licence_name: {'valid_licence': _check_agreement(agreement.licence_name, agreement.date_agreed),
+                                     'date_agreed': agreement.date_agreed}
+            for agreement in UserTermsLink.get_latest_user_terms_by_user_id(user_id)}
+
+
+def _licence_agreement(agreements, licence_name):
+    return agreements.get(licence_name, {'valid_licence': False, 'date_agreed': None})
+
+
+def _latest_agreements(user_licences):
+    # The date each licence was last agreed to, which is the agreement get_licence_agreement would find
+    latest = {}
+    for row in user_licences:
+        if row['licence_id'] not in latest or row['date_agreed'] > latest[row['licence_id']]:
+            latest[row['licence_id']] = row['date_agreed']
+    return latest
+
+
 def _delete_user_data(account, data):
     account.delete(data['ldap_id'])
     delete_user(data['user_details_id'])
@@ -435,28 +501,31 @@ def _delete_user_data(account, data):
 
 
 def _build_user_dataset_activity(user_id):
-    dataset = Dataset.get_all()
+    reference_data = get_reference_data()
+    downloads = _get_user_downloads(user_id)
+    agreements = _get_licence_agreements(user_id)
+    dataset = [row for row in reference_data.datasets if not row['external']]
     dataset_activity = []
     for row in dataset:
         dataset_dict = {
-            'id': row.dataset_id,
-            'name': row.name,
-            'private': row.private,
-            'title': row.title,
+            'id': row['dataset_id'],
+            'name': row['name'],
+            'private': row['private'],
+            'title': row['title'],
             'licence_agreed': False,
-            'download_history': _get_dataset_downloads(user_id, row.name)
+            'download_history': downloads.get(row['name'], [])
         }
 
-        licence_names = _extract_rows(Licence.get_licences_by_dataset_name(row.name))
+        licence_names = reference_data.licences_by_dataset.get(row['name'], ())
 
         if len(licence_names) > 1:
             for licence in licence_names:
-                this_licence = get_licence_agreement(user_id, licence['licence_id'])
+                this_licence = _licence_agreement(agreements, licence['licence_id'])
                 if this_licence['valid_licence']:
                     dataset_dict['licence_agreed'] = True
                     break
         else:
-            licence = get_licence_agreement(user_id, row.licence_name)
+            licence = _licence_agreement(agreements, row['licence_id'])
             if licence['valid_licence']:
                 dataset_dict['licence_agreed'] = True
                 converted_date = datetime.strftime(licence['date_agreed'], '%Y-%m-%dT%H:%M:%S.%f')
@@ -465,17 +534,16 @@ def _build_user_dataset_activity(user_id):
     return dataset_activity
 
 
-def _get_dataset_downloads(user_id, name):
-    activities = Activity.get_user_activity_by_dataset(user_id, name)
-    downloads = []
-    for download in activities:
-        if download.activity_type == 'download':
-            converted_date = datetime.strftime(download.timestamp, '%Y-%m-%dT%H:%M:%S.%f')
-            download_dict = {
-                'date': str(converted_date),
-                'file': download.file
-            }
-            downloads.append(download_dict)
+def _get_user_downloads(user_id):
+    # The user's downloads of every dataset from one query, grouped by dataset name
+    downloads = {}
+    for download in Activity.get_user_downloads(user_id):
+        converted_date = datetime.strftime(download.timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+        download_dict = {
+            'date': str(converted_date),
+            'file': download.file
+        }
+        downloads.setdefault(download.dataset_name, []).append(download_dict)
 
     return downloads
 
@@ -486,14 +554,14 @@ def _build_contact_preferences(contact_preferences):
 
 def _sort_out_sample(dataset_access):
     # for showing dataset access add sample licence info to parent and remove from the list
+    datasets_by_name = {d['name']: d for d in dataset_access}
     for rows in dataset_access:
         if rows['name'][-7:] == '_sample':
             main_dataset = rows['name'][:-7]
-            index = next((index for (index, d) in enumerate(dataset_access) if d["name"] == main_dataset), None)
             sample_licence = rows['licences'][rows['name']]
-            dataset_access[index]['licences'][main_dataset]['title'] = 'Full dataset'
+            datasets_by_name[main_dataset]['licences'][main_dataset]['title'] = 'Full dataset'
             sample_licence['title'] = 'Sample'
-            dataset_access[index]['licences'][rows['name']] = sample_licence
+            datasets_by_name[main_dataset]['licences'][rows['name']] = sample_licence
 
     return [d for d in dataset_access if d['name'][-7:] != '_sample']
 
@@ -526,8 +594,8 @@ def _handle_ldap_group(licence, ldap_id, agreed):
 
 
 def _check_freemium(dataset):
-    details = Dataset.get_dataset_by_name(dataset)
-    return True if details.type == 'freemium' else False
+    details = get_reference_data().dataset_by_name[dataset]
+    return True if details['type'] == 'freemium' else False
 
 
 def _handle_ldap_freemium_updates(freemium_type, freemium_list, groups, current_list):
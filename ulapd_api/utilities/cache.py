@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+from flask import current_app
+
+
+class MetadataCache(object):
+    """Process-level cache of S3 documents keyed by (bucket, key).
+
+    Entries younger than the TTL are served from memory. Older entries are revalidated with the ETag they were
+    fetched with, so an unchanged document costs a conditional request rather than a full download. If revalidation
+    fails, the last good copy keeps being served until it is max_staleness seconds past its TTL. Only one fetch per
+    key is made at a time; callers that need the same document meanwhile wait for it and share its outcome.
+
+    With refresh_interval set, a background thread renews entries that have been read since they were last fetched
+    before they expire, so requests rarely wait on S3. It runs inside context(), which must return a context manager.
+
+    Cached documents are shared between requests and must not be mutated by callers.
+    """
+
+    def __init__(self, ttl, max_staleness=0, refresh_interval=0, context=None):
+        self.ttl = ttl
+        self.max_staleness = max_staleness
+        self.refresh_interval = refresh_interval
+        self._context = context
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._refresher_pid = None
+        self._stats = {'hits': 0, 'misses': 0, 'revalidations': 0, 'modified': 0, 'coalesced': 0, 'stale': 0,
+                       'refreshes': 0, 'refresh_failures': 0}
+
+    def get(self, bucket, key, fetch):
+        """Return the document for (bucket, key).
+
+        fetch is called with the cached ETag (or None) and must return a (content, etag) tuple, with content set to
+        None when S3 reports the document as not modified.
+        """
+        return self.get_with_age(bucket, key, fetch)[0]
+
+    def get_with_age(self, bucket, key, fetch):
+        """Return the document for (bucket, key) as get does, with the seconds since it was last confirmed current."""
+        self._start_refresher()
+        cache_key = (bucket, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry:
+                entry['read'] = True
+                age = time.monotonic() - entry['fetched']
+                if age < self.ttl:
+                    self._stats['hits'] += 1
+                    return entry['content'], age
+
+        if entry is None:
+            return self._single_flight(cache_key, lambda: self._fetch(cache_key, fetch)), 0
+
+        try:
+            return self._single_flight(cache_key, lambda: self._revalidate(cache_key, entry, fetch, read=True)), 0
+        except Exception:
+            if age >= self.ttl + self.max_staleness:
+                raise
+            self._count('stale')
+            return entry['content'], age
+
+    def peek_etag(self, bucket, key):
+        """Return the ETag of a cached document that is still within its TTL, or None, without fetching anything."""
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+            if entry and time.monotonic() - entry['fetched'] < self.ttl:
+                return entry['etag']
+        return None
+
+    def refresh(self):
+        """Revalidate the entries read since they were last fetched that would expire before the next sweep."""
+        now = time.monotonic()
+        with self._lock:
+            due = [(cache_key, entry) for cache_key, entry in self._entries.items()
+                   if entry['read'] and now - entry['fetched'] >= self.ttl - self.refresh_interval]
+
+        for cache_key, entry in due:
+            try:
+                self._single_flight(cache_key, lambda: self._revalidate(cache_key, entry, entry['fetch'], read=False))
+                self._count('refreshes')
+            except Exception as e:
+                self._count('refresh_failures')
+                current_app.logger.error('Failed to refresh {}/{}: {}'.format(cache_key[0], cache_key[1], str(e)))
+
+    def invalidate(self, bucket=None, key=None):
+        with self._lock:
+            if bucket is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((bucket, key), None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        stats['ttl'] = self.ttl
+        stats['max_staleness'] = self.max_staleness
+        return stats
+
+    def _single_flight(self, cache_key, func):
+        # Run func unless a call for the same key is already in flight, in which case wait for that one instead
+        with self._lock:
+            flight = self._flights.get(cache_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[cache_key] = _Flight()
+            else:
+                self._stats['coalesced'] += 1
+
+        if leader:
+            try:
+                flight.result = func()
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._flights[cache_key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _fetch(self, cache_key, fetch):
+        content, etag = fetch(None)
+        self._count('misses')
+        self._store(cache_key, content, etag, fetch, read=True)
+        return content
+
+    def _revalidate(self, cache_key, entry, fetch, read):
+        content, etag = fetch(entry['etag'])
+        self._count('revalidations')
+        if content is None:
+            content, etag = entry['content'], entry['etag']
+        else:
+            self._count('modified')
+        self._store(cache_key, content, etag, fetch, read)
+        return content
+
+    def _store(self, cache_key, content, etag, fetch, read):
+        with self._lock:
+            self._entries[cache_key] = {'content': content, 'etag': etag, 'fetch': fetch, 'read': read,
+                                        'fetched': time.monotonic()}
+
+    def _start_refresher(self):
+        # Threads do not survive a fork, so each worker process starts its own on first use
+        if not self.refresh_interval or self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid != os.getpid():
+                self._refresher_pid = os.getpid()
+                threading.Thread(target=self._refresh_loop, name='metadata-cache-refresher', daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            with self._context():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    # Letting this escape would end the thread, and with it refreshing, for the life of the process
+                    current_app.logger.error('Metadata cache refresh failed: {}'.format(str(e)))
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+
+class _Flight(object):
+    """A fetch in progress, whose result or exception is shared with every caller waiting on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PresignedUrlCache(object):
+    """Process-level cache of presigned S3 URLs keyed by (bucket, path).
+
+    A URL is reused while more than reuse_fraction of its expiration is left, so a client is never handed a URL
+    that is about to expire. A URL signed with temporary credentials stops working when they expire, so its
+    expiration is cut short to theirs when that comes first.
+    """
+
+    def __init__(self, expiration, reuse_fraction, max_entries=10000):
+        self.expiration = expiration
+        self.min_remaining = expiration * reuse_fraction
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, bucket, path, sign, valid_for=None):
+        """Return a presigned URL for (bucket, path), calling sign() to create one when none can be reused.
+
+        valid_for, if given, is called after signing and returns the number of seconds the signing credentials
+        remain valid, or None if they do not expire.
+        """
+        cache_key = (bucket, path)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry and self._remaining(entry, now) > self.min_remaining:
+                self._stats['hits'] += 1
+                return entry['url']
+            self._stats['misses'] += 1
+
+        url = sign()
+        lifetime = self.expiration
+        credentials_left = valid_for() if valid_for else None
+        if credentials_left is not None:
+            lifetime = min(lifetime, credentials_left)
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._prune(now)
+            self._entries[cache_key] = {'url': url, 'signed': now, 'lifetime': lifetime}
+        return url
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+    def _remaining(self, entry, now):
+        return entry['lifetime'] - (now - entry['signed'])
+
+    def _prune(self, now):
+        # Drop every URL that can no longer be reused; if that frees nothing, start again from empty
+        self._entries = {key: entry for key, entry in self._entries.items()
+                         if self._remaining(entry, now) > self.min_remaining}
+        if len(self._entries) >= self.max_entries:
+            self._entries = {}
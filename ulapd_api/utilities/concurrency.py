@@ -0,0 +1,37 @@
+from concurrent import futures
+from flask import g, has_app_context
+from ulapd_api.app import app
+
+
+def map_concurrently(func, items, max_workers, timeout=None):
+    """Apply func to every item on a bounded thread pool and return the results in input order.
+
+    Each call runs inside an application context carrying the caller's trace id, so it can log and read config.
+    If any call raises, the first exception (in input order) is re-raised. If the calls have not all finished within
+    timeout seconds, concurrent.futures.TimeoutError is raised and any calls that have not started are cancelled.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    trace_id = g.get('trace_id') if has_app_context() else None
+    executor = futures.ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    try:
+        pending = [executor.submit(_run_in_app_context, func, item, trace_id) for item in items]
+        _, not_done = futures.wait(pending, timeout=timeout)
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            raise futures.TimeoutError('{} of {} calls did not finish within {} seconds'.format(
+                len(not_done), len(items), timeout))
+        return [future.result() for future in pending]
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _run_in_app_context(func, item, trace_id):
+    with app.app_context():
+        if trace_id is not None:
+            # g is not shared with the calling thread, so copy the request's trace id for the call's log lines
+            g.trace_id = trace_id
+        return func(item)
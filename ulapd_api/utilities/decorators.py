@@ -1,12 +1,26 @@
+import threading
+from flask import has_request_context
 from ulapd_api.exceptions import ApplicationError
 from ulapd_api.extensions import db
 from sqlalchemy.exc import SQLAlchemyError
 from common_utilities import errors
 
+# How many decorated calls deep the current thread is, so that only the outermost one closes the session
+_calls = threading.local()
+
 
 def handle_errors(is_get):
+    """Turn database errors into ApplicationErrors and clean up the session once the call is finished.
+
+    Writes are always rolled back afterwards, which does nothing once they have committed. Closing the session is
+    left to whoever owns it: during a request that is the app context teardown, so every service call in the request
+    shares one session and connection; otherwise it is the outermost decorated call, so calls nested inside it share
+    its session.
+    """
     def wrapper(func):
         def run_and_handle(*args, **kwargs):
+            depth = getattr(_calls, 'depth', 0)
+            _calls.depth = depth + 1
             try:
                 return func(*args, **kwargs)
             except SQLAlchemyError as e:
@@ -15,8 +29,10 @@ def handle_errors(is_get):
             except ApplicationError as error:
                 raise error
             finally:
+                _calls.depth = depth
                 if not is_get:
                     db.session.rollback()
-                db.session.close()
+                if depth == 0 and not has_request_context():
+                    db.session.close()
         return run_and_handle
     return wrapper
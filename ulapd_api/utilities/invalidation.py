@@ -0,0 +1,107 @@
+import json
+import os
+import select
+import socket
+import threading
+import time
+from sqlalchemy import text
+from ulapd_api.app import app
+from ulapd_api.extensions import db
+
+CHANNEL = 'ulapd_api_invalidation'
+# Seconds the listener waits for a notification before checking its connection is still alive
+KEEPALIVE_INTERVAL = 30
+# Seconds the listener waits before reconnecting after its connection fails
+RECONNECT_DELAY = 5
+
+_handlers = {}
+_lock = threading.Lock()
+_listener_pid = None
+
+
+def subscribe(kind, handler):
+    """Call handler(key) whenever another process reports a write of the given kind.
+
+    key is None when the listener may have missed notifications, in which case everything of that kind should be
+    dropped. Handlers run on the listener thread and must be thread-safe.
+    """
+    _handlers.setdefault(kind, []).append(handler)
+
+
+def notify(session, kind, key=None):
+    """Tell every other process that the row identified by (kind, key) has been written.
+
+    The notification is part of the session's transaction, so it is only delivered if that commits. The process
+    making the write is expected to update its own caches itself, and ignores its own notifications.
+    """
+    payload = json.dumps({'kind': kind, 'key': key, 'origin': _origin()})
+    session.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': CHANNEL, 'payload': payload})
+
+
+def start_listener():
+    """Start this process's listener thread, if it has not been started yet."""
+    # Threads do not survive a fork, so each worker process starts its own
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _lock:
+        if _listener_pid != os.getpid():
+            _listener_pid = os.getpid()
+            threading.Thread(target=_listen_loop, name='cache-invalidation-listener', daemon=True).start()
+
+
+def _listen_loop():
+    with app.app_context():
+        while True:
+            try:
+                _listen()
+            except Exception as e:
+                app.logger.error('Cache invalidation listener failed, reconnecting: {}'.format(str(e)))
+            time.sleep(RECONNECT_DELAY)
+
+
+def _listen():
+    # A connection held for the life of the process, so it is detached from the pool rather than checked out of it
+    connection = db.engine.raw_connection()
+    connection.detach()
+    try:
+        connection.connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute('LISTEN {}'.format(CHANNEL))
+        # Anything written while this process was not listening has been missed
+        _dispatch_all()
+        app.logger.info('Listening for cache invalidations on {}'.format(CHANNEL))
+        while True:
+            if not select.select([connection.connection], [], [], KEEPALIVE_INTERVAL)[0]:
+                cursor.execute('SELECT 1')
+                continue
+            connection.connection.poll()
+            while connection.connection.notifies:
+                _handle(connection.connection.notifies.pop(0).payload)
+    finally:
+        connection.close()
+
+
+def _handle(payload):
+    message = json.loads(payload)
+    if message['origin'] == _origin():
+        return
+    for handler in _handlers.get(message['kind'], []):
+        _dispatch(handler, message['kind'], message['key'])
+
+
+def _dispatch_all():
+    for kind, handlers in _handlers.items():
+        for handler in handlers:
+            _dispatch(handler, kind, None)
+
+
+def _dispatch(handler, kind, key):
+    try:
+        handler(key)
+    except Exception as e:
+        app.logger.error('Failed to invalidate {} {}: {}'.format(kind, key, str(e)))
+
+
+def _origin():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
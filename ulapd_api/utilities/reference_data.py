@@ -0,0 +1,100 @@
+import itertools
+import threading
+import time
+from types import MappingProxyType
+from ulapd_api.app import app
+from ulapd_api.models.dataset import Dataset
+from ulapd_api.models.licence import Licence
+from ulapd_api.models.user_type import UserType
+from ulapd_api.utilities import invalidation
+
+_versions = itertools.count(1)
+_reload_lock = threading.Lock()
+_snapshot = None
+# Bumped when another process reports a write; a snapshot loaded under an earlier generation is out of date
+_generation = 0
+_snapshot_generation = 0
+
+
+class ReferenceData(object):
+    """Immutable snapshot of the licence, dataset and user type tables.
+
+    Rows are held as read-only dicts in the shape of each model's as_dict, and every lookup is a dict access.
+    datasets holds every dataset, external ones included, in table order.
+    """
+
+    def __init__(self, licences, datasets, user_types, version=0):
+        self.version = version
+        self.loaded = time.monotonic()
+
+        licences = tuple(MappingProxyType(licence) for licence in licences)
+        self.licence_by_name = MappingProxyType({licence['licence_id']: licence for licence in licences})
+        licences_by_dataset = {}
+        for licence in licences:
+            licences_by_dataset.setdefault(licence['dataset_name'], []).append(licence)
+        self.licences_by_dataset = MappingProxyType({name: tuple(rows) for name, rows in licences_by_dataset.items()})
+
+        self.datasets = tuple(MappingProxyType(dataset) for dataset in datasets)
+        self.dataset_by_name = MappingProxyType({dataset['name']: dataset for dataset in self.datasets})
+
+        user_types = tuple(MappingProxyType(user_type) for user_type in user_types)
+        self.user_type_by_id = MappingProxyType({user_type['user_type_id']: user_type for user_type in user_types})
+        self.user_type_by_name = MappingProxyType({user_type['user_type']: user_type for user_type in user_types})
+
+    @staticmethod
+    def load():
+        return ReferenceData([row.as_dict() for row in Licence.get_all_licences()],
+                             [row.as_dict() for row in Dataset.get_all_datasets()],
+                             [row.as_dict() for row in UserType.get_all_user_types()],
+                             next(_versions))
+
+
+def get_reference_data():
+    """Return the current snapshot, reloading it once it is older than REFERENCE_DATA_TTL.
+
+    Writes made through this process replace the snapshot straight away, and writes reported by other processes
+    expire it. The TTL bounds how long a write takes to show should a notification be lost. While one caller reloads,
+    the others carry on with the previous snapshot, which is also kept if the reload fails.
+    """
+    snapshot = _snapshot
+    if snapshot is not None and _snapshot_generation == _generation and \
+            time.monotonic() - snapshot.loaded < app.config.get('REFERENCE_DATA_TTL'):
+        return snapshot
+
+    if snapshot is None:
+        with _reload_lock:
+            return _snapshot or _reload()
+
+    if not _reload_lock.acquire(blocking=False):
+        return snapshot
+    try:
+        return _reload()
+    except Exception as e:
+        app.logger.error('Failed to reload reference data, keeping version {}: {}'.format(snapshot.version, str(e)))
+        return snapshot
+    finally:
+        _reload_lock.release()
+
+
+def reload_reference_data():
+    """Replace the snapshot with a fresh copy of the tables, after a write to any of them has been committed."""
+    with _reload_lock:
+        return _reload()
+
+
+def expire_reference_data(key=None):
+    """Have the next caller reload the snapshot, after another process has written to the tables."""
+    global _generation
+    _generation += 1
+
+
+def _reload():
+    global _snapshot, _snapshot_generation
+    generation = _generation
+    snapshot = ReferenceData.load()
+    _snapshot, _snapshot_generation = snapshot, generation
+    return snapshot
+
+
+invalidation.subscribe('licence', expire_reference_data)
+invalidation.subscribe('dataset', expire_reference_data)
@@ -0,0 +1,47 @@
+import time
+from ulapd_api.extensions import db
+from ulapd_api.dependencies.s3 import S3
+from ulapd_api.services import dataset_service
+from ulapd_api.utilities.reference_data import reload_reference_data
+
+
+def warm_up(app):
+    """Open connections and fill caches before the app serves its first request.
+
+    Each step is timed and logged. A step that fails is logged and skipped, as the app can still serve requests
+    without it, only more slowly.
+    """
+    started = time.monotonic()
+    timings = []
+    with app.app_context():
+        for name, step in [('database connections', _open_db_connections),
+                           ('S3 client', _build_s3_client),
+                           ('reference data', _load_reference_data),
+                           ('dataset metadata', _load_dataset_metadata)]:
+            step_started = time.monotonic()
+            try:
+                step()
+            except Exception as e:
+                app.logger.error('Warm-up of {} failed: {}'.format(name, str(e)))
+            timings.append('{} {:.2f}s'.format(name, time.monotonic() - step_started))
+        db.session.remove()
+        app.logger.info('Warm-up finished in {:.2f}s ({})'.format(time.monotonic() - started, ', '.join(timings)))
+
+
+def _open_db_connections():
+    # Check out a full pool's worth of connections at once so that each one is opened, then return them all
+    connections = [db.engine.connect() for _ in range(db.engine.pool.size())]
+    for connection in connections:
+        connection.close()
+
+
+def _build_s3_client():
+    S3().get_s3_session()
+
+
+def _load_reference_data():
+    reload_reference_data()
+
+
+def _load_dataset_metadata():
+    dataset_service.get_datasets()
@@ -1,16 +1,31 @@
-from flask import Blueprint, jsonify, current_app, request
+from flask import Blueprint, Response, g, jsonify, current_app, request
 from ulapd_api.services import dataset_service
 from ulapd_api.exceptions import ApplicationError
 
 datasets = Blueprint('dataset_bp', __name__)
 
 
+@datasets.after_request
+def add_age_header(response):
+    # Set by the dataset service when metadata is served past its TTL because S3 could not be reached
+    age = g.get('metadata_age')
+    if age is not None:
+        response.headers['Age'] = str(age)
+    return response
+
+
 @datasets.route('', methods=['GET'])
 def get_datasets():
     try:
         external = True if request.args.get('external') else False
         simple = True if request.args.get('simple') else False
-        return jsonify(dataset_service.get_datasets(external, simple))
+        fields = request.args.get('fields')
+        if fields is not None:
+            fields = [field for field in fields.split(',') if field]
+        etag, datasets = dataset_service.get_datasets_with_etag(external, simple, fields, request.if_none_match)
+        if datasets is None:
+            return _not_modified(etag)
+        return _with_etag(jsonify(datasets), etag)
     except ApplicationError as error:
         error_message = 'Failed to get datasets - error: {}'.format(error.message)
         current_app.logger.error(error_message)
@@ -32,7 +47,10 @@ def create_dataset():
 @datasets.route('/<name>', methods=['GET'])
 def get_dataset_by_name(name):
     try:
-        return jsonify(dataset_service.get_dataset_by_name(name))
+        etag, dataset = dataset_service.get_dataset_with_etag(name, request.if_none_match)
+        if dataset is None:
+            return _not_modified(etag)
+        return _with_etag(jsonify(dataset), etag)
     except ApplicationError as error:
         error_message = 'Failed to get dataset: {} - error: {}'.format(name, error.message)
         current_app.logger.error(error_message)
@@ -42,7 +60,7 @@ def get_dataset_by_name(name):
 @datasets.route('/<name>/history', methods=['GET'])
 def get_dataset_history(name):
     try:
-        return jsonify(dataset_service.get_dataset_history(name))
+        return Response(response=dataset_service.get_dataset_history(name), mimetype='application/json')
     except ApplicationError as error:
         error_message = 'Failed to get dataset: {} history - error: {}'.format(name, error.message)
         current_app.logger.error(error_message)
@@ -62,12 +80,48 @@ def get_download_link(name, file, date=None):
         return jsonify(error=error_message), error.http_code
 
 
+@datasets.route('/download/batch', methods=['POST'])
+def get_download_links():
+    try:
+        return jsonify(links=dataset_service.get_download_links(request.get_json()))
+    except ApplicationError as error:
+        error_message = 'Failed to get download links - error: {}'.format(error.message)
+        current_app.logger.error(error_message)
+        return jsonify(error=error_message), error.http_code
+
+
 @datasets.route('/historical_cache', methods=['PUT'])
 def historical_cache():
     try:
-        result = dataset_service.update_historical_cache()
+        full = request.args.get('full') == 'true'
+        result = dataset_service.update_historical_cache(full)
         return jsonify(result)
     except ApplicationError as error:
         error_message = 'Failed to update historical cache:  {} '.format(error.message)
         current_app.logger.error(error_message)
         return jsonify(error=error_message), error.http_code
+
+
+@datasets.route('/metadata_sync', methods=['PUT'])
+def metadata_sync():
+    try:
+        return jsonify(dataset_service.sync_metadata())
+    except ApplicationError as error:
+        error_message = 'Failed to sync dataset metadata: {}'.format(error.message)
+        current_app.logger.error(error_message)
+        return jsonify(error=error_message), error.http_code
+
+
+@datasets.route('/metadata_cache', methods=['GET'])
+def metadata_cache_stats():
+    return jsonify(dataset_service.get_metadata_cache_stats())
+
+
+def _not_modified(etag):
+    return _with_etag(Response(status=304), etag)
+
+
+def _with_etag(response, etag):
+    if etag:
+        response.set_etag(etag)
+    return response
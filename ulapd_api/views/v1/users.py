@@ -1,4 +1,4 @@
-from flask import request, Blueprint, jsonify
+from flask import request, Blueprint, Response, jsonify, json, stream_with_context, url_for
 from ulapd_api.services import user_service as service
 from ulapd_api.app import app
 from ulapd_api.exceptions import ApplicationError
@@ -11,8 +11,19 @@ users_bp = Blueprint('users_bp', __name__)
 def get_users():
     try:
         app.logger.info("Getting details for all users")
-        users = service.get_all_users()
-        return jsonify(users)
+        after = _int_arg('after')
+        limit = _int_arg('limit')
+        if request.args.get('format') == 'ndjson':
+            lines = (json.dumps(user) + '\n' for user in service.stream_all_users(after, limit))
+            return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+        users = service.get_all_users(after, limit)
+        response = jsonify(users)
+        if limit is not None and len(users) == limit:
+            next_page = url_for('users_bp.get_users', after=users[-1]['user_details']['user_details_id'],
+                                limit=limit)
+            response.headers['Link'] = '<{}>; rel="next"'.format(next_page)
+        return response
     except ApplicationError as error:
         error_message = "Failed to get all users - error: {}".format(error.message)
         app.logger.error(error_message)
@@ -146,3 +157,13 @@ def get_users_dataset_access(user_id):
         error_message = "Failed to get data access for user: {} - error: {}".format(user_id, error.message)
         app.logger.error(error_message)
         return jsonify(error=error_message), error.http_code
+
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ApplicationError('{} must be a whole number'.format(name), 'E102', http_code=400)
@@ -0,0 +1,192 @@
+import datetime
+import io
+import boto3
+import botocore.credentials
+import unittest
+from unittest.mock import patch, ANY, MagicMock
+from botocore.exceptions import ClientError
+from ulapd_api.app import app
+from ulapd_api.dependencies import s3
+from ulapd_api.dependencies.s3 import S3
+
+
+class TestDependencyS3(unittest.TestCase):
+
+    def setUp(self):
+        s3._clients.clear()
+
+    def tearDown(self):
+        s3._clients.clear()
+
+    @patch('ulapd_api.dependencies.s3._create_client')
+    def test_get_s3_session_reuses_client(self, mock_create):
+        first = S3().get_s3_session()
+        second = S3().get_s3_session()
+
+        self.assertIs(first, second)
+        mock_create.assert_called_once_with(app.config['S3_BUCKET_REGION'], ANY)
+
+    @patch('ulapd_api.dependencies.s3.os')
+    @patch('ulapd_api.dependencies.s3._create_client')
+    def test_get_s3_session_new_client_after_fork(self, mock_create, mock_os):
+        mock_create.side_effect = ['parent client', 'child client']
+        mock_os.getpid.return_value = 100
+        self.assertEqual(S3().get_s3_session(), 'parent client')
+
+        mock_os.getpid.return_value = 101
+        self.assertEqual(S3().get_s3_session(), 'child client')
+        self.assertEqual(mock_create.call_count, 2)
+
+    def test_create_client_pool_size(self):
+        client = s3._create_client('eu-west-2', boto3.session.Session())
+        self.assertEqual(client.meta.config.max_pool_connections, app.config['S3_MAX_POOL_CONNECTIONS'])
+        self.assertEqual(client.meta.region_name, 'eu-west-2')
+        self.assertEqual(client.meta.config.read_timeout, app.config['DEFAULT_TIMEOUT'])
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_resource_if_modified(self, mock_session):
+        mock_session.return_value.get_object.return_value = {'Body': io.BytesIO(b'{"foo": "bar"}'), 'ETag': '"2"'}
+        before = s3.get_fetch_stats()
+
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            result = S3().get_s3_resource_if_modified('ccod', '/metadata.json', '"1"', True)
+
+        self.assertEqual(result, ({'foo': 'bar'}, '"2"'))
+        mock_session.return_value.get_object.assert_called_once_with(Bucket=app.config['S3_BUCKET_RESTRICTED'],
+                                                                     Key='ccod/metadata.json', IfNoneMatch='"1"')
+        after = s3.get_fetch_stats()
+        self.assertEqual(after['requests'] - before['requests'], 1)
+        self.assertEqual(after['bytes'] - before['bytes'], 14)
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_resource_if_modified_not_modified(self, mock_session):
+        mock_session.return_value.get_object.side_effect = ClientError(
+            {'Error': {'Code': '304', 'Message': 'Not Modified'}, 'ResponseMetadata': {'HTTPStatusCode': 304}},
+            'GetObject')
+        before = s3.get_fetch_stats()
+
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            result = S3().get_s3_resource_if_modified('ccod', '/metadata.json', '"1"')
+
+        self.assertEqual(result, (None, '"1"'))
+        self.assertEqual(s3.get_fetch_stats()['not_modified'] - before['not_modified'], 1)
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_resource_if_modified_error(self, mock_session):
+        mock_session.return_value.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}, 'ResponseMetadata': {'HTTPStatusCode': 404}},
+            'GetObject')
+
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            with self.assertRaises(ClientError):
+                S3().get_s3_resource_if_modified('ccod', '/metadata.json')
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_resource(self, mock_session):
+        mock_session.return_value.get_object.return_value = {'Body': io.BytesIO(b'[1, 2]'), 'ETag': '"1"'}
+
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            result = S3().get_s3_resource('ccod', '/history/history_cache.json')
+
+        self.assertEqual(result, [1, 2])
+        mock_session.return_value.get_object.assert_called_once_with(Bucket=app.config['S3_BUCKET'],
+                                                                     Key='ccod/history/history_cache.json')
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_bytes_if_modified_missing(self, mock_session):
+        mock_session.return_value.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}, 'ResponseMetadata': {'HTTPStatusCode': 404}},
+            'GetObject')
+
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            result = S3().get_s3_bytes_if_modified('ccod', '/history/dataset_history.json', missing_ok=True)
+
+        self.assertEqual(result, (None, None))
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_bytes_if_modified(self, mock_session):
+        mock_session.return_value.get_object.return_value = {'Body': io.BytesIO(b'[1, 2]'), 'ETag': '"1"'}
+
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            result = S3().get_s3_bytes_if_modified('ccod', '/history/dataset_history.json')
+
+        self.assertEqual(result, (b'[1, 2]', '"1"'))
+
+    @patch('ulapd_api.dependencies.s3.S3._get_client')
+    def test_signing_credentials_valid_for(self, mock_client):
+        expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=20)
+        mock_client.return_value = (MagicMock(), _session_with(_temporary_credentials(expiry)))
+
+        self.assertAlmostEqual(S3().signing_credentials_valid_for(), 1200, delta=5)
+
+    @patch('ulapd_api.dependencies.s3.S3._get_client')
+    def test_signing_credentials_valid_for_static(self, mock_client):
+        mock_client.return_value = (MagicMock(), _session_with(botocore.credentials.Credentials('key', 'secret')))
+
+        self.assertIsNone(S3().signing_credentials_valid_for())
+
+    @patch('ulapd_api.dependencies.s3.S3._get_client')
+    def test_signing_credentials_valid_for_no_credentials(self, mock_client):
+        mock_client.return_value = (MagicMock(), _session_with(None))
+
+        self.assertIsNone(S3().signing_credentials_valid_for())
+
+    def test_expiry_time_unreadable(self):
+        credentials = _temporary_credentials(datetime.datetime.now(datetime.timezone.utc))
+        del credentials._expiry_time
+
+        self.assertIsNone(s3._expiry_time(credentials))
+
+    def test_signing_credentials_from_client_session(self):
+        session = _session_with(botocore.credentials.Credentials('key', 'secret'))
+        with patch('ulapd_api.dependencies.s3.boto3.session.Session', return_value=session):
+            S3().signing_credentials_valid_for()
+
+        session.client.assert_called_once()
+        session.get_credentials.assert_called_once_with()
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_json(self, mock_session):
+        mock_session.return_value.get_object.return_value = {'Body': io.BytesIO(b'{"foo": "bar"}')}
+        self.assertEqual(S3().get_s3_json('ccod/history/history_cache.json', 'bucket'), {'foo': 'bar'})
+        mock_session.return_value.get_object.assert_called_once_with(Bucket='bucket',
+                                                                     Key='ccod/history/history_cache.json')
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_json_missing(self, mock_session):
+        mock_session.return_value.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}, 'ResponseMetadata': {'HTTPStatusCode': 404}},
+            'GetObject')
+        self.assertIsNone(S3().get_s3_json('ccod/history/history_cache.json', 'bucket'))
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_get_s3_json_raises_server_errors(self, mock_session):
+        mock_session.return_value.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'},
+             'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+        with self.assertRaises(ClientError):
+            S3().get_s3_json('ccod/history/2019_06/metadata.json', 'bucket')
+
+    @patch('ulapd_api.dependencies.s3.S3.get_s3_session')
+    def test_s3_file_exists(self, mock_session):
+        self.assertTrue(S3().s3_file_exists('ccod/metadata.json', 'bucket'))
+        mock_session.return_value.head_object.side_effect = ClientError(
+            {'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        self.assertFalse(S3().s3_file_exists('ccod/metadata.json', 'bucket'))
+
+
+def _temporary_credentials(expiry):
+    # Credentials as botocore builds them for an assumed role, which it refreshes when they near expiry
+    return botocore.credentials.RefreshableCredentials.create_from_metadata(
+        metadata={'access_key': 'key', 'secret_key': 'secret', 'token': 'token', 'expiry_time': expiry.isoformat()},
+        refresh_using=MagicMock(), method='sts-assume-role')
+
+
+def _session_with(credentials):
+    return MagicMock(**{'get_credentials.return_value': credentials})
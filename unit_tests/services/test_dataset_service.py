@@ -1,10 +1,14 @@
 import os
 import json
 import unittest
+from datetime import datetime, timedelta
+from concurrent import futures
+from botocore.exceptions import ClientError, EndpointConnectionError
 from ulapd_api.app import app
 from unittest.mock import patch, MagicMock
 from common_utilities import errors
 from ulapd_api.exceptions import ApplicationError
+from unit_tests.utilities import helpers
 
 from ulapd_api.services import dataset_service as service
 
@@ -21,14 +25,14 @@ class TestDatasetService(unittest.TestCase):
         self.app = app.test_client()
 
     @patch("ulapd_api.services.dataset_service.Dataset")
-    @patch("ulapd_api.services.dataset_service._metadata_extend")
-    @patch("ulapd_api.services.dataset_service._extract_rows")
-    def test_get_datasets(self, mock_extract, mock_metadata, mock_dataset, *_):
+    @patch("ulapd_api.services.dataset_service._extend_rows")
+    def test_get_datasets(self, mock_extend, mock_dataset, *_):
         extract = [{'foo': 'bar'}, {'foo': 'bar'}]
-        mock_extract.return_value = extract
-        mock_dataset.get_datasets.return_value = MagicMock()
+        mock_extend.return_value = extract
         result = service.get_datasets()
         self.assertEqual(result, extract)
+        mock_extend.assert_called_once_with(mock_dataset.get_all_with_metadata.return_value)
+        mock_dataset.get_all_with_metadata.assert_called_once_with(False)
 
     @patch("ulapd_api.services.dataset_service.Dataset")
     @patch("ulapd_api.services.dataset_service._metadata_extend")
@@ -41,16 +45,16 @@ class TestDatasetService(unittest.TestCase):
         self.assertEqual(result, extract)
 
     @patch("ulapd_api.services.dataset_service.Dataset")
-    @patch("ulapd_api.services.dataset_service._metadata_extend")
-    def test_get_datasets_by_name(self, mock_metadata, mock_dataset, *_):
-        mock_metadata.return_value = {'foo': 'bar'}
-        mock_dataset.get_dataset_by_name.return_value = mock_metadata
+    @patch("ulapd_api.services.dataset_service._extend_rows")
+    def test_get_datasets_by_name(self, mock_extend, mock_dataset, *_):
+        mock_extend.return_value = [{'foo': 'bar'}]
         result = service.get_dataset_by_name('ccod')
         self.assertEqual(result, {'foo': 'bar'})
+        mock_extend.assert_called_once_with([mock_dataset.get_dataset_with_metadata.return_value])
 
     @patch("ulapd_api.services.dataset_service.Dataset")
     def test_get_datasets_by_name_no_row(self, mock_dataset, *_):
-        mock_dataset.get_dataset_by_name.return_value = None
+        mock_dataset.get_dataset_with_metadata.return_value = None
         with self.assertRaises(ApplicationError) as context:
             service.get_dataset_by_name('ccod')
 
@@ -62,12 +66,35 @@ class TestDatasetService(unittest.TestCase):
         self.assertEqual(context.exception.code, expected_err_code)
 
     @patch("ulapd_api.services.dataset_service.Dataset")
+    @patch("ulapd_api.services.dataset_service._get_rendered_history")
+    def test_get_dataset_history(self, mock_rendered, mock_dataset, *_):
+        row = {'name': 'ccod', 'private': True, 'external': False, 'type': 'licenced'}
+        mock_dataset.get_dataset_by_name.return_value.as_dict.return_value = dict(row)
+        mock_rendered.return_value = b'[{"last_updated": "October 2019"}]'
+        result = service.get_dataset_history('ccod')
+        self.assertEqual(json.loads(result.decode('utf-8')),
+                         dict(row, dataset_history=[{'last_updated': 'October 2019'}]))
+        mock_rendered.assert_called_once_with('ccod', True)
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    @patch("ulapd_api.services.dataset_service._get_rendered_history")
     @patch("ulapd_api.services.dataset_service._metadata_extend_history")
-    def test_get_dataset_history(self, mock_metadata, mock_dataset, *_):
+    def test_get_dataset_history_not_rendered(self, mock_metadata, mock_rendered, mock_dataset, *_):
+        row = {'name': 'ccod', 'private': False, 'external': False, 'type': 'open'}
+        mock_dataset.get_dataset_by_name.return_value.as_dict.return_value = row
+        mock_rendered.return_value = None
         mock_metadata.return_value = {'foo': 'bar'}
-        mock_dataset.get_dataset_by_name.return_value = mock_metadata
         result = service.get_dataset_history('ccod')
-        self.assertEqual(result, {'foo': 'bar'})
+        self.assertEqual(json.loads(result.decode('utf-8')), {'foo': 'bar'})
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    @patch("ulapd_api.services.dataset_service._get_rendered_history")
+    def test_get_dataset_history_external(self, mock_rendered, mock_dataset, *_):
+        row = {'name': 'ccod', 'private': False, 'external': True, 'type': 'open'}
+        mock_dataset.get_dataset_by_name.return_value.as_dict.return_value = row
+        result = service.get_dataset_history('ccod')
+        self.assertEqual(json.loads(result.decode('utf-8')), row)
+        mock_rendered.assert_not_called()
 
     @patch("ulapd_api.services.dataset_service.Dataset")
     def test_get_dataset_history_no_row(self, mock_dataset, *_):
@@ -82,63 +109,394 @@ class TestDatasetService(unittest.TestCase):
         self.assertEqual(context.exception.message, expected_err_message)
         self.assertEqual(context.exception.code, expected_err_code)
 
+    @patch("ulapd_api.services.dataset_service.reload_reference_data")
     @patch("ulapd_api.services.dataset_service.db")
     @patch("ulapd_api.services.dataset_service.Dataset")
-    def test_create_dataset(self, mock_dataset, mock_db, *_):
+    def test_create_dataset(self, mock_dataset, mock_db, mock_reload, *_):
         data = {'name': 'ulapd'}
         mock_dataset.get_dataset_by_name.return_value = None
         mock_dataset.return_value = _create_dataset_profile()
         result = service.create_dataset(data)
         self.assertEqual(result, example_dict)
+        mock_reload.assert_called_once_with()
+        self.assertIn('pg_notify', str(mock_db.session.execute.call_args[0][0]))
 
+    @patch("ulapd_api.services.dataset_service.reload_reference_data")
     @patch("ulapd_api.services.dataset_service.db")
     @patch("ulapd_api.services.dataset_service.Dataset")
-    def test_create_dataset_already_exists(self, mock_dataset, mock_db, *_):
+    def test_create_dataset_already_exists(self, mock_dataset, mock_db, mock_reload, *_):
         data = {'name': 'ulapd'}
         mock_dataset.get_dataset_by_name.return_value = MagicMock()
         mock_dataset.return_value = _create_dataset_profile()
         result = service.create_dataset(data)
         self.assertEqual(result, example_dict)
+        mock_reload.assert_called_once_with()
+        self.assertIn('pg_notify', str(mock_db.session.execute.call_args[0][0]))
 
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
     @patch("ulapd_api.services.dataset_service.S3")
-    @patch("ulapd_api.services.dataset_service.get_dataset_by_name")
-    def test_get_download_link(self, mock_get_by_name, mock_s3, *_):
-        mock_get_by_name.return_value.get.return_value = False
+    def test_evict_metadata(self, mock_s3, mock_cache, *_):
+        mock_s3.return_value.get_bucket.side_effect = lambda private: 'restricted' if private else 'public'
+
+        service._evict_metadata('ccod')
+
+        mock_cache.invalidate.assert_any_call('public', 'ccod/metadata.json')
+        mock_cache.invalidate.assert_any_call('restricted', 'ccod/metadata.json')
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    def test_evict_all_metadata(self, mock_cache, *_):
+        service._evict_metadata(None)
+        mock_cache.invalidate.assert_called_once_with()
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service._extend_rows")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_datasets_with_etag(self, mock_dataset, mock_extend, mock_cache, *_):
+        rows = [{'name': 'ccod', 'private': False, 'external': False},
+                {'name': 'nps', 'private': True, 'external': False},
+                {'name': 'inspire', 'private': False, 'external': True}]
+        mock_dataset.get_all_with_metadata.return_value = [_result(row) for row in rows]
+        mock_cache.peek_etag.side_effect = ['"1"', '"2"', '"1"', '"3"']
+
+        etag, datasets = service.get_datasets_with_etag()
+        self.assertRegex(etag, '^[0-9a-f]{64}$')
+        self.assertEqual(datasets, mock_extend.return_value)
+        self.assertEqual(mock_cache.peek_etag.call_count, 2)
+        self.assertNotEqual(service.get_datasets_with_etag()[0], etag)
+        self.assertEqual(mock_dataset.get_all_with_metadata.call_count, 2)
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service._extend_rows")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_datasets_with_etag_not_modified(self, mock_dataset, mock_extend, mock_cache, *_):
+        mock_dataset.get_all_with_metadata.return_value = [
+            _result({'name': 'ccod', 'private': False, 'external': False})]
+        mock_cache.peek_etag.return_value = '"1"'
+        etag = service.get_datasets_with_etag()[0]
+        mock_extend.reset_mock()
+
+        self.assertEqual(service.get_datasets_with_etag(if_none_match=[etag]), (etag, None))
+        mock_extend.assert_not_called()
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service._extend_rows")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_datasets_with_etag_stale_metadata(self, mock_dataset, mock_extend, mock_cache, *_):
+        mock_dataset.get_all_with_metadata.return_value = [
+            _result({'name': 'ccod', 'private': False, 'external': False})]
+        mock_cache.peek_etag.side_effect = [None, '"1"']
+
+        etag, datasets = service.get_datasets_with_etag()
+        self.assertIsNotNone(etag)
+        self.assertEqual(datasets, mock_extend.return_value)
+        mock_dataset.get_all_with_metadata.assert_called_once_with(False)
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_datasets_with_etag_simple(self, mock_dataset, mock_cache, *_):
+        mock_dataset.get_all_with_metadata.return_value = [
+            _result({'name': 'ccod', 'private': False, 'external': False})]
+
+        etag, datasets = service.get_datasets_with_etag(False, True)
+        self.assertIsNotNone(etag)
+        self.assertEqual(datasets, [{'name': 'ccod', 'private': False, 'external': False}])
+        mock_cache.peek_etag.assert_not_called()
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service._extend_rows")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_datasets_with_etag_synced_metadata(self, mock_dataset, mock_extend, mock_cache, *_):
+        row = {'name': 'ccod', 'private': False, 'external': False}
+        mock_dataset.get_all_with_metadata.return_value = [_result(row, _synced('"1"'))]
+
+        etag = service.get_datasets_with_etag()[0]
+        self.assertIsNotNone(etag)
+        mock_cache.peek_etag.assert_not_called()
+
+        mock_dataset.get_all_with_metadata.return_value = [_result(row, _synced('"2"'))]
+        self.assertNotEqual(service.get_datasets_with_etag()[0], etag)
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service._extend_rows")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_dataset_with_etag(self, mock_dataset, mock_extend, mock_cache, *_):
+        mock_dataset.get_dataset_with_metadata.return_value = _result(
+            {'name': 'ccod', 'private': False, 'external': False})
+        mock_extend.return_value = [{'name': 'ccod'}]
+        mock_cache.peek_etag.return_value = '"1"'
+
+        etag, dataset = service.get_dataset_with_etag('ccod')
+        self.assertEqual(dataset, {'name': 'ccod'})
+        self.assertEqual(service.get_dataset_with_etag('ccod', [etag]), (etag, None))
+        mock_extend.assert_called_once_with([mock_dataset.get_dataset_with_metadata.return_value])
+        self.assertEqual(mock_dataset.get_dataset_with_metadata.call_count, 2)
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_dataset_with_etag_no_row(self, mock_dataset, *_):
+        mock_dataset.get_dataset_with_metadata.return_value = None
+        with self.assertRaises(ApplicationError) as context:
+            service.get_dataset_with_etag('ccod')
+
+        self.assertEqual(context.exception.http_code, 404)
+
+    @patch("ulapd_api.services.dataset_service.download_url_cache")
+    @patch("ulapd_api.services.dataset_service.S3")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_download_link(self, mock_dataset, mock_s3, mock_cache, *_):
+        mock_dataset.get_dataset_by_name.return_value.private = False
+        mock_s3.return_value.get_bucket.return_value = 'bucket'
         mock_s3.return_value.build_presigned_url.return_value = 'www.gov.uk/ccod'
+        mock_cache.get.side_effect = lambda bucket, path, sign, valid_for: sign()
         result = service.get_download_link('ccod', 'CCOD_FULL_2019_11.zip', False)
         self.assertEqual(result, 'www.gov.uk/ccod')
+        mock_cache.get.assert_called_once()
+        self.assertEqual(mock_cache.get.call_args[0][:2], ('bucket', 'ccod/CCOD_FULL_2019_11.zip'))
+        mock_s3.return_value.build_presigned_url.assert_called_once_with('ccod/CCOD_FULL_2019_11.zip', False)
 
+    @patch("ulapd_api.services.dataset_service.download_url_cache")
     @patch("ulapd_api.services.dataset_service.S3")
-    @patch("ulapd_api.services.dataset_service.get_dataset_by_name")
-    def test_get_download_link_with_date(self, mock_get_by_name, mock_s3, *_):
-        mock_get_by_name.return_value.get.return_value = False
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_download_link_with_date(self, mock_dataset, mock_s3, mock_cache, *_):
+        mock_dataset.get_dataset_by_name.return_value.private = True
         mock_s3.return_value.build_presigned_url.return_value = 'www.gov.uk/ccod'
+        mock_cache.get.side_effect = lambda bucket, path, sign, valid_for: sign()
         result = service.get_download_link('ccod', 'CCOD_FULL_2019_11.zip', 'August 2019')
         self.assertEqual(result, 'www.gov.uk/ccod')
+        mock_s3.return_value.build_presigned_url.assert_called_once_with(
+            'ccod/history/August 2019/CCOD_FULL_2019_11.zip', True)
+
+    @patch("ulapd_api.services.dataset_service.S3")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_download_link_no_dataset(self, mock_dataset, mock_s3, *_):
+        mock_dataset.get_dataset_by_name.return_value = None
+        with self.assertRaises(ApplicationError) as context:
+            service.get_download_link('ccod', 'CCOD_FULL_2019_11.zip')
+
+        self.assertEqual(context.exception.http_code, 404)
+        mock_s3.return_value.build_presigned_url.assert_not_called()
+
+    @patch("ulapd_api.services.dataset_service.download_url_cache")
+    @patch("ulapd_api.services.dataset_service.S3")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_download_links(self, mock_dataset, mock_s3, mock_cache, *_):
+        ccod, ocod = MagicMock(private=False), MagicMock(private=True)
+        ccod.name, ocod.name = 'ccod', 'ocod'
+        mock_dataset.get_datasets_by_names.return_value = [ccod, ocod]
+        mock_s3.return_value.build_presigned_url.side_effect = lambda path, private: 'https://{}'.format(path)
+        mock_cache.get.side_effect = lambda bucket, path, sign, valid_for: sign()
+        files = [{'name': 'ccod', 'file': 'a.zip'},
+                 {'name': 'ocod', 'file': 'b.zip'},
+                 {'name': 'ccod', 'file': 'c.zip', 'date': 'August 2019'}]
+
+        result = service.get_download_links(files)
+
+        self.assertEqual(result, [
+            {'name': 'ccod', 'file': 'a.zip', 'date': None, 'link': 'https://ccod/a.zip'},
+            {'name': 'ocod', 'file': 'b.zip', 'date': None, 'link': 'https://ocod/b.zip'},
+            {'name': 'ccod', 'file': 'c.zip', 'date': 'August 2019', 'link': 'https://ccod/history/August 2019/c.zip'}
+        ])
+        mock_dataset.get_datasets_by_names.assert_called_once_with({'ccod', 'ocod'})
+        mock_s3.assert_called_once_with()
+        mock_s3.return_value.build_presigned_url.assert_any_call('ocod/b.zip', True)
+
+    @patch("ulapd_api.services.dataset_service.S3")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_download_links_unknown_dataset(self, mock_dataset, mock_s3, *_):
+        mock_dataset.get_datasets_by_names.return_value = []
+        with self.assertRaises(ApplicationError) as context:
+            service.get_download_links([{'name': 'ccod', 'file': 'a.zip'}])
+
+        self.assertEqual(context.exception.http_code, 404)
+        mock_s3.return_value.build_presigned_url.assert_not_called()
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_download_links_invalid(self, mock_dataset, *_):
+        for files in [None, {'name': 'ccod'}, [{'name': 'ccod'}], ['ccod']]:
+            with self.assertRaises(ApplicationError) as context:
+                service.get_download_links(files)
+            self.assertEqual(context.exception.http_code, 400)
+
+        mock_dataset.get_datasets_by_names.assert_not_called()
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_download_links_over_limit(self, mock_dataset, *_):
+        files = [{'name': 'ccod', 'file': '{}.zip'.format(i)} for i in range(3)]
+        with patch.dict(app.config, {'DOWNLOAD_BATCH_LIMIT': 2}):
+            with self.assertRaises(ApplicationError) as context:
+                service.get_download_links(files)
+
+        self.assertEqual(context.exception.code, 'E102')
+        self.assertEqual(context.exception.http_code, 400)
+        mock_dataset.get_datasets_by_names.assert_not_called()
+
+    @patch("ulapd_api.services.dataset_service._render_history", return_value=[])
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_update_historical_cache(self, mock_s3, *_):
+        _mock_history_bucket(mock_s3, ['2019_06'], existing_cache=None)
+        result = service.update_historical_cache()
+        self.assertEqual(result['result'], 'ok')
+        self.assertEqual(sorted(result['datasets']), ['bucket/ccod', 'other_bucket/ccod'])
+        self.assertEqual(result['datasets']['bucket/ccod']['months'], 1)
+        self.assertEqual(result['datasets']['bucket/ccod']['dropped'], [])
+        self.assertTrue(result['datasets']['bucket/ccod']['updated'])
+        mock_s3.return_value.write_to_s3.assert_any_call('ccod/history/history_cache.json',
+                                                         '[{"some": "data", "history_month": "2019_06", '
+                                                         '"history_etag": "\\"2019_06\\""}]',
+                                                         'bucket')
+
+    @patch("ulapd_api.services.dataset_service._render_history", return_value=[])
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_update_historical_cache_incremental(self, mock_s3, *_):
+        existing = [{'some': 'old', 'history_month': '2019_06', 'history_etag': '"2019_06"'}]
+        _mock_history_bucket(mock_s3, ['2019_06', '2019_07'], existing_cache=existing)
+        result = service.update_historical_cache()
+        self.assertEqual(result['datasets']['bucket/ccod']['months'], 2)
+        self.assertEqual(result['datasets']['bucket/ccod']['fetched'], 1)
+        fetched_paths = [c[0][0] for c in mock_s3.return_value.get_s3_json.call_args_list]
+        self.assertNotIn('ccod/history/2019_06/metadata.json', fetched_paths)
+        self.assertIn('ccod/history/2019_07/metadata.json', fetched_paths)
+        written = json.loads(mock_s3.return_value.write_to_s3.call_args_list[0][0][1])
+        self.assertEqual(written, [{'some': 'old', 'history_month': '2019_06', 'history_etag': '"2019_06"'},
+                                   {'some': 'data', 'history_month': '2019_07', 'history_etag': '"2019_07"'}])
 
+    @patch("ulapd_api.services.dataset_service._render_history", return_value=[])
     @patch("ulapd_api.services.dataset_service.S3")
-    @patch("ulapd_api.services.dataset_service._fetch_prefixes")
-    def test_update_historical_cache(self, mock_prefixes, mock_s3, *_):
-        mock_s3.return_value = MagicMock()
-        mock_s3.return_value.BUCKET_NAME.return_value = 'bucket'
-        mock_s3.return_value.BUCKET_RESTRICTED.return_value = 'other_bucket'
-        mock_prefixes.return_value = ['ccod/']
-        mock_s3.return_value.fetch_s3_file.return_value = {'some': 'data'}
-        mock_s3.write_to_s3.return_value = MagicMock()
+    def test_update_historical_cache_changed_etag(self, mock_s3, *_):
+        existing = [{'some': 'old', 'history_month': '2019_06', 'history_etag': '"stale"'}]
+        _mock_history_bucket(mock_s3, ['2019_06'], existing_cache=existing)
         result = service.update_historical_cache()
-        self.assertEqual(result, {'result': 'ok'})
+        self.assertEqual(result['datasets']['bucket/ccod']['fetched'], 1)
+        self.assertTrue(result['datasets']['bucket/ccod']['updated'])
 
     @patch("ulapd_api.services.dataset_service.S3")
-    @patch("ulapd_api.services.dataset_service._fetch_prefixes")
-    def test_update_historical_cache_exception(self, mock_prefixes, mock_s3, *_):
-        mock_s3.return_value = MagicMock()
-        mock_s3.return_value.BUCKET_NAME.return_value = 'bucket'
-        mock_s3.return_value.BUCKET_RESTRICTED.return_value = 'other_bucket'
-        mock_prefixes.return_value = ['ccod/']
-        mock_s3.return_value.fetch_s3_file.side_effect = ApplicationError('Some error', 400)
+    def test_update_historical_cache_unchanged(self, mock_s3, *_):
+        existing = [{'some': 'old', 'history_month': '2019_06', 'history_etag': '"2019_06"'}]
+        _mock_history_bucket(mock_s3, ['2019_06'], existing_cache=existing)
+        mock_s3.return_value.s3_file_exists.return_value = True
+        result = service.update_historical_cache()
+        self.assertEqual(result['result'], 'ok')
+        self.assertEqual(result['datasets']['bucket/ccod']['fetched'], 0)
+        self.assertFalse(result['datasets']['bucket/ccod']['updated'])
+        mock_s3.return_value.write_to_s3.assert_not_called()
+        mock_s3.return_value.s3_file_exists.assert_any_call('ccod/history/dataset_history.json', 'bucket')
+
+    @patch("ulapd_api.services.dataset_service._render_history", return_value=[])
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_update_historical_cache_unchanged_not_rendered(self, mock_s3, *_):
+        existing = [{'some': 'old', 'history_month': '2019_06', 'history_etag': '"2019_06"'}]
+        _mock_history_bucket(mock_s3, ['2019_06'], existing_cache=existing)
+        mock_s3.return_value.s3_file_exists.return_value = False
+        result = service.update_historical_cache()
+        self.assertEqual(result['datasets']['bucket/ccod']['fetched'], 0)
+        self.assertTrue(result['datasets']['bucket/ccod']['updated'])
+
+    @patch("ulapd_api.services.dataset_service._render_history", return_value=[])
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_update_historical_cache_full(self, mock_s3, *_):
+        existing = [{'some': 'old', 'history_month': '2019_06', 'history_etag': '"2019_06"'}]
+        _mock_history_bucket(mock_s3, ['2019_06'], existing_cache=existing)
+        result = service.update_historical_cache(full=True)
+        self.assertEqual(result['datasets']['bucket/ccod']['fetched'], 1)
+        fetched_paths = [c[0][0] for c in mock_s3.return_value.get_s3_json.call_args_list]
+        self.assertNotIn('ccod/history/history_cache.json', fetched_paths)
+
+    @patch("ulapd_api.services.dataset_service.time.sleep")
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_update_historical_cache_exception(self, mock_s3, *_):
+        _mock_history_bucket(mock_s3, ['2019_06'], existing_cache=None)
+        mock_s3.return_value.get_s3_json.side_effect = ApplicationError('Some error', 400)
         mock_s3.return_value.write_to_s3.side_effect = ApplicationError('Some error', 400)
         result = service.update_historical_cache()
-        self.assertEqual(result, {'result': 'Failed to write cache, please check logs'})
+        self.assertEqual(result['result'], 'Failed to write cache, please check logs')
+        self.assertEqual(sorted(result['failed']), ['bucket/ccod', 'other_bucket/ccod'])
+        self.assertEqual(result['datasets']['bucket/ccod']['months'], 0)
+
+    @patch("ulapd_api.services.dataset_service._render_history", return_value=[])
+    @patch("ulapd_api.services.dataset_service.time.sleep")
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_update_historical_cache_dropped_month(self, mock_s3, mock_sleep, *_):
+        _mock_history_bucket(mock_s3, ['2019_06', '2019_07'], existing_cache=None)
+        slow_down = ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'},
+                                 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+
+        def get_s3_json(path, bucket):
+            if '2019_07' in path:
+                raise slow_down
+            return None if path.endswith('history_cache.json') else {'some': 'data'}
+
+        mock_s3.return_value.get_s3_json.side_effect = get_s3_json
+        result = service.update_historical_cache()
+        self.assertEqual(result['result'], 'Some months could not be fetched, please check logs')
+        self.assertEqual(sorted(result['incomplete']), ['bucket/ccod', 'other_bucket/ccod'])
+        self.assertEqual(result['datasets']['bucket/ccod']['months'], 1)
+        self.assertEqual(result['datasets']['bucket/ccod']['dropped'], ['2019_07'])
+        month_fetches = [c for c in mock_s3.return_value.get_s3_json.call_args_list
+                         if c[0] == ('ccod/history/2019_07/metadata.json', 'bucket')]
+        self.assertEqual(len(month_fetches), app.config['HISTORY_CACHE_RETRIES'])
+
+    def test_index_history_cache(self, *_):
+        cache = [{'history_month': '2019_06'}, {'history_month': '2019_07'}]
+        self.assertEqual(service._index_history_cache(cache), {'2019_06': cache[0], '2019_07': cache[1]})
+        self.assertEqual(service._index_history_cache(None), {})
+        self.assertEqual(service._index_history_cache([{'last_updated': '01-06-2019'}]), {})
+
+    def test_inventory_history(self, *_):
+        session = MagicMock()
+        session.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': 'README.txt', 'ETag': '"a"', 'Size': 1},
+                          {'Key': 'ccod/CCOD_FULL.zip', 'ETag': '"b"', 'Size': 2},
+                          {'Key': 'ccod/history/2019_06/metadata.json', 'ETag': '"c"', 'Size': 3},
+                          {'Key': 'ccod/history/2019_06/CCOD_FULL.zip', 'ETag': '"d"', 'Size': 4}]},
+            {'Contents': [{'Key': 'ccod/history/2019_07/metadata.json', 'ETag': '"e"', 'Size': 5},
+                          {'Key': 'nps/metadata.json', 'ETag': '"f"', 'Size': 6}]},
+            {'KeyCount': 0}
+        ]
+        result = service._inventory_history(session, 'bucket')
+        self.assertEqual(result, {
+            'ccod/': [{'month': '2019_06', 'etag': '"c"', 'size': 3}, {'month': '2019_07', 'etag': '"e"', 'size': 5}],
+            'nps/': []
+        })
+        session.get_paginator.assert_called_once_with('list_objects_v2')
+        session.get_paginator.return_value.paginate.assert_called_once_with(Bucket='bucket')
+
+    @patch("ulapd_api.services.dataset_service.time.sleep")
+    def test_with_retries(self, mock_sleep, *_):
+        func = MagicMock(side_effect=[EndpointConnectionError(endpoint_url='https://s3'), 'ok'])
+        result = service._with_retries(3, func, 'a', key='b')
+        self.assertEqual(result, 'ok')
+        self.assertEqual(func.call_count, 2)
+        func.assert_called_with('a', key='b')
+        mock_sleep.assert_called_once()
+
+    @patch("ulapd_api.services.dataset_service.time.sleep")
+    def test_with_retries_gives_up(self, mock_sleep, *_):
+        func = MagicMock(side_effect=EndpointConnectionError(endpoint_url='https://s3'))
+        with self.assertRaises(EndpointConnectionError):
+            service._with_retries(3, func)
+        self.assertEqual(func.call_count, 3)
+
+    @patch("ulapd_api.services.dataset_service.time.sleep")
+    def test_with_retries_s3_errors(self, mock_sleep, *_):
+        for code, status in [('SlowDown', 503), ('InternalError', 500), ('ServiceUnavailable', 503),
+                             ('BadGateway', 502)]:
+            with self.subTest(code=code):
+                error = ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                                    'GetObject')
+                func = MagicMock(side_effect=[error, 'ok'])
+                self.assertEqual(service._with_retries(3, func), 'ok')
+                self.assertEqual(func.call_count, 2)
+
+    @patch("ulapd_api.services.dataset_service.time.sleep")
+    def test_with_retries_permanent_errors(self, mock_sleep, *_):
+        for error in [ClientError({'Error': {'Code': 'AccessDenied'}, 'ResponseMetadata': {'HTTPStatusCode': 403}},
+                                  'GetObject'),
+                      ValueError('bad json')]:
+            with self.subTest(error=error):
+                func = MagicMock(side_effect=error)
+                with self.assertRaises(type(error)):
+                    service._with_retries(3, func)
+                self.assertEqual(func.call_count, 1)
+        mock_sleep.assert_not_called()
 
     def test_extract_rows_no_rows(self, *_):
         result = service._extract_rows([])
@@ -150,17 +508,196 @@ class TestDatasetService(unittest.TestCase):
         result = service._extract_rows([mock_row, mock_row])
         self.assertEqual(result, [{'foo': 'bar'}, {'foo': 'bar'}])
 
-    @patch("ulapd_api.services.dataset_service.S3")
+    def test_map_rows_concurrently(self, *_):
+        rows = [{'name': name} for name in ['ccod', 'ocod', 'nps']]
+        result = service._map_rows_concurrently(rows, lambda row: dict(row, extended=True))
+        self.assertEqual(result, [{'name': 'ccod', 'extended': True},
+                                  {'name': 'ocod', 'extended': True},
+                                  {'name': 'nps', 'extended': True}])
+
+    @patch("ulapd_api.services.dataset_service.map_concurrently")
+    def test_map_rows_concurrently_timeout(self, mock_map, *_):
+        mock_map.side_effect = futures.TimeoutError('too slow')
+        with self.assertRaises(ApplicationError) as context:
+            service._map_rows_concurrently([], lambda row: row)
+
+        self.assertEqual(context.exception.http_code, 504)
+
+    @patch("ulapd_api.services.dataset_service._get_metadata")
     @patch("ulapd_api.services.dataset_service.format_file_size")
     @patch("ulapd_api.services.dataset_service.format_last_updated_date")
-    def test_metadata_extend(self, mock_date, mock_file_size, mock_s3, *_):
+    def test_metadata_extend(self, mock_date, mock_file_size, mock_metadata, *_):
         row = {'name': 'ccod', 'private': False, 'external': False}
         expected_result = self.expected_metadata
-        mock_s3.return_value.get_s3_resource.return_value = self.test_metadata
+        mock_metadata.return_value = (self.test_metadata, 0)
         mock_file_size.return_value = '1.17 MB'
         mock_date.return_value = 'October 2019'
         result = service._metadata_extend(row)
         self.assertDictEqual(expected_result, result)
+        mock_metadata.assert_called_once_with('ccod', False)
+
+    @patch("ulapd_api.services.dataset_service.S3")
+    @patch("ulapd_api.services.dataset_service._get_metadata")
+    def test_extend_rows(self, mock_metadata, mock_s3, *_):
+        mock_s3.return_value.get_bucket.side_effect = lambda private: 'restricted' if private else 'bucket'
+        mock_metadata.return_value = ({'fee': 'unsynced'}, 0)
+        synced = _result({'name': 'ccod', 'private': False, 'external': False},
+                         _synced('"1"', {'fee': 'synced'}, 'bucket'))
+        moved = _result({'name': 'ocod', 'private': True, 'external': False},
+                        _synced('"1"', {'fee': 'moved'}, 'bucket'))
+        unsynced = _result({'name': 'nps', 'private': True, 'external': False})
+        external = _result({'name': 'inspire', 'private': False, 'external': True})
+        stale = _result({'name': 'ccod_sample', 'private': False, 'external': False},
+                        _synced('"1"', {'fee': 'stale'}, 'bucket', datetime.utcnow() - timedelta(
+                            seconds=app.config['METADATA_SYNC_MAX_AGE'] + 60)))
+
+        result = service._extend_rows([synced, moved, unsynced, external, stale], ['fee'])
+
+        self.assertEqual([row.get('fee') for row in result], ['synced', 'unsynced', 'unsynced', None, 'unsynced'])
+        self.assertEqual(mock_metadata.call_count, 3)
+        mock_metadata.assert_any_call('ocod', True)
+        mock_metadata.assert_any_call('nps', True)
+        mock_metadata.assert_any_call('ccod_sample', False)
+
+    @patch("ulapd_api.services.dataset_service._get_metadata")
+    def test_extend_rows_stale_metadata(self, mock_metadata, *_):
+        mock_metadata.side_effect = [({'fee': 'a'}, 10), ({'fee': 'b'}, 400.5)]
+        results = [_result({'name': name, 'private': False, 'external': False}) for name in ['ccod', 'ocod']]
+
+        with app.test_request_context():
+            service._extend_rows(results, ['fee'])
+            self.assertEqual(service.g.metadata_age, 400)
+
+    @patch("ulapd_api.services.dataset_service._get_metadata")
+    def test_extend_rows_fresh_metadata(self, mock_metadata, *_):
+        mock_metadata.return_value = ({'fee': 'a'}, 10)
+
+        with app.test_request_context():
+            service._extend_rows([_result({'name': 'ccod', 'private': False, 'external': False})], ['fee'])
+            self.assertIsNone(service.g.get('metadata_age'))
+
+    @patch("ulapd_api.services.dataset_service._get_metadata")
+    def test_metadata_extend_fields(self, mock_metadata, *_):
+        row = {'name': 'ccod', 'private': False, 'external': False}
+        mock_metadata.return_value = (self.test_metadata, 0)
+        result = service._metadata_extend(row, ['fee', 'format'])
+        self.assertEqual(result, {'name': 'ccod', 'private': False, 'external': False,
+                                  'fee': self.test_metadata['fee'], 'format': self.test_metadata['format']})
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    @patch("ulapd_api.services.dataset_service._get_metadata")
+    def test_get_datasets_fields_from_rows(self, mock_metadata, mock_dataset, *_):
+        mock_dataset.get_all.return_value = [
+            MagicMock(**{'as_dict.return_value': {'name': 'ccod', 'title': 'CCOD', 'external': False}}),
+            MagicMock(**{'as_dict.return_value': {'name': 'inspire', 'title': 'INSPIRE', 'external': True}})]
+
+        result = service.get_datasets(fields=['name', 'title'])
+
+        self.assertEqual(result, [{'name': 'ccod', 'title': 'CCOD'}, {'name': 'inspire', 'title': 'INSPIRE'}])
+        mock_metadata.assert_not_called()
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    @patch("ulapd_api.services.dataset_service._get_metadata")
+    def test_get_datasets_fields_from_metadata(self, mock_metadata, mock_dataset, *_):
+        mock_dataset.get_all_with_metadata.return_value = [
+            _result({'name': 'ccod', 'private': False, 'external': False}),
+            _result({'name': 'inspire', 'private': False, 'external': True})]
+        mock_metadata.return_value = (self.test_metadata, 0)
+
+        result = service.get_datasets(fields=['name', 'fee'])
+
+        self.assertEqual(result, [{'name': 'ccod', 'fee': self.test_metadata['fee']}, {'name': 'inspire'}])
+        mock_metadata.assert_called_once_with('ccod', False)
+
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    def test_get_datasets_unknown_fields(self, mock_dataset, *_):
+        with self.assertRaises(ApplicationError) as context:
+            service.get_datasets(fields=['name', 'colour'])
+
+        self.assertEqual(context.exception.http_code, 400)
+        mock_dataset.get_all.assert_not_called()
+
+    def test_row_fields_match_model(self, *_):
+        dataset = service.Dataset({'name': 'ccod', 'title': 'CCOD', 'version': '1', 'url': None, 'description': None,
+                                   'licence_id': 'ccod', 'state': 'active', 'type': 'licenced', 'private': False,
+                                   'external': False})
+        self.assertEqual(set(dataset.as_dict()), set(service.ROW_FIELDS))
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_get_metadata(self, mock_s3, mock_cache, *_):
+        mock_s3.return_value.get_bucket.return_value = 'bucket'
+        mock_s3.return_value.get_s3_resource_if_modified.return_value = (self.test_metadata, '"etag"')
+        mock_cache.get_with_age.side_effect = lambda bucket, key, fetch: (fetch('"old"')[0], 5)
+        result = service._get_metadata('ccod', True)
+        self.assertEqual(result, (self.test_metadata, 5))
+        mock_cache.get_with_age.assert_called_once()
+        self.assertEqual(mock_cache.get_with_age.call_args[0][:2], ('bucket', 'ccod/metadata.json'))
+        mock_s3.return_value.get_s3_resource_if_modified.assert_called_once_with('ccod', '/metadata.json', '"old"',
+                                                                                 True)
+
+    @patch("ulapd_api.services.dataset_service.db")
+    @patch("ulapd_api.services.dataset_service.map_concurrently")
+    @patch("ulapd_api.services.dataset_service.DatasetMetadata")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_sync_metadata(self, mock_s3, mock_dataset, mock_metadata, mock_map, mock_db, *_):
+        mock_s3.return_value.get_bucket.side_effect = lambda private: 'restricted' if private else 'bucket'
+        mock_dataset.get_all.return_value = [
+            MagicMock(**{'as_dict.return_value': {'name': name, 'private': private}})
+            for name, private in [('ccod', False), ('ocod', False), ('nps', True), ('rfi', False)]]
+        ccod, nps, old = _synced('"1"', bucket='bucket'), _synced('"2"', bucket='bucket'), _synced('"3"')
+        ccod.dataset_name, nps.dataset_name, old.dataset_name = 'ccod', 'nps', 'old'
+        mock_metadata.get_all.return_value = [ccod, nps, old]
+        mock_s3.return_value.get_s3_resource_if_modified.side_effect = [
+            (None, '"1"'), ({'fee': 'ocod'}, '"4"'), ({'fee': 'nps'}, '"5"'), Exception('boom')]
+        mock_map.side_effect = lambda func, items, max_workers: [func(item) for item in items]
+
+        with patch.dict(app.config, {'METADATA_SYNC_RETRIES': 1}):
+            result = service.sync_metadata()
+
+        self.assertEqual(result, {'result': 'Failed to sync metadata for some datasets, please check logs',
+                                  'updated': ['ocod', 'nps'], 'unchanged': 1, 'removed': ['old'], 'failed': ['rfi']})
+        calls = mock_s3.return_value.get_s3_resource_if_modified.call_args_list
+        self.assertEqual(calls[0][0], ('ccod', '/metadata.json', '"1"', False))
+        # nps is now private, so its copy from the public bucket is not revalidated
+        self.assertEqual(calls[2][0], ('nps', '/metadata.json', None, True))
+        self.assertEqual((nps.bucket, nps.etag, nps.content), ('restricted', '"5"', {'fee': 'nps'}))
+        # ccod was unchanged but has been checked, so is good for another METADATA_SYNC_MAX_AGE
+        self.assertIsInstance(ccod.synced, datetime)
+        mock_metadata.assert_called_once_with({'dataset_name': 'ocod', 'bucket': 'bucket', 'etag': '"4"',
+                                               'content': {'fee': 'ocod'}})
+        mock_db.session.add.assert_called_once_with(mock_metadata.return_value)
+        mock_db.session.delete.assert_called_once_with(old)
+        mock_db.session.commit.assert_called_once()
+
+    @patch("ulapd_api.services.dataset_service.db")
+    @patch("ulapd_api.services.dataset_service.DatasetMetadata")
+    @patch("ulapd_api.services.dataset_service.Dataset")
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_sync_metadata_from_command(self, mock_s3, mock_dataset, mock_metadata, *_):
+        mock_dataset.get_all.return_value = [
+            MagicMock(**{'as_dict.return_value': {'name': 'ccod', 'private': False}})]
+        mock_metadata.get_all.return_value = []
+        mock_s3.return_value.get_s3_resource_if_modified.return_value = ({'fee': 'ccod'}, '"1"')
+
+        # manage.py runs commands in a test request context, which does not run before_request to set a trace id
+        with app.test_request_context(), helpers.contextual_filter(app.logger), self.assertLogs(app.logger) as logs:
+            result = service.sync_metadata()
+
+        self.assertEqual(result['updated'], ['ccod'])
+        self.assertIn('Synced metadata for 1 datasets', logs.records[-1].getMessage())
+        self.assertEqual(logs.records[-1].trace_id, 'N/A')
+
+    @patch("ulapd_api.services.dataset_service.get_fetch_stats")
+    @patch("ulapd_api.services.dataset_service.download_url_cache")
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    def test_get_metadata_cache_stats(self, mock_cache, mock_url_cache, mock_fetch_stats, *_):
+        mock_cache.stats.return_value = {'hits': 1}
+        mock_url_cache.stats.return_value = {'hits': 3}
+        mock_fetch_stats.return_value = {'requests': 2}
+        self.assertEqual(service.get_metadata_cache_stats(),
+                         {'cache': {'hits': 1}, 'download_urls': {'hits': 3}, 's3': {'requests': 2}})
 
     @patch("ulapd_api.services.dataset_service.S3")
     @patch("ulapd_api.services.dataset_service.format_file_size")
@@ -174,6 +711,30 @@ class TestDatasetService(unittest.TestCase):
         result = service._metadata_extend_history(row)
         self.assertDictEqual(expected_result, result)
 
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service.S3")
+    def test_get_rendered_history(self, mock_s3, mock_cache, *_):
+        mock_s3.return_value.get_bucket.return_value = 'bucket'
+        mock_s3.return_value.get_s3_bytes_if_modified.return_value = (b'[]', '"etag"')
+        mock_cache.get.side_effect = lambda bucket, key, fetch: fetch(None)[0]
+        result = service._get_rendered_history('ccod', False)
+        self.assertEqual(result, b'[]')
+        self.assertEqual(mock_cache.get.call_args[0][:2], ('bucket', 'ccod/history/dataset_history.json'))
+        mock_s3.return_value.get_s3_bytes_if_modified.assert_called_once_with(
+            'ccod', '/history/dataset_history.json', None, False, missing_ok=True)
+
+    @patch("ulapd_api.services.dataset_service.metadata_cache")
+    @patch("ulapd_api.services.dataset_service._render_history")
+    def test_write_history_cache(self, mock_render, mock_cache, *_):
+        mock_s3 = MagicMock()
+        mock_render.return_value = [{'last_updated': 'October 2019'}]
+        result = service._write_history_cache(mock_s3, 'bucket', 'ccod/', [{'some': 'data'}])
+        self.assertTrue(result)
+        mock_s3.write_to_s3.assert_any_call('ccod/history/history_cache.json', '[{"some": "data"}]', 'bucket')
+        mock_s3.write_to_s3.assert_any_call('ccod/history/dataset_history.json',
+                                            '[{"last_updated": "October 2019"}]', 'bucket')
+        mock_cache.invalidate.assert_called_once_with('bucket', 'ccod/history/dataset_history.json')
+
     def test_metadata_extend_history_external(self, *_):
         row = {'name': 'ccod', 'private': False, 'external': True}
         result = service._metadata_extend_history(row)
@@ -201,11 +762,24 @@ class TestDatasetService(unittest.TestCase):
         result = service._map_resources(resource)
         self.assertDictEqual(result, expected_result)
 
-    def test_fetch_prefixes(self, *_):
-        data = {'CommonPrefixes': [{'Prefix': 'nps/history/2019_06/'}, {'Prefix': 'nps/history/2019_07/'}]}
-        result = service._fetch_prefixes(data)
-        expected_result = ['nps/history/2019_06/', 'nps/history/2019_07/']
-        self.assertEqual(result, expected_result)
+
+def _mock_history_bucket(mock_s3, months, existing_cache):
+    mock_s3.return_value = MagicMock()
+    mock_s3.return_value.BUCKET_NAME = 'bucket'
+    mock_s3.return_value.S3_BUCKET_RESTRICTED = 'other_bucket'
+
+    contents = [{'Key': 'ccod/CCOD_FULL.zip', 'ETag': '"zip"', 'Size': 1000}]
+    contents.extend({'Key': 'ccod/history/{}/metadata.json'.format(month), 'ETag': '"{}"'.format(month), 'Size': 10}
+                    for month in months)
+
+    def get_s3_json(path, bucket):
+        if path.endswith('history_cache.json'):
+            return json.loads(json.dumps(existing_cache))
+        return {'some': 'data'}
+
+    paginator = mock_s3.return_value.get_s3_session.return_value.get_paginator.return_value
+    paginator.paginate.return_value = [{'Contents': contents}]
+    mock_s3.return_value.get_s3_json.side_effect = get_s3_json
 
 
 def _create_dataset_profile(dataset_id=1, name='foo', title='bar', version='v1', url='www',
@@ -228,6 +802,16 @@ def _create_dataset_profile(dataset_id=1, name='foo', title='bar', version='v1',
     return dataset_profile
 
 
+def _result(row, synced=None):
+    # A (Dataset, DatasetMetadata) pair as returned by the joined dataset queries
+    return MagicMock(**{'as_dict.return_value': dict(row)}), synced
+
+
+def _synced(etag, content=None, bucket=None, synced=None):
+    return MagicMock(etag=etag, content=content or {}, bucket=bucket or app.config.get('S3_BUCKET'),
+                     synced=synced or datetime.utcnow())
+
+
 example_dict = {
     'dataset_id': 1,
     'name': 'foo',
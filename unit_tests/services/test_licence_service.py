@@ -11,20 +11,24 @@ class TestActivityrService(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
 
+    @patch('ulapd_api.services.licence_service.reload_reference_data')
     @patch('ulapd_api.services.licence_service.Licence')
-    def test_create_licence(self, mock_licence, *_):
+    def test_create_licence(self, mock_licence, mock_reload, *_):
         licence = MagicMock()
         licence.as_dict.return_value = {'dataset_licence_id': 1}
         mock_licence.return_value = licence
         mock_licence.get_licence_by_licence_name.return_value = None
         result = service.create_licence({'licence_id': 'ccod'})
         self.assertEqual(result, {'dataset_licence_id': 1})
+        mock_reload.assert_called_once_with()
 
+    @patch('ulapd_api.services.licence_service.reload_reference_data')
     @patch('ulapd_api.services.licence_service.Licence')
-    def test_create_licence_already_exists(self, mock_licence, *_):
+    def test_create_licence_already_exists(self, mock_licence, mock_reload, *_):
         licence = MagicMock()
         licence.as_dict.return_value = {'dataset_licence_id': 1}
         mock_licence.return_value = licence
         mock_licence.get_licence_by_licence_name.return_value = MagicMock()
         result = service.create_licence({'licence_id': 'ccod'})
         self.assertEqual(result, {'dataset_licence_id': 1})
+        mock_reload.assert_called_once_with()
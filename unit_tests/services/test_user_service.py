@@ -40,33 +40,92 @@ class TestUserService(unittest.TestCase):
         }
 
     @patch('ulapd_api.services.user_service.UserDetails')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.get_user_type')
-    def test_get_all_users(self, mock_type, mock_extract, mock_user, *_):
-        mock_user.return_value = MagicMock()
-        user_list = [helpers.generate_test_user(), helpers.generate_test_user()]
-        mock_extract.return_value = user_list
-        mock_type.return_value = self.user_type
+    def test_get_all_users(self, mock_user, *_):
+        user_type = MagicMock()
+        user_type.as_dict.return_value = self.user_type
+        mock_user.get_all_with_user_type.return_value = [(helpers.generate_test_user(), user_type),
+                                                         (helpers.generate_test_user(), user_type)]
 
         result = service.get_all_users()
-        self.assertIn('user_details', result[0])
-        self.assertIn('user_type', result[0])
+        mock_user.get_all_with_user_type.assert_called_once_with(app.config['USER_BATCH_SIZE'], None, None)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0]['user_details'], helpers.user_dict)
         self.assertEqual(result[0]['user_type'], self.user_type)
 
     @patch('ulapd_api.services.user_service.UserDetails')
-    @patch('ulapd_api.services.user_service.get_user_type')
+    def test_get_all_users_page(self, mock_user, *_):
+        mock_user.get_all_with_user_type.return_value = []
+
+        service.get_all_users(after=10, limit=50)
+        mock_user.get_all_with_user_type.assert_called_once_with(app.config['USER_BATCH_SIZE'], 10, 50)
+
+    def test_get_all_users_bad_limit(self, *_):
+        for limit in [0, app.config['USER_PAGE_LIMIT'] + 1]:
+            with self.assertRaises(ApplicationError) as context:
+                service.get_all_users(limit=limit)
+            self.assertEqual(context.exception.http_code, 400)
+
+    @patch('ulapd_api.services.user_service.UserDetails')
+    def test_stream_all_users(self, mock_user, mock_db, *_):
+        user_type = MagicMock()
+        user_type.as_dict.return_value = self.user_type
+        mock_user.get_all_with_user_type.return_value = iter([(helpers.generate_test_user(), user_type)])
+        mock_user.get_missing_user_type_id.return_value = None
+
+        users = service.stream_all_users(after=3)
+        mock_user.get_missing_user_type_id.assert_called_once_with(3, None)
+        mock_db.session.close.assert_not_called()
+
+        self.assertEqual(list(users), [{'user_details': helpers.user_dict, 'user_type': self.user_type}])
+        mock_user.get_all_with_user_type.assert_called_once_with(app.config['USER_BATCH_SIZE'], 3, None)
+        mock_db.session.close.assert_called_once_with()
+
+    def test_stream_all_users_bad_after(self, *_):
+        with self.assertRaises(ApplicationError) as context:
+            service.stream_all_users(after=-1)
+        self.assertEqual(context.exception.http_code, 400)
+
+    @patch('ulapd_api.services.user_service.UserDetails')
+    def test_stream_all_users_no_type(self, mock_user, *_):
+        mock_user.get_missing_user_type_id.return_value = 10
+
+        with self.assertRaises(ApplicationError) as context:
+            service.stream_all_users(limit=5)
+
+        expected_err = ('ulapd_api', 'USER_TYPE_NOT_FOUND')
+        self.assertEqual(context.exception.message, errors.get_message(*expected_err, filler=10))
+        self.assertEqual(context.exception.http_code, 404)
+        mock_user.get_all_with_user_type.assert_not_called()
+
+    @patch('ulapd_api.services.user_service.UserDetails')
+    def test_get_all_users_no_type(self, mock_user, *_):
+        user = helpers.generate_test_user()
+        user.user_type_id = 10
+        mock_user.get_all_with_user_type.return_value = [(user, None)]
+
+        with self.assertRaises(ApplicationError) as context:
+            service.get_all_users()
+
+        expected_err = ('ulapd_api', 'USER_TYPE_NOT_FOUND')
+        self.assertEqual(context.exception.message, errors.get_message(*expected_err, filler=10))
+        self.assertEqual(context.exception.code, errors.get_code(*expected_err))
+
+    @patch('ulapd_api.services.user_service.UserDetails')
+    @patch('ulapd_api.services.user_service.get_reference_data')
     @patch('ulapd_api.services.user_service._build_users_datasets')
-    @patch('ulapd_api.services.user_service.Contact')
-    @patch('ulapd_api.services.user_service._build_contact_preferences')
-    def test_get_user_by_key(self, mock_preferences, mock_contact, mock_build, mock_type, mock_user, *_):
-        mock_user.get_user_details_by_id.return_value = helpers.generate_test_user()
-        mock_user.get_user_details_by_email.return_value = helpers.generate_test_user()
-        mock_user.get_user_details_by_api_key.return_value = helpers.generate_test_user()
-        mock_user.get_user_details_by_ldap_id.return_value = helpers.generate_test_user()
-        mock_type.return_value = self.user_type
+    @patch('ulapd_api.services.user_service.UserTermsLink')
+    def test_get_user_by_key(self, mock_terms, mock_build, mock_reference, mock_user, *_):
+        email = MagicMock()
+        email.as_dict.return_value = {'contact_type': 'email'}
+        phone = MagicMock()
+        phone.as_dict.return_value = {'contact_type': 'phone'}
+        user = helpers.generate_test_user()
+        mock_user.get_user_with_contacts.return_value = [(user, email), (user, phone)]
+        mock_reference.return_value = helpers.generate_reference_data(user_types=[self.user_type])
         mock_build.return_value = self.datasets
-        mock_contact.return_value = MagicMock()
-        mock_preferences.return_value = ['email', 'phone']
+        agreement = MagicMock()
+        agreement.as_dict.return_value = {'licence_id': 'ccod'}
+        mock_terms.get_user_terms_by_user_id.return_value = [agreement]
 
         key_list = [
             {'user_details_id': 6},
@@ -78,9 +137,25 @@ class TestUserService(unittest.TestCase):
         for key in key_list:
             for k, v in key.items():
                 result = service.get_user_by_key({'key': k, 'value': v})
+                mock_user.get_user_with_contacts.assert_called_with(k, v)
                 self.assertEqual(result['datasets']['ccod']['valid_licence'], True)
                 self.assertIn('user_details', result)
                 self.assertEqual(result['user_details']['user_type']['user_type'], 'personal-uk')
+                self.assertEqual(result['user_details']['contact_preferences'], ['email', 'phone'])
+                mock_terms.get_user_terms_by_user_id.assert_called_with(123)
+                mock_build.assert_called_with([{'licence_id': 'ccod'}])
+
+    @patch('ulapd_api.services.user_service.UserDetails')
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    @patch('ulapd_api.services.user_service.UserTermsLink')
+    def test_get_user_by_key_no_contacts(self, mock_terms, mock_reference, mock_user, *_):
+        mock_user.get_user_with_contacts.return_value = [(helpers.generate_test_user(), None)]
+        mock_reference.return_value = helpers.generate_reference_data(user_types=[self.user_type])
+        mock_terms.get_user_terms_by_user_id.return_value = []
+
+        result = service.get_user_by_key({'key': 'email', 'value': 'test@email.com'})
+        self.assertEqual(result['user_details']['contact_preferences'], [])
+        self.assertEqual(result['datasets'], {})
 
     def test_get_user_by_key_incorrect_key(self, *_):
         with self.assertRaises(ApplicationError) as context:
@@ -90,7 +165,7 @@ class TestUserService(unittest.TestCase):
 
     @patch('ulapd_api.services.user_service.UserDetails')
     def test_get_user_by_key_no_user(self, mock_user, *_):
-        mock_user.get_user_details_by_id.return_value = None
+        mock_user.get_user_with_contacts.return_value = []
         with self.assertRaises(ApplicationError) as context:
             service.get_user_by_key({'key': 'user_details_id', 'value': '6'})
 
@@ -121,18 +196,16 @@ class TestUserService(unittest.TestCase):
         self.assertEqual(context.exception.message, expected_err_message)
         self.assertEqual(context.exception.code, expected_err_code)
 
-    @patch('ulapd_api.services.user_service.UserType')
-    def test_get_user_type(self, mock_type, *_):
-        test_type = MagicMock()
-        test_type.as_dict.return_value = self.user_type
-        mock_type.get_user_type_by_id.return_value = test_type
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_get_user_type(self, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(user_types=[self.user_type])
 
         result = service.get_user_type(1)
         self.assertEqual(result['user_type'], 'personal-uk')
 
-    @patch('ulapd_api.services.user_service.UserType')
-    def test_get_user_type_no_type(self, mock_type, *_):
-        mock_type.get_user_type_by_id.return_value = None
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_get_user_type_no_type(self, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(user_types=[self.user_type])
         with self.assertRaises(ApplicationError) as context:
             service.get_user_type(10)
 
@@ -164,19 +237,18 @@ class TestUserService(unittest.TestCase):
         self.assertEqual(result['date_agreed'], None)
 
     @patch('ulapd_api.services.user_service.UserDetails')
-    @patch('ulapd_api.services.user_service.Licence')
-    @patch('ulapd_api.services.user_service._extract_rows')
+    @patch('ulapd_api.services.user_service.get_reference_data')
     @patch('ulapd_api.services.user_service.UserTermsLink.get_user_terms_by_licence_name')
     @patch('ulapd_api.services.user_service._check_freemium')
     @patch('ulapd_api.services.user_service.UserTermsLink')
     @patch('ulapd_api.services.user_service._handle_ldap_group')
-    def test_manage_licence_agreement(self, mock_ldap, mock_user_terms, mock_freemium, mock_terms_get, mock_extract,
-                                      mock_licence, mock_user, *_):
+    def test_manage_licence_agreement(self, mock_ldap, mock_user_terms, mock_freemium, mock_terms_get, mock_reference,
+                                      mock_user, *_):
         user = MagicMock()
         user.user_details_id = 1
         mock_user.get_user_details_by_id.return_value = user
-        mock_licence.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'ccod'}]
+        mock_reference.return_value = helpers.generate_reference_data(
+            licences=[helpers.generate_licence_row('ccod', 'ccod')])
         mock_freemium.return_value = False
         terms_link = MagicMock()
         terms_link.user_terms_link_id = 33
@@ -203,20 +275,20 @@ class TestUserService(unittest.TestCase):
 
     @patch('ulapd_api.services.user_service.app.logger.info')
     @patch('ulapd_api.services.user_service.UserDetails')
-    @patch('ulapd_api.services.user_service.Licence')
-    @patch('ulapd_api.services.user_service._extract_rows')
+    @patch('ulapd_api.services.user_service.get_reference_data')
     @patch('ulapd_api.services.user_service.UserTermsLink.get_user_terms_by_licence_name')
     @patch('ulapd_api.services.user_service._check_freemium')
     @patch('ulapd_api.services.user_service.UserTermsLink')
     @patch('ulapd_api.services.user_service._handle_ldap_group')
     def test_manage_licence_agreement_freemium(self, mock_ldap, mock_user_terms, mock_freemium, mock_terms_get,
-                                               mock_extract, mock_licence, mock_user, mock_log, *_):
+                                               mock_reference, mock_user, mock_log, *_):
         user = MagicMock()
         user.user_details_id = 1
         mock_user.get_user_details_by_id.return_value = user
-        mock_licence.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'res_cov_direct'}, {'licence_id': 'res_cov_exploration'},
-                                     {'licence_id': 'res_cov_commercial'}]
+        mock_reference.return_value = helpers.generate_reference_data(
+            licences=[helpers.generate_licence_row('res_cov_direct', 'res_cov'),
+                      helpers.generate_licence_row('res_cov_exploration', 'res_cov'),
+                      helpers.generate_licence_row('res_cov_commercial', 'res_cov')])
         mock_freemium.return_value = True
         terms_link = MagicMock()
         terms_link.user_terms_link_id = 33
@@ -247,25 +319,20 @@ class TestUserService(unittest.TestCase):
     @patch('ulapd_api.services.user_service.UserDetails')
     @patch('ulapd_api.services.user_service._extract_rows')
     @patch('ulapd_api.services.user_service.UserTermsLink.get_user_terms_by_user_id')
-    @patch('ulapd_api.services.user_service.Licence')
+    @patch('ulapd_api.services.user_service.get_reference_data')
     @patch('ulapd_api.services.user_service.UserTermsLink')
     @patch('ulapd_api.services.user_service.UserTermsLink.delete_user_licence_agreement')
     @patch('ulapd_api.services.user_service._handle_ldap_freemium_updates')
     @patch('ulapd_api.services.user_service.update_groups_for_ldap')
-    def test_manage_multi_licence_agreement(self, mock_ldap, mock_freemium, mock_delete, mock_terms, mock_licence,
+    def test_manage_multi_licence_agreement(self, mock_ldap, mock_freemium, mock_delete, mock_terms, mock_reference,
                                             mock_get, mock_extract, mock_user, mock_log, *_):
         user = MagicMock()
         user.user_details_id = 1
         mock_user.get_user_details_by_id.return_value = user
         mock_get.return_value = MagicMock()
         mock_extract.return_value = [{'licence_id': 'ocod'}]
-        ccod_data = MagicMock()
-        ccod_data.licence_name = 'ccod'
-        ccod_data.dataset_name = 'ccod'
-        ocod_data = MagicMock()
-        ocod_data.licence_name = 'ocod'
-        ocod_data.dataset_name = 'ocod'
-        mock_licence.get_all_licences.return_value = [ccod_data, ocod_data]
+        mock_reference.return_value = helpers.generate_reference_data(
+            licences=[helpers.generate_licence_row('ccod', 'ccod'), helpers.generate_licence_row('ocod', 'ocod')])
         mock_terms.return_value = MagicMock()
         mock_delete.return_value = MagicMock()
         mock_ldap.return_value = MagicMock()
@@ -282,35 +349,23 @@ class TestUserService(unittest.TestCase):
     @patch('ulapd_api.services.user_service.UserDetails')
     @patch('ulapd_api.services.user_service._extract_rows')
     @patch('ulapd_api.services.user_service.UserTermsLink.get_user_terms_by_user_id')
-    @patch('ulapd_api.services.user_service.Licence')
+    @patch('ulapd_api.services.user_service.get_reference_data')
     @patch('ulapd_api.services.user_service.UserTermsLink')
     @patch('ulapd_api.services.user_service.UserTermsLink.delete_user_licence_agreement')
     @patch('ulapd_api.services.user_service._handle_ldap_freemium_updates')
     @patch('ulapd_api.services.user_service.update_groups_for_ldap')
     def test_manage_multi_licence_agreement_freemium(self, mock_ldap, mock_freemium, mock_delete, mock_terms,
-                                                     mock_licence, mock_get, mock_extract, mock_user, mock_log, *_):
+                                                     mock_reference, mock_get, mock_extract, mock_user, mock_log, *_):
         user = MagicMock()
         user.user_details_id = 1
         mock_user.get_user_details_by_id.return_value = user
         mock_get.return_value = MagicMock()
         mock_extract.return_value = [{'licence_id': 'ocod'}]
-        ccod_data = MagicMock()
-        ccod_data.licence_name = 'ccod'
-        ccod_data.dataset_name = 'ccod'
-        ocod_data = MagicMock()
-        ocod_data.licence_name = 'ocod'
-        ocod_data.dataset_name = 'ocod'
-        res_cov_direct_data = MagicMock()
-        res_cov_direct_data.licence_name = 'res_cov_direct'
-        res_cov_direct_data.dataset_name = 'res_cov'
-        res_cov_exploration_data = MagicMock()
-        res_cov_exploration_data.licence_name = 'res_cov_exploration'
-        res_cov_exploration_data.dataset_name = 'res_cov'
-        res_cov_commercial_data = MagicMock()
-        res_cov_commercial_data.licence_name = 'res_cov_commercial'
-        res_cov_commercial_data.dataset_name = 'res_cov'
-        mock_licence.get_all_licences.return_value = [ccod_data, ocod_data, res_cov_direct_data,
-                                                      res_cov_exploration_data, res_cov_commercial_data]
+        mock_reference.return_value = helpers.generate_reference_data(
+            licences=[helpers.generate_licence_row('ccod', 'ccod'), helpers.generate_licence_row('ocod', 'ocod'),
+                      helpers.generate_licence_row('res_cov_direct', 'res_cov'),
+                      helpers.generate_licence_row('res_cov_exploration', 'res_cov'),
+                      helpers.generate_licence_row('res_cov_commercial', 'res_cov')])
         mock_terms.return_value = MagicMock()
         mock_delete.return_value = MagicMock()
         mock_ldap.return_value = MagicMock()
@@ -362,7 +417,8 @@ class TestUserService(unittest.TestCase):
         user['user_type_id'] = 1
         user['contactable'] = True
         mock_process.return_value = user
-        mock_user.return_value = MagicMock()
+        # A real id, as notify() serialises it into the pg_notify payload
+        mock_user.return_value = MagicMock(user_details_id=123)
         mock_verification.create.return_value = MagicMock()
         mock_account.return_value.activate.return_value = MagicMock()
         mock_contact.return_value = MagicMock()
@@ -370,6 +426,7 @@ class TestUserService(unittest.TestCase):
         result = service.create_new_user(user)
         self.assertEqual(result['ldap_id'], '123-343-454-dd5-333')
         self.assertEqual(result['api_key'], '456-343-2ewe-4343')
+        self.assertEqual(result['user_details_id'], 123)
 
     @patch('ulapd_api.services.user_service.AccountAPI')
     @patch('ulapd_api.services.user_service.VerificationAPI')
@@ -384,7 +441,8 @@ class TestUserService(unittest.TestCase):
         user['user_type'] = 'organisation-uk'
         user['contactable'] = True
         mock_process.return_value = user
-        mock_user.return_value = MagicMock()
+        # A real id, as notify() serialises it into the pg_notify payload
+        mock_user.return_value = MagicMock(user_details_id=123)
         mock_verification.create.return_value = MagicMock()
         mock_account.return_value.acknowledge.return_value = MagicMock()
         mock_contact.return_value = MagicMock()
@@ -392,6 +450,7 @@ class TestUserService(unittest.TestCase):
         result = service.create_new_user(user)
         self.assertEqual(result['ldap_id'], '123-343-454-dd5-333')
         self.assertEqual(result['api_key'], '456-343-2ewe-4343')
+        self.assertEqual(result['user_details_id'], 123)
 
     @patch('ulapd_api.services.user_service.UserTermsLink')
     @patch('ulapd_api.services.user_service.Activity')
@@ -499,20 +558,18 @@ class TestUserService(unittest.TestCase):
         self.assertEqual(context.exception.code, expected_err_code)
 
     @patch('ulapd_api.services.user_service.UserDetails')
-    @patch('ulapd_api.services.user_service.Dataset')
-    @patch('ulapd_api.services.user_service.Licence')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.get_licence_agreement')
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    @patch('ulapd_api.services.user_service._get_licence_agreements')
     @patch('ulapd_api.services.user_service._sort_out_sample')
     @patch('ulapd_api.services.user_service._sort_out_licenced_datasets')
-    def test_get__users_dataset_access(self, mock_licenced_datasets, mock_sample, mock_get_licence, mock_extract,
-                                       mock_licence, mock_dataset, mock_user, *_):
+    def test_get__users_dataset_access(self, mock_licenced_datasets, mock_sample, mock_agreements, mock_reference,
+                                       mock_user, *_):
         mock_user.return_value = MagicMock()
-        mock_dataset.get_all.return_value = helpers.generate_dataset_list()
-        mock_licence.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'foo', 'title': 'bar'},
-                                     {'licence_id': 'bar', 'title': 'foo'}]
-        mock_get_licence.return_value = {'valid_licence': True}
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=helpers.generate_dataset_list(),
+            licences=[helpers.generate_licence_row('nps', 'nps', 'nps licence title'),
+                      helpers.generate_licence_row('ccod', 'ccod', 'ccod licence title')])
+        mock_agreements.return_value = {'nps': {'valid_licence': True}, 'ccod': {'valid_licence': True}}
 
         mock_sample.return_value = [{'id': '1', 'name': 'nps', 'title': 'nps_title', 'type': 'restricted',
                                      'licences': [{'title': 'nps licence title', 'agreed': True}]},
@@ -530,6 +587,48 @@ class TestUserService(unittest.TestCase):
 
         result = service.get_users_dataset_access(1)
         self.assertEqual(result, expected_result)
+        mock_sample.assert_called_once_with([
+            {'id': 1, 'name': 'nps', 'title': 'nps title', 'type': 'restricted',
+             'licences': {'nps': {'title': 'nps licence title', 'agreed': True}}},
+            {'id': 2, 'name': 'ccod', 'title': 'ccod title', 'type': 'licenced',
+             'licences': {'ccod': {'title': 'ccod licence title', 'agreed': True}}}])
+
+    @patch('ulapd_api.services.user_service.UserDetails')
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    @patch('ulapd_api.services.user_service._get_licence_agreements')
+    @patch('ulapd_api.services.user_service._sort_out_licenced_datasets')
+    def test_get_users_dataset_access_not_agreed(self, mock_licenced_datasets, mock_agreements, mock_reference,
+                                                 mock_user, *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=helpers.generate_dataset_list(),
+            licences=[helpers.generate_licence_row('nps', 'nps', 'nps licence title'),
+                      helpers.generate_licence_row('ccod', 'ccod', 'ccod licence title')])
+        mock_agreements.return_value = {'ccod': {'valid_licence': True}}
+
+        result = service.get_users_dataset_access(1)
+        self.assertEqual(result[0], {'id': 1, 'name': 'nps', 'title': 'nps title', 'type': 'restricted',
+                                     'licences': {'nps': {'title': 'nps licence title', 'agreed': False}}})
+        mock_agreements.assert_called_once_with(1)
+        mock_licenced_datasets.assert_called_once_with([
+            {'id': 2, 'name': 'ccod', 'title': 'ccod title', 'type': 'licenced',
+             'licences': {'ccod': {'title': 'ccod licence title', 'agreed': True}}}])
+
+    @patch('ulapd_api.services.user_service.UserTermsLink')
+    @patch('ulapd_api.services.user_service._check_agreement')
+    def test_get_licence_agreements(self, mock_check, mock_terms, *_):
+        ccod = MagicMock(licence_name='ccod', date_agreed=datetime(2019, 11, 21))
+        ocod = MagicMock(licence_name='ocod', date_agreed=datetime(2019, 9, 1))
+        mock_terms.get_latest_user_terms_by_user_id.return_value = [ccod, ocod]
+        mock_check.side_effect = [True, False]
+
+        result = service._get_licence_agreements(1)
+        self.assertEqual(result, {'ccod': {'valid_licence': True, 'date_agreed': datetime(2019, 11, 21)},
+                                  'ocod': {'valid_licence': False, 'date_agreed': datetime(2019, 9, 1)}})
+        mock_terms.get_latest_user_terms_by_user_id.assert_called_once_with(1)
+
+    def test_licence_agreement_not_agreed(self, *_):
+        result = service._licence_agreement({}, 'ccod')
+        self.assertEqual(result, {'valid_licence': False, 'date_agreed': None})
 
     @patch('ulapd_api.services.user_service.UserDetails')
     def test_get_users_dataset_access_no_user(self, mock_user, *_):
@@ -555,23 +654,21 @@ class TestUserService(unittest.TestCase):
         result = service._extract_rows([mock_row, mock_row])
         self.assertEqual(result, [{'foo': 'bar'}, {'foo': 'bar'}])
 
-    @patch('ulapd_api.services.user_service.Licence')
-    def test_check_agreement_true(self, mock_licence, *_):
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_check_agreement_true(self, mock_reference, *_):
         date_agreed = datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f')
         licence_date = datetime.strptime('2019-09-09', '%Y-%m-%d')
-        licence = MagicMock()
-        licence.last_updated = licence_date.date()
-        mock_licence.get_licence_by_licence_name.return_value = licence
+        mock_reference.return_value = helpers.generate_reference_data(
+            licences=[helpers.generate_licence_row('ccod', 'ccod', last_updated=licence_date.date())])
         result = service._check_agreement('ccod', date_agreed)
         self.assertEqual(result, True)
 
-    @patch('ulapd_api.services.user_service.Licence')
-    def test_check_agreement_false(self, mock_licence, *_):
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_check_agreement_false(self, mock_reference, *_):
         date_agreed = datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f')
         licence_date = datetime.strptime('2019-11-22', '%Y-%m-%d')
-        licence = MagicMock()
-        licence.last_updated = licence_date.date()
-        mock_licence.get_licence_by_licence_name.return_value = licence
+        mock_reference.return_value = helpers.generate_reference_data(
+            licences=[helpers.generate_licence_row('ccod', 'ccod', last_updated=licence_date.date())])
         result = service._check_agreement('ccod', date_agreed)
         self.assertEqual(result, False)
 
@@ -634,11 +731,10 @@ class TestUserService(unittest.TestCase):
 
         self.assertEqual(result, expected_result)
 
-    @patch('ulapd_api.services.user_service.UserType')
-    def test_get_user_type_by_type(self, mock_type, *_):
-        user_type = MagicMock()
-        user_type.as_dict.return_value = {'user_type_id': 3}
-        mock_type.get_user_id_by_type.return_value = user_type
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_get_user_type_by_type(self, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            user_types=[self.user_type, {'user_type_id': 3, 'user_type': 'organisation-uk', 'date_added': None}])
         result = service._get_user_type_id('organisation-uk')
         self.assertEqual(result, 3)
 
@@ -646,24 +742,15 @@ class TestUserService(unittest.TestCase):
         result = service._create_api_key()
         assert isinstance(result, str)
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    @patch('ulapd_api.services.user_service.get_licence_agreement')
-    @patch('ulapd_api.services.user_service.UserTermsLink')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.Licence')
-    def test_build_users_datasets(self, mock_licence, mock_extract, mock_user_terms,
-                                  mock_get_licence, mock_dataset, *_):
-        mock_dataset.get_dataset_by_name.return_value = helpers.generate_a_dataset()
-        licence_data = MagicMock()
-        licence_data.title = 'Licence Title'
-        mock_licence.get_licence_by_licence_name.return_value = licence_data
-        mock_user_terms.get_user_terms_by_user_id.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'ccod'}]
-
-        licence = {'date_agreed': '2019-11-21 12:10:57.070764', 'valid_licence': True}
-        mock_get_licence.return_value = licence
-
-        result = service._build_users_datasets(123)
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_build_users_datasets(self, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=[helpers.generate_a_dataset()],
+            licences=[helpers.generate_licence_row('ccod', 'ccod', 'Licence Title',
+                                                   datetime(2019, 9, 9).date())])
+        user_licences = [{'licence_id': 'ccod', 'date_agreed': datetime(2019, 11, 21, 12, 10, 57, 70764)}]
+
+        result = service._build_users_datasets(user_licences)
         expected_result = {
             'ccod': {
                 'date_agreed': '2019-11-21 12:10:57.070764',
@@ -675,29 +762,37 @@ class TestUserService(unittest.TestCase):
         }
         self.assertEqual(result, expected_result)
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    @patch('ulapd_api.services.user_service.get_licence_agreement')
-    @patch('ulapd_api.services.user_service.UserTermsLink')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.Licence')
-    @patch('ulapd_api.services.user_service.sorted')
-    def test_build_users_datasets_freemium(self, mock_sorted, mock_licence, mock_extract, mock_user_terms,
-                                           mock_get_licence, mock_dataset, *_):
-        mock_dataset.get_dataset_by_name.return_value = helpers.generate_a_freemium_dataset()
-        licence_data = MagicMock()
-        licence_data.title = 'Licence Title'
-        mock_licence.get_licence_by_licence_name.return_value = licence_data
-        mock_user_terms.get_user_terms_by_user_id.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'res_cov_exploration'}, {'licence_id': 'res_cov_direct'}]
-        mock_sorted.return_value = ['Direct Use', 'Exploration']
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_build_users_datasets_not_agreed_since_update(self, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=[helpers.generate_a_dataset()],
+            licences=[helpers.generate_licence_row('ccod', 'ccod', 'Licence Title',
+                                                   datetime(2019, 12, 1).date())])
 
-        licence = {
-            'date_agreed': '2019-11-21 12:10:57.070764',
-            'valid_licence': True
-        }
-        mock_get_licence.return_value = licence
+        result = service._build_users_datasets([{'licence_id': 'ccod', 'date_agreed': datetime(2019, 11, 21)}])
+        self.assertEqual(result, {})
 
-        result = service._build_users_datasets(123)
+    def test_latest_agreements(self, *_):
+        user_licences = [{'licence_id': 'ccod', 'date_agreed': datetime(2019, 10, 1)},
+                         {'licence_id': 'ocod', 'date_agreed': datetime(2019, 9, 1)},
+                         {'licence_id': 'ccod', 'date_agreed': datetime(2019, 11, 21)},
+                         {'licence_id': 'ccod', 'date_agreed': datetime(2019, 11, 1)}]
+
+        result = service._latest_agreements(user_licences)
+        self.assertEqual(result, {'ccod': datetime(2019, 11, 21), 'ocod': datetime(2019, 9, 1)})
+
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_build_users_datasets_freemium(self, mock_reference, *_):
+        licence_date = datetime(2019, 9, 9).date()
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=[helpers.generate_a_freemium_dataset()],
+            licences=[helpers.generate_licence_row('res_cov_direct', 'res_cov', 'Direct Use', licence_date),
+                      helpers.generate_licence_row('res_cov_exploration', 'res_cov', 'Exploration', licence_date)])
+        date_agreed = datetime(2019, 11, 21, 12, 10, 57, 70764)
+        user_licences = [{'licence_id': 'res_cov_exploration', 'date_agreed': date_agreed},
+                         {'licence_id': 'res_cov_direct', 'date_agreed': date_agreed}]
+
+        result = service._build_users_datasets(user_licences)
         expected_result = {
             'res_cov': {
                 'date_agreed': None,
@@ -717,23 +812,22 @@ class TestUserService(unittest.TestCase):
         service._delete_user_data(account, {'user_details_id': 123, 'ldap_id': 'an-ldap-id'})
         mock_delete.assert_called()
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    @patch('ulapd_api.services.user_service._get_dataset_downloads')
-    @patch('ulapd_api.services.user_service.get_licence_agreement')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.Licence')
-    def test_build_user_dataset_activity(self, mock_licence, mock_extract, mock_get_licence,
-                                         mock_download, mock_dataset, *_):
-        mock_licence.return_value = MagicMock()
-        mock_dataset.get_all.return_value = helpers.generate_dataset_list()
-        mock_download.return_value = [{"date": "2019-11-22T09:28:58.610283", "file": "COU_file.zip"},
-                                      {"date": "2019-11-21T12:10:27.550330", "file": "FULL_file.zip"}]
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    @patch('ulapd_api.services.user_service._get_user_downloads')
+    @patch('ulapd_api.services.user_service._get_licence_agreements')
+    def test_build_user_dataset_activity(self, mock_get_licence, mock_download, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=helpers.generate_dataset_list(),
+            licences=[helpers.generate_licence_row('nps', 'nps'), helpers.generate_licence_row('ccod', 'ccod')])
+        mock_download.return_value = {'nps': [{"date": "2019-11-22T09:28:58.610283", "file": "COU_file.zip"},
+                                              {"date": "2019-11-21T12:10:27.550330", "file": "FULL_file.zip"}],
+                                      'ccod': [{"date": "2019-11-22T09:28:58.610283", "file": "COU_file.zip"},
+                                               {"date": "2019-11-21T12:10:27.550330", "file": "FULL_file.zip"}]}
         licence = {
             'date_agreed': datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f'),
             'valid_licence': True
         }
-        mock_get_licence.return_value = licence
-        mock_extract.return_value = [{'licence_id': 'ccod'}]
+        mock_get_licence.return_value = {'nps': licence, 'ccod': licence}
 
         result = service._build_user_dataset_activity(123)
         expected_result = [
@@ -755,22 +849,19 @@ class TestUserService(unittest.TestCase):
              'licence_agreed_date': '2019-11-21T12:10:57.070764'}]
         self.assertEqual(result, expected_result)
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    @patch('ulapd_api.services.user_service._get_dataset_downloads')
-    @patch('ulapd_api.services.user_service.get_licence_agreement')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.Licence')
-    def test_build_user_dataset_activity_no_download(self, mock_licence, mock_extract, mock_get_licence, mock_download,
-                                                     mock_dataset, *_):
-        mock_licence.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'ccod'}]
-        mock_dataset.get_all.return_value = helpers.generate_dataset_list()
-        mock_download.return_value = []
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    @patch('ulapd_api.services.user_service._get_user_downloads')
+    @patch('ulapd_api.services.user_service._get_licence_agreements')
+    def test_build_user_dataset_activity_no_download(self, mock_get_licence, mock_download, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=helpers.generate_dataset_list(),
+            licences=[helpers.generate_licence_row('nps', 'nps'), helpers.generate_licence_row('ccod', 'ccod')])
+        mock_download.return_value = {}
         licence = {
             'date_agreed': datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f'),
             'valid_licence': True
         }
-        mock_get_licence.return_value = licence
+        mock_get_licence.return_value = {'nps': licence, 'ccod': licence}
         result = service._build_user_dataset_activity(123)
         expected_result = [
             {'id': 1,
@@ -789,22 +880,20 @@ class TestUserService(unittest.TestCase):
              'licence_agreed_date': '2019-11-21T12:10:57.070764'}]
         self.assertEqual(result, expected_result)
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    @patch('ulapd_api.services.user_service._get_dataset_downloads')
-    @patch('ulapd_api.services.user_service.get_licence_agreement')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.Licence')
-    def test_build_user_dataset_activity_no_licence_agreement(self, mock_licence, mock_extract, mock_get_licence,
-                                                              mock_download, mock_dataset, *_):
-        mock_licence.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'ccod'}]
-        mock_dataset.get_all.return_value = helpers.generate_dataset_list()
-        mock_download.return_value = []
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    @patch('ulapd_api.services.user_service._get_user_downloads')
+    @patch('ulapd_api.services.user_service._get_licence_agreements')
+    def test_build_user_dataset_activity_no_licence_agreement(self, mock_get_licence, mock_download, mock_reference,
+                                                              *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=helpers.generate_dataset_list(),
+            licences=[helpers.generate_licence_row('nps', 'nps'), helpers.generate_licence_row('ccod', 'ccod')])
+        mock_download.return_value = {}
         licence = {
             'date_agreed': datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f'),
             'valid_licence': False
         }
-        mock_get_licence.return_value = licence
+        mock_get_licence.return_value = {'nps': licence, 'ccod': licence}
         result = service._build_user_dataset_activity(123)
         expected_result = [
             {'id': 1,
@@ -821,25 +910,22 @@ class TestUserService(unittest.TestCase):
              'download_history': []}]
         self.assertEqual(result, expected_result)
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    @patch('ulapd_api.services.user_service._get_dataset_downloads')
-    @patch('ulapd_api.services.user_service.get_licence_agreement')
-    @patch('ulapd_api.services.user_service._extract_rows')
-    @patch('ulapd_api.services.user_service.Licence')
-    def test_build_user_dataset_activity_freemium(self, mock_licence, mock_extract, mock_get_licence,
-                                                  mock_download, mock_dataset, *_):
-        mock_licence.return_value = MagicMock()
-        mock_extract.return_value = [{'licence_id': 'res_cov_direct'}, {'licence_id': 'res_cov_exploration'},
-                                     {'licence_id': 'res_cov_commercial'}]
-
-        mock_dataset.get_all.return_value = [helpers.generate_a_freemium_dataset()]
-
-        mock_download.return_value = []
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    @patch('ulapd_api.services.user_service._get_user_downloads')
+    @patch('ulapd_api.services.user_service._get_licence_agreements')
+    def test_build_user_dataset_activity_freemium(self, mock_get_licence, mock_download, mock_reference, *_):
+        mock_reference.return_value = helpers.generate_reference_data(
+            datasets=[helpers.generate_a_freemium_dataset()],
+            licences=[helpers.generate_licence_row('res_cov_direct', 'res_cov'),
+                      helpers.generate_licence_row('res_cov_exploration', 'res_cov'),
+                      helpers.generate_licence_row('res_cov_commercial', 'res_cov')])
+
+        mock_download.return_value = {}
         licence = {
             'date_agreed': datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f'),
             'valid_licence': True
         }
-        mock_get_licence.return_value = licence
+        mock_get_licence.return_value = {'res_cov_exploration': licence}
         result = service._build_user_dataset_activity(123)
         expected_result = [
             {'id': 3,
@@ -851,25 +937,29 @@ class TestUserService(unittest.TestCase):
         self.assertEqual(result, expected_result)
 
     @patch('ulapd_api.services.user_service.Activity')
-    def test_get_dataset_downloads(self, mock_activity, *_):
+    def test_get_user_downloads(self, mock_activity, *_):
         a1 = MagicMock()
-        a1.activity_type = 'download'
-        a1.timestamp = datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f')
-        a1.file = 'COU_file.zip'
+        a1.dataset_name = 'ccod'
+        a1.timestamp = datetime.strptime('2019-11-21 12:10:58.070764', '%Y-%m-%d %H:%M:%S.%f')
+        a1.file = 'FULL_file.zip'
 
         a2 = MagicMock()
-        a2.activity_type = 'download'
-        a2.timestamp = datetime.strptime('2019-11-21 12:10:58.070764', '%Y-%m-%d %H:%M:%S.%f')
-        a2.file = 'FULL_file.zip'
+        a2.dataset_name = 'ccod'
+        a2.timestamp = datetime.strptime('2019-11-21 12:10:57.070764', '%Y-%m-%d %H:%M:%S.%f')
+        a2.file = 'COU_file.zip'
 
         a3 = MagicMock()
-        a3.activity_type = 'licence agreed'
-
-        mock_activity.get_user_activity_by_dataset.return_value = [a1, a2, a3]
-        result = service._get_dataset_downloads(123, 'ccod')
-        expected_result = [{'date': '2019-11-21T12:10:57.070764', 'file': 'COU_file.zip'},
-                           {'date': '2019-11-21T12:10:58.070764', 'file': 'FULL_file.zip'}]
+        a3.dataset_name = 'ocod'
+        a3.timestamp = datetime.strptime('2019-11-20 09:00:00.000000', '%Y-%m-%d %H:%M:%S.%f')
+        a3.file = 'OCOD_FULL_file.zip'
+
+        mock_activity.get_user_downloads.return_value = [a1, a2, a3]
+        result = service._get_user_downloads(123)
+        expected_result = {'ccod': [{'date': '2019-11-21T12:10:58.070764', 'file': 'FULL_file.zip'},
+                                    {'date': '2019-11-21T12:10:57.070764', 'file': 'COU_file.zip'}],
+                           'ocod': [{'date': '2019-11-20T09:00:00.000000', 'file': 'OCOD_FULL_file.zip'}]}
         self.assertEqual(result, expected_result)
+        mock_activity.get_user_downloads.assert_called_once_with(123)
 
     def test_build_contact_preferences(self, *_):
         data = [
@@ -915,19 +1005,21 @@ class TestUserService(unittest.TestCase):
             service._handle_ldap_group('dad', '123-333', True)
         mock_account.assert_called_with(expected_call)
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    def test_check_freemium_true(self, mock_dataset, *_):
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_check_freemium_true(self, mock_reference, *_):
         dataset = MagicMock()
+        dataset.name = 'res_cov'
         dataset.type = 'freemium'
-        mock_dataset.get_dataset_by_name.return_value = dataset
+        mock_reference.return_value = helpers.generate_reference_data(datasets=[dataset])
         result = service._check_freemium('res_cov')
         self.assertEqual(result, True)
 
-    @patch('ulapd_api.services.user_service.Dataset')
-    def test_check_freemium_false(self, mock_dataset, *_):
+    @patch('ulapd_api.services.user_service.get_reference_data')
+    def test_check_freemium_false(self, mock_reference, *_):
         dataset = MagicMock()
+        dataset.name = 'ocod'
         dataset.type = 'licenced'
-        mock_dataset.get_dataset_by_name.return_value = dataset
+        mock_reference.return_value = helpers.generate_reference_data(datasets=[dataset])
         result = service._check_freemium('ocod')
         self.assertEqual(result, False)
 
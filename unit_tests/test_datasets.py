@@ -2,6 +2,7 @@ import unittest
 from ulapd_api.main import app
 from ulapd_api.exceptions import ApplicationError
 from unittest.mock import patch
+from flask import g
 
 
 @patch('ulapd_api.views.v1.datasets.dataset_service')
@@ -13,16 +14,57 @@ class TestDatasets(unittest.TestCase):
                         'Content-Type': 'application/json'}
 
     def test_get_datasets(self, mock_service):
-        mock_service.get_datasets.return_value = [{'foo': 'bar'}]
+        mock_service.get_datasets_with_etag.return_value = (None, [{'foo': 'bar'}])
 
         response = self.app.get('/v1/datasets', headers=self.headers)
 
         self.assertEqual(200, response.status_code)
         response_body = response.get_json()
         self.assertEqual(response_body, [{'foo': 'bar'}])
+        self.assertNotIn('ETag', response.headers)
+
+    def test_get_datasets_etag(self, mock_service):
+        mock_service.get_datasets_with_etag.return_value = ('abc', [{'foo': 'bar'}])
+
+        response = self.app.get('/v1/datasets', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.headers['ETag'], '"abc"')
+
+    def test_get_datasets_not_modified(self, mock_service):
+        mock_service.get_datasets_with_etag.return_value = ('abc', None)
+        headers = dict(self.headers, **{'If-None-Match': '"abc"'})
+
+        response = self.app.get('/v1/datasets?simple=true', headers=headers)
+
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(response.headers['ETag'], '"abc"')
+        args = mock_service.get_datasets_with_etag.call_args[0]
+        self.assertEqual(args[:3], (False, True, None))
+        self.assertIn('abc', args[3])
+
+    def test_get_datasets_fields(self, mock_service):
+        mock_service.get_datasets_with_etag.return_value = (None, [{'name': 'ccod'}])
+
+        response = self.app.get('/v1/datasets?fields=name,,last_updated', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        args = mock_service.get_datasets_with_etag.call_args[0]
+        self.assertEqual(args[:3], (False, False, ['name', 'last_updated']))
+
+    def test_get_datasets_stale_metadata(self, mock_service):
+        def get_datasets_with_etag(*_):
+            g.metadata_age = 400
+            return None, [{'foo': 'bar'}]
+        mock_service.get_datasets_with_etag.side_effect = get_datasets_with_etag
+
+        response = self.app.get('/v1/datasets', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.headers['Age'], '400')
 
     def test_get_datasets_error(self, mock_service):
-        mock_service.get_datasets.side_effect = ApplicationError('some error', 500)
+        mock_service.get_datasets_with_etag.side_effect = ApplicationError('some error', 500)
 
         response = self.app.get('/v1/datasets', headers=self.headers)
 
@@ -49,16 +91,28 @@ class TestDatasets(unittest.TestCase):
         self.assertEqual(response_body, {'error': 'Failed to create dataset: aaaa - error: some error'})
 
     def test_get_dataset_by_name(self, mock_service):
-        mock_service.get_dataset_by_name.return_value = [{'foo': 'bar'}]
+        mock_service.get_dataset_with_etag.return_value = ('abc', {'foo': 'bar'})
 
         response = self.app.get('/v1/datasets/test', headers=self.headers)
 
         self.assertEqual(200, response.status_code)
         response_body = response.get_json()
-        self.assertEqual(response_body, [{'foo': 'bar'}])
+        self.assertEqual(response_body, {'foo': 'bar'})
+        self.assertEqual(response.headers['ETag'], '"abc"')
+
+    def test_get_dataset_by_name_not_modified(self, mock_service):
+        mock_service.get_dataset_with_etag.return_value = ('abc', None)
+        headers = dict(self.headers, **{'If-None-Match': '"abc"'})
+
+        response = self.app.get('/v1/datasets/test', headers=headers)
+
+        self.assertEqual(304, response.status_code)
+        name, if_none_match = mock_service.get_dataset_with_etag.call_args[0]
+        self.assertEqual(name, 'test')
+        self.assertIn('abc', if_none_match)
 
     def test_get_dataset_by_name_error(self, mock_service):
-        mock_service.get_dataset_by_name.side_effect = ApplicationError('some error', 500)
+        mock_service.get_dataset_with_etag.side_effect = ApplicationError('some error', 500)
 
         response = self.app.get('/v1/datasets/test', headers=self.headers)
 
@@ -67,13 +121,14 @@ class TestDatasets(unittest.TestCase):
         self.assertEqual(response_body, {'error': 'Failed to get dataset: test - error: some error'})
 
     def test_get_dataset_history(self, mock_service):
-        mock_service.get_dataset_history.return_value = [{'foo': 'bar'}]
+        mock_service.get_dataset_history.return_value = b'{"name": "test", "dataset_history": []}'
 
         response = self.app.get('/v1/datasets/test/history', headers=self.headers)
 
         self.assertEqual(200, response.status_code)
+        self.assertEqual(response.mimetype, 'application/json')
         response_body = response.get_json()
-        self.assertEqual(response_body, [{'foo': 'bar'}])
+        self.assertEqual(response_body, {'name': 'test', 'dataset_history': []})
 
     def test_get_dataset_history_error(self, mock_service):
         mock_service.get_dataset_history.side_effect = ApplicationError('some error', 500)
@@ -111,6 +166,27 @@ class TestDatasets(unittest.TestCase):
         response_body = response.get_json()
         self.assertEqual(response_body, {'error': 'Failed to get download link for dataset: test - error: some error'})
 
+    def test_get_download_links(self, mock_service):
+        mock_service.get_download_links.return_value = [{'name': 'test', 'file': 'a.zip', 'date': None,
+                                                         'link': 'a_link'}]
+        files = [{'name': 'test', 'file': 'a.zip'}]
+
+        response = self.app.post('/v1/datasets/download/batch', json=files, headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        response_body = response.get_json()
+        self.assertEqual(response_body, {'links': [{'name': 'test', 'file': 'a.zip', 'date': None, 'link': 'a_link'}]})
+        mock_service.get_download_links.assert_called_once_with(files)
+
+    def test_get_download_links_error(self, mock_service):
+        mock_service.get_download_links.side_effect = ApplicationError('some error', 'E102', http_code=400)
+
+        response = self.app.post('/v1/datasets/download/batch', json={}, headers=self.headers)
+
+        self.assertEqual(400, response.status_code)
+        response_body = response.get_json()
+        self.assertEqual(response_body, {'error': 'Failed to get download links - error: some error'})
+
     def test_historical_cache(self, mock_service):
         mock_service.update_historical_cache.return_value = 'ok'
 
@@ -120,6 +196,14 @@ class TestDatasets(unittest.TestCase):
         response_body = response.get_json()
         self.assertEqual(response_body, 'ok')
 
+    def test_historical_cache_full(self, mock_service):
+        mock_service.update_historical_cache.return_value = 'ok'
+
+        response = self.app.put('/v1/datasets/historical_cache?full=true', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        mock_service.update_historical_cache.assert_called_once_with(True)
+
     def test_historical_cache_error(self, mock_service):
         mock_service.update_historical_cache.side_effect = ApplicationError('some error', 500)
 
@@ -128,3 +212,28 @@ class TestDatasets(unittest.TestCase):
         self.assertEqual(500, response.status_code)
         response_body = response.get_json()
         self.assertEqual(response_body, {'error': 'Failed to update historical cache:  some error '})
+
+    def test_metadata_sync(self, mock_service):
+        mock_service.sync_metadata.return_value = {'result': 'ok'}
+
+        response = self.app.put('/v1/datasets/metadata_sync', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.get_json(), {'result': 'ok'})
+
+    def test_metadata_sync_error(self, mock_service):
+        mock_service.sync_metadata.side_effect = ApplicationError('some error', 500)
+
+        response = self.app.put('/v1/datasets/metadata_sync', headers=self.headers)
+
+        self.assertEqual(500, response.status_code)
+        self.assertEqual(response.get_json(), {'error': 'Failed to sync dataset metadata: some error'})
+
+    def test_metadata_cache_stats(self, mock_service):
+        mock_service.get_metadata_cache_stats.return_value = {'hits': 2, 'misses': 1}
+
+        response = self.app.get('/v1/datasets/metadata_cache', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        response_body = response.get_json()
+        self.assertEqual(response_body, {'hits': 2, 'misses': 1})
@@ -21,6 +21,50 @@ class TestActivity(unittest.TestCase):
         response_body = response.get_json()
         self.assertEqual(response_body, [{'foo': 'bar'}, {'foo2': 'bar2'}])
 
+    def test_get_users_page(self, mock_service):
+        mock_service.get_all_users.return_value = [{'user_details': {'user_details_id': 11}},
+                                                   {'user_details': {'user_details_id': 12}}]
+
+        response = self.app.get('/v1/users?after=10&limit=2', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        mock_service.get_all_users.assert_called_once_with(10, 2)
+        self.assertEqual(response.headers['Link'], '</v1/users?after=12&limit=2>; rel="next"')
+
+    def test_get_users_last_page(self, mock_service):
+        mock_service.get_all_users.return_value = [{'user_details': {'user_details_id': 11}}]
+
+        response = self.app.get('/v1/users?after=10&limit=2', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('Link', response.headers)
+
+    def test_get_users_bad_limit(self, mock_service):
+        response = self.app.get('/v1/users?limit=ten', headers=self.headers)
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(response.get_json(),
+                         {'error': 'Failed to get all users - error: limit must be a whole number'})
+        mock_service.get_all_users.assert_not_called()
+
+    def test_get_users_ndjson(self, mock_service):
+        mock_service.stream_all_users.return_value = iter([{'foo': 'bar'}, {'foo2': 'bar2'}])
+
+        response = self.app.get('/v1/users?format=ndjson&after=5', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(response.get_data(as_text=True), '{"foo": "bar"}\n{"foo2": "bar2"}\n')
+        mock_service.stream_all_users.assert_called_once_with(5, None)
+
+    def test_get_users_ndjson_error(self, mock_service):
+        mock_service.stream_all_users.side_effect = ApplicationError('User type not found', 'E999', http_code=404)
+
+        response = self.app.get('/v1/users?format=ndjson', headers=self.headers)
+
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(response.get_json(), {'error': 'Failed to get all users - error: User type not found'})
+
     def test_get_users_error(self, mock_service):
         mock_service.get_all_users.side_effect = ApplicationError('some error', 500)
 
@@ -1,5 +1,8 @@
+from contextlib import contextmanager
 from unittest.mock import MagicMock
 from datetime import datetime
+from ulapd_api.custom_extensions.enhanced_logging.filters import ContextualFilter
+from ulapd_api.utilities.reference_data import ReferenceData
 
 user_dict = {
     'user_details_id': 123,
@@ -96,3 +99,31 @@ def generate_a_freemium_dataset():
     res_cov.type = 'freemium'
 
     return res_cov
+
+
+def generate_licence_row(licence_name, dataset_name, title=None, last_updated=None):
+    return {
+        'licence_id': licence_name,
+        'dataset_name': dataset_name,
+        'title': title,
+        'last_updated': last_updated
+    }
+
+
+def generate_reference_data(datasets=(), licences=(), user_types=()):
+    """Build a ReferenceData snapshot from dataset mocks such as generate_a_dataset returns and row dicts."""
+    dataset_rows = [{'dataset_id': dataset.dataset_id, 'name': dataset.name, 'title': dataset.title,
+                     'licence_id': dataset.licence_id, 'type': dataset.type, 'private': dataset.private,
+                     'external': False} for dataset in datasets]
+    return ReferenceData(licences, dataset_rows, user_types)
+
+
+@contextmanager
+def contextual_filter(logger):
+    """Attach the app's log filter to logger, so the trace id it sets can be checked on captured records."""
+    log_filter = ContextualFilter()
+    logger.addFilter(log_filter)
+    try:
+        yield
+    finally:
+        logger.removeFilter(log_filter)
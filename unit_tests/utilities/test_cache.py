@@ -0,0 +1,266 @@
+import threading
+import time
+import unittest
+from concurrent import futures
+from unittest.mock import MagicMock, patch
+from ulapd_api.app import app
+from ulapd_api.utilities.cache import MetadataCache, PresignedUrlCache
+from unit_tests.utilities import helpers
+
+
+class _StopLoop(BaseException):
+    pass
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MetadataCache(60)
+
+    def test_miss_then_hit(self):
+        fetch = MagicMock(return_value=({'foo': 'bar'}, '"1"'))
+
+        self.assertEqual(self.cache.get('bucket', 'ccod/metadata.json', fetch), {'foo': 'bar'})
+        self.assertEqual(self.cache.get('bucket', 'ccod/metadata.json', fetch), {'foo': 'bar'})
+
+        fetch.assert_called_once_with(None)
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_expired_entry_revalidated_not_modified(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 100, 100]
+        fetch = MagicMock(side_effect=[({'foo': 'bar'}, '"1"'), (None, '"1"')])
+
+        self.cache.get('bucket', 'ccod/metadata.json', fetch)
+        result = self.cache.get('bucket', 'ccod/metadata.json', fetch)
+
+        self.assertEqual(result, {'foo': 'bar'})
+        fetch.assert_called_with('"1"')
+        stats = self.cache.stats()
+        self.assertEqual(stats['revalidations'], 1)
+        self.assertEqual(stats['modified'], 0)
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_expired_entry_revalidated_modified(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 100, 100]
+        fetch = MagicMock(side_effect=[({'foo': 'bar'}, '"1"'), ({'foo': 'baz'}, '"2"')])
+
+        self.cache.get('bucket', 'ccod/metadata.json', fetch)
+        result = self.cache.get('bucket', 'ccod/metadata.json', fetch)
+
+        self.assertEqual(result, {'foo': 'baz'})
+        self.assertEqual(self.cache.stats()['modified'], 1)
+
+    def test_keys_are_per_bucket(self):
+        fetch = MagicMock(side_effect=[({'bucket': 1}, '"1"'), ({'bucket': 2}, '"2"')])
+
+        self.assertEqual(self.cache.get('bucket', 'ccod/metadata.json', fetch), {'bucket': 1})
+        self.assertEqual(self.cache.get('restricted', 'ccod/metadata.json', fetch), {'bucket': 2})
+
+    def test_invalidate(self):
+        fetch = MagicMock(return_value=({'foo': 'bar'}, '"1"'))
+        self.cache.get('bucket', 'ccod/metadata.json', fetch)
+
+        self.cache.invalidate('bucket', 'ccod/metadata.json')
+        self.cache.get('bucket', 'ccod/metadata.json', fetch)
+
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_peek_etag(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 30, 100]
+        self.assertIsNone(self.cache.peek_etag('bucket', 'ccod/metadata.json'))
+
+        self.cache.get('bucket', 'ccod/metadata.json', MagicMock(return_value=({'a': 1}, '"1"')))
+
+        self.assertEqual(self.cache.peek_etag('bucket', 'ccod/metadata.json'), '"1"')
+        self.assertIsNone(self.cache.peek_etag('bucket', 'ccod/metadata.json'))
+
+    def test_concurrent_misses_share_one_fetch(self):
+        release = threading.Event()
+        calls = []
+
+        def fetch(etag):
+            calls.append(etag)
+            release.wait(5)
+            return {'foo': 'bar'}, '"1"'
+
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            pending = [executor.submit(self.cache.get, 'bucket', 'ccod/metadata.json', fetch) for _ in range(4)]
+            self._wait_for_waiters(3)
+            release.set()
+            results = [future.result(5) for future in pending]
+
+        self.assertEqual(results, [{'foo': 'bar'}] * 4)
+        self.assertEqual(calls, [None])
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_concurrent_misses_share_one_failure(self):
+        release = threading.Event()
+        fetch = MagicMock(side_effect=lambda etag: release.wait(5) and 1 / 0)
+
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            pending = [executor.submit(self.cache.get, 'bucket', 'ccod/metadata.json', fetch) for _ in range(2)]
+            self._wait_for_waiters(1)
+            release.set()
+            for future in pending:
+                with self.assertRaises(ZeroDivisionError):
+                    future.result(5)
+
+        fetch.assert_called_once_with(None)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def _wait_for_waiters(self, count):
+        for _ in range(500):
+            if self.cache.stats()['coalesced'] == count:
+                return
+            time.sleep(0.01)
+        self.fail('{} callers did not wait on the fetch in flight'.format(count))
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_stale_copy_served_when_revalidation_fails(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 100]
+        cache = MetadataCache(60, max_staleness=300)
+        fetch = MagicMock(side_effect=[({'foo': 'bar'}, '"1"'), Exception('S3 unavailable')])
+
+        cache.get('bucket', 'ccod/metadata.json', fetch)
+        result = cache.get_with_age('bucket', 'ccod/metadata.json', fetch)
+
+        self.assertEqual(result, ({'foo': 'bar'}, 100))
+        self.assertEqual(cache.stats()['stale'], 1)
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_failure_raised_past_max_staleness(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 400]
+        cache = MetadataCache(60, max_staleness=300)
+        fetch = MagicMock(side_effect=[({'foo': 'bar'}, '"1"'), Exception('S3 unavailable')])
+
+        cache.get('bucket', 'ccod/metadata.json', fetch)
+        with self.assertRaises(Exception):
+            cache.get('bucket', 'ccod/metadata.json', fetch)
+
+    @patch.object(MetadataCache, '_start_refresher')
+    @patch('ulapd_api.utilities.cache.time')
+    def test_refresh_renews_entries_in_use(self, mock_time, *_):
+        # Both stored at 0, ccod read at 10, then refreshed by the sweep at 50 while ocod has not been read again
+        mock_time.monotonic.side_effect = [0, 0, 0, 10, 50, 50]
+        cache = MetadataCache(60, refresh_interval=15)
+        ccod = MagicMock(side_effect=[({'foo': 'bar'}, '"1"'), (None, '"1"')])
+        ocod = MagicMock(return_value=({'foo': 'baz'}, '"2"'))
+        cache.get('bucket', 'ccod/metadata.json', ccod)
+        cache.get('bucket', 'ocod/metadata.json', ocod)
+        cache._store(('bucket', 'ocod/metadata.json'), {'foo': 'baz'}, '"2"', ocod, read=False)
+        cache.get('bucket', 'ccod/metadata.json', ccod)
+
+        cache.refresh()
+
+        ccod.assert_called_with('"1"')
+        ocod.assert_called_once_with(None)
+        self.assertEqual(cache.stats()['refreshes'], 1)
+
+    @patch.object(MetadataCache, '_start_refresher')
+    @patch('ulapd_api.utilities.cache.time')
+    def test_refresh_failure_keeps_entry(self, mock_time, *_):
+        mock_time.monotonic.side_effect = [0, 50]
+        cache = MetadataCache(60, refresh_interval=15)
+        fetch = MagicMock(side_effect=[({'foo': 'bar'}, '"1"'), Exception('S3 unavailable')])
+        cache.get('bucket', 'ccod/metadata.json', fetch)
+
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            cache.refresh()
+
+        self.assertEqual(cache.stats()['refresh_failures'], 1)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    @patch('ulapd_api.utilities.cache.time.sleep')
+    def test_refresh_loop_survives_failures(self, mock_sleep):
+        # Stops the loop on its third sleep, after two sweeps have failed
+        mock_sleep.side_effect = [None, None, _StopLoop()]
+        cache = MetadataCache(60, refresh_interval=15, context=app.app_context)
+
+        with patch.object(cache, 'refresh', side_effect=Exception('S3 unavailable')) as mock_refresh, \
+                helpers.contextual_filter(app.logger), self.assertLogs(app.logger, 'ERROR') as logs:
+            with self.assertRaises(_StopLoop):
+                cache._refresh_loop()
+
+        self.assertEqual(mock_refresh.call_count, 2)
+        self.assertEqual(logs.records[0].getMessage(), 'Metadata cache refresh failed: S3 unavailable')
+        self.assertEqual(logs.records[0].trace_id, 'N/A')
+
+    @patch('ulapd_api.utilities.cache.threading')
+    def test_refresher_started_once_per_process(self, mock_threading):
+        cache = MetadataCache(60, refresh_interval=15, context=MagicMock())
+        fetch = MagicMock(return_value=({'foo': 'bar'}, '"1"'))
+
+        cache.get('bucket', 'ccod/metadata.json', fetch)
+        cache.get('bucket', 'ccod/metadata.json', fetch)
+
+        mock_threading.Thread.assert_called_once()
+        mock_threading.Thread.return_value.start.assert_called_once_with()
+
+
+class TestPresignedUrlCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = PresignedUrlCache(3600, 0.5)
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_reused_while_enough_time_left(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 1000]
+        sign = MagicMock(return_value='https://signed/1')
+
+        self.assertEqual(self.cache.get('bucket', 'ccod/a.zip', sign), 'https://signed/1')
+        self.assertEqual(self.cache.get('bucket', 'ccod/a.zip', sign), 'https://signed/1')
+
+        sign.assert_called_once_with()
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1})
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_resigned_when_too_close_to_expiry(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 2000]
+        sign = MagicMock(side_effect=['https://signed/1', 'https://signed/2'])
+
+        self.cache.get('bucket', 'ccod/a.zip', sign)
+        self.assertEqual(self.cache.get('bucket', 'ccod/a.zip', sign), 'https://signed/2')
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_reuse_limited_by_credentials_expiry(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 500]
+        sign = MagicMock(side_effect=['https://signed/1', 'https://signed/2'])
+
+        self.cache.get('bucket', 'ccod/a.zip', sign, lambda: 900)
+        result = self.cache.get('bucket', 'ccod/a.zip', sign, lambda: 900)
+
+        self.assertEqual(result, 'https://signed/2')
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_static_credentials_do_not_limit_reuse(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 1000]
+        sign = MagicMock(return_value='https://signed/1')
+
+        self.cache.get('bucket', 'ccod/a.zip', sign, lambda: None)
+        self.cache.get('bucket', 'ccod/a.zip', sign, lambda: None)
+
+        sign.assert_called_once_with()
+
+    def test_keys_are_per_bucket(self):
+        sign = MagicMock(side_effect=['https://public', 'https://restricted'])
+
+        self.assertEqual(self.cache.get('bucket', 'ccod/a.zip', sign), 'https://public')
+        self.assertEqual(self.cache.get('restricted', 'ccod/a.zip', sign), 'https://restricted')
+
+    @patch('ulapd_api.utilities.cache.time')
+    def test_prunes_when_full(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 0, 2000]
+        cache = PresignedUrlCache(3600, 0.5, max_entries=2)
+
+        cache.get('bucket', 'a', lambda: 'a')
+        cache.get('bucket', 'b', lambda: 'b')
+        cache.get('bucket', 'c', lambda: 'c')
+
+        self.assertEqual(cache.stats()['entries'], 1)
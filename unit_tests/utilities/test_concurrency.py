@@ -0,0 +1,43 @@
+import time
+import unittest
+from concurrent import futures
+from flask import current_app, g
+from ulapd_api.app import app
+from ulapd_api.utilities.concurrency import map_concurrently
+
+
+class TestMapConcurrently(unittest.TestCase):
+
+    def test_preserves_order(self):
+        def slow_square(value):
+            time.sleep(0.01 * (5 - value))
+            return value * value
+
+        result = map_concurrently(slow_square, range(5), max_workers=5)
+        self.assertEqual(result, [0, 1, 4, 9, 16])
+
+    def test_empty(self):
+        self.assertEqual(map_concurrently(lambda x: x, [], max_workers=4), [])
+
+    def test_runs_in_app_context(self):
+        result = map_concurrently(lambda _: current_app.name, [1, 2], max_workers=2)
+        self.assertEqual(result, ['ulapd_api.app', 'ulapd_api.app'])
+
+    def test_reraises_exception(self):
+        def fail_on_two(value):
+            if value == 2:
+                raise ValueError('bad value')
+            return value
+
+        with self.assertRaises(ValueError):
+            map_concurrently(fail_on_two, [1, 2, 3], max_workers=3)
+
+    def test_timeout(self):
+        with self.assertRaises(futures.TimeoutError):
+            map_concurrently(lambda _: time.sleep(0.5), [1, 2], max_workers=2, timeout=0.05)
+
+    def test_propagates_trace_id(self):
+        with app.app_context():
+            g.trace_id = 'abc123'
+            result = map_concurrently(lambda _: g.trace_id, [1, 2], max_workers=2)
+        self.assertEqual(result, ['abc123', 'abc123'])
@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from flask import g
+from sqlalchemy.exc import SQLAlchemyError
+from ulapd_api.main import app
+from ulapd_api.exceptions import ApplicationError
+from ulapd_api.extensions import _count_checkout
+from ulapd_api.utilities.decorators import handle_errors
+
+
+@handle_errors(is_get=True)
+def _read(inner=None):
+    return inner() if inner else 'read'
+
+
+@handle_errors(is_get=False)
+def _write():
+    return 'written'
+
+
+@handle_errors(is_get=True)
+def _fail():
+    raise SQLAlchemyError('boom')
+
+
+@patch('ulapd_api.utilities.decorators.db')
+class TestHandleErrors(unittest.TestCase):
+
+    def test_closes_session(self, mock_db):
+        self.assertEqual(_read(), 'read')
+        mock_db.session.close.assert_called_once_with()
+        mock_db.session.rollback.assert_not_called()
+
+    def test_write_rolls_back(self, mock_db):
+        self.assertEqual(_write(), 'written')
+        mock_db.session.rollback.assert_called_once_with()
+        mock_db.session.close.assert_called_once_with()
+
+    def test_nested_calls_close_once(self, mock_db):
+        def inner():
+            _read()
+            mock_db.session.close.assert_not_called()
+            return _read()
+
+        self.assertEqual(_read(inner), 'read')
+        mock_db.session.close.assert_called_once_with()
+
+    def test_nested_failure_closes_once(self, mock_db):
+        with self.assertRaises(ApplicationError) as context:
+            _read(_fail)
+
+        self.assertEqual(context.exception.http_code, 500)
+        mock_db.session.close.assert_called_once_with()
+
+    def test_request_leaves_close_to_teardown(self, mock_db):
+        with app.test_request_context():
+            _read(_read)
+            _write()
+
+        mock_db.session.close.assert_not_called()
+        mock_db.session.rollback.assert_called_once_with()
+
+
+class TestCheckoutCount(unittest.TestCase):
+
+    def test_counts_checkouts_in_request(self):
+        with app.test_request_context():
+            _count_checkout(MagicMock(), MagicMock(), MagicMock())
+            _count_checkout(MagicMock(), MagicMock(), MagicMock())
+            self.assertEqual(g.db_checkouts, 2)
+
+    def test_ignores_checkouts_outside_request(self):
+        with app.app_context():
+            _count_checkout(MagicMock(), MagicMock(), MagicMock())
+            self.assertNotIn('db_checkouts', g)
@@ -0,0 +1,95 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+from ulapd_api.app import app
+from ulapd_api.utilities import invalidation
+from unit_tests.utilities import helpers
+
+
+class _StopLoop(BaseException):
+    pass
+
+
+def _payload(kind, key, origin='other-host:1'):
+    return json.dumps({'kind': kind, 'key': key, 'origin': origin})
+
+
+@patch.dict('ulapd_api.utilities.invalidation._handlers', clear=True)
+class TestInvalidation(unittest.TestCase):
+
+    def test_notify(self):
+        session = MagicMock()
+
+        invalidation.notify(session, 'dataset', 'ccod')
+
+        statement, params = session.execute.call_args[0]
+        self.assertEqual(str(statement), 'SELECT pg_notify(:channel, :payload)')
+        self.assertEqual(params['channel'], 'ulapd_api_invalidation')
+        self.assertEqual(json.loads(params['payload']),
+                         {'kind': 'dataset', 'key': 'ccod', 'origin': invalidation._origin()})
+
+    def test_handle_calls_handlers_for_kind(self):
+        dataset_handler = MagicMock()
+        licence_handler = MagicMock()
+        invalidation.subscribe('dataset', dataset_handler)
+        invalidation.subscribe('licence', licence_handler)
+
+        invalidation._handle(_payload('dataset', 'ccod'))
+
+        dataset_handler.assert_called_once_with('ccod')
+        licence_handler.assert_not_called()
+
+    def test_handle_ignores_own_notifications(self):
+        handler = MagicMock()
+        invalidation.subscribe('dataset', handler)
+
+        invalidation._handle(_payload('dataset', 'ccod', invalidation._origin()))
+
+        handler.assert_not_called()
+
+    def test_handler_failure_is_logged(self):
+        failing = MagicMock(side_effect=Exception('boom'))
+        handler = MagicMock()
+        invalidation.subscribe('licence', failing)
+        invalidation.subscribe('licence', handler)
+
+        with patch.object(app, 'logger') as mock_logger:
+            invalidation._handle(_payload('licence', 'ccod'))
+
+        mock_logger.error.assert_called_once_with('Failed to invalidate licence ccod: boom')
+        handler.assert_called_once_with('ccod')
+
+    def test_dispatch_all(self):
+        dataset_handler = MagicMock()
+        user_handler = MagicMock()
+        invalidation.subscribe('dataset', dataset_handler)
+        invalidation.subscribe('user', user_handler)
+
+        invalidation._dispatch_all()
+
+        dataset_handler.assert_called_once_with(None)
+        user_handler.assert_called_once_with(None)
+
+    @patch('ulapd_api.utilities.invalidation.time.sleep')
+    @patch('ulapd_api.utilities.invalidation._listen')
+    def test_listen_loop_logs_and_reconnects(self, mock_listen, mock_sleep):
+        mock_listen.side_effect = Exception('connection refused')
+        # Stops the loop when it waits to reconnect for the second time
+        mock_sleep.side_effect = [None, _StopLoop()]
+
+        with helpers.contextual_filter(app.logger), self.assertLogs(app.logger, 'ERROR') as logs:
+            with self.assertRaises(_StopLoop):
+                invalidation._listen_loop()
+
+        self.assertEqual(mock_listen.call_count, 2)
+        self.assertEqual(logs.records[0].getMessage(),
+                         'Cache invalidation listener failed, reconnecting: connection refused')
+        self.assertEqual(logs.records[0].trace_id, 'N/A')
+
+    @patch('ulapd_api.utilities.invalidation.threading')
+    def test_listener_started_once_per_process(self, mock_threading):
+        with patch.object(invalidation, '_listener_pid', None):
+            invalidation.start_listener()
+            invalidation.start_listener()
+
+        mock_threading.Thread.return_value.start.assert_called_once_with()
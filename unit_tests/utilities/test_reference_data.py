@@ -0,0 +1,117 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from ulapd_api.app import app
+from ulapd_api.utilities import reference_data
+from ulapd_api.utilities.reference_data import ReferenceData
+
+
+def _row(**values):
+    row = MagicMock()
+    row.as_dict.return_value = values
+    return row
+
+
+@patch('ulapd_api.utilities.reference_data.UserType')
+@patch('ulapd_api.utilities.reference_data.Dataset')
+@patch('ulapd_api.utilities.reference_data.Licence')
+class TestReferenceData(unittest.TestCase):
+
+    def setUp(self):
+        reference_data._snapshot = None
+
+    def tearDown(self):
+        reference_data._snapshot = None
+
+    def _load(self, mock_licence, mock_dataset, mock_user_type):
+        mock_licence.get_all_licences.return_value = [
+            _row(licence_id='res_cov_direct', dataset_name='res_cov', title='Direct Use'),
+            _row(licence_id='res_cov_exploration', dataset_name='res_cov', title='Exploration'),
+            _row(licence_id='ccod', dataset_name='ccod', title='CCOD')]
+        mock_dataset.get_all_datasets.return_value = [_row(name='ccod', external=False),
+                                                      _row(name='res_cov', external=False)]
+        mock_user_type.get_all_user_types.return_value = [_row(user_type_id=1, user_type='personal-uk')]
+
+    def test_maps(self, mock_licence, mock_dataset, mock_user_type):
+        self._load(mock_licence, mock_dataset, mock_user_type)
+
+        snapshot = ReferenceData.load()
+
+        self.assertEqual(snapshot.licence_by_name['ccod']['title'], 'CCOD')
+        self.assertEqual([licence['licence_id'] for licence in snapshot.licences_by_dataset['res_cov']],
+                         ['res_cov_direct', 'res_cov_exploration'])
+        self.assertEqual(snapshot.dataset_by_name['res_cov']['name'], 'res_cov')
+        self.assertEqual([dataset['name'] for dataset in snapshot.datasets], ['ccod', 'res_cov'])
+        self.assertEqual(snapshot.user_type_by_id[1]['user_type'], 'personal-uk')
+        self.assertEqual(snapshot.user_type_by_name['personal-uk']['user_type_id'], 1)
+
+    def test_snapshot_is_read_only(self, mock_licence, mock_dataset, mock_user_type):
+        self._load(mock_licence, mock_dataset, mock_user_type)
+
+        snapshot = ReferenceData.load()
+
+        with self.assertRaises(TypeError):
+            snapshot.licence_by_name['ocod'] = {}
+        with self.assertRaises(TypeError):
+            snapshot.dataset_by_name['ccod']['name'] = 'ocod'
+
+    def test_get_reference_data_loads_once_within_ttl(self, mock_licence, mock_dataset, mock_user_type):
+        self._load(mock_licence, mock_dataset, mock_user_type)
+
+        with patch.dict(app.config, {'REFERENCE_DATA_TTL': 300}):
+            first = reference_data.get_reference_data()
+            second = reference_data.get_reference_data()
+
+        self.assertIs(first, second)
+        mock_licence.get_all_licences.assert_called_once_with()
+
+    @patch('ulapd_api.utilities.reference_data.time.monotonic')
+    def test_get_reference_data_reloads_after_ttl(self, mock_time, mock_licence, mock_dataset, mock_user_type):
+        self._load(mock_licence, mock_dataset, mock_user_type)
+        mock_time.side_effect = [0, 301, 301]
+
+        with patch.dict(app.config, {'REFERENCE_DATA_TTL': 300}):
+            first = reference_data.get_reference_data()
+            second = reference_data.get_reference_data()
+
+        self.assertIsNot(first, second)
+        self.assertGreater(second.version, first.version)
+        self.assertEqual(mock_licence.get_all_licences.call_count, 2)
+
+    @patch('ulapd_api.utilities.reference_data.time.monotonic')
+    def test_failed_reload_keeps_snapshot(self, mock_time, mock_licence, mock_dataset, mock_user_type):
+        self._load(mock_licence, mock_dataset, mock_user_type)
+        mock_time.side_effect = [0, 301]
+
+        with patch.dict(app.config, {'REFERENCE_DATA_TTL': 300}), patch.object(app, 'logger') as mock_logger:
+            first = reference_data.get_reference_data()
+            mock_licence.get_all_licences.side_effect = Exception('connection lost')
+            second = reference_data.get_reference_data()
+
+        self.assertIs(first, second)
+        mock_logger.error.assert_called_once_with(
+            'Failed to reload reference data, keeping version {}: connection lost'.format(first.version))
+
+    def test_reload_reference_data_swaps_snapshot(self, mock_licence, mock_dataset, mock_user_type):
+        self._load(mock_licence, mock_dataset, mock_user_type)
+
+        with patch.dict(app.config, {'REFERENCE_DATA_TTL': 300}):
+            first = reference_data.get_reference_data()
+            mock_licence.get_all_licences.return_value = [_row(licence_id='ocod', dataset_name='ocod')]
+            reloaded = reference_data.reload_reference_data()
+
+            self.assertIs(reference_data.get_reference_data(), reloaded)
+        self.assertNotIn('ocod', first.licence_by_name)
+        self.assertIn('ocod', reloaded.licence_by_name)
+
+    def test_expire_reference_data(self, mock_licence, mock_dataset, mock_user_type):
+        self._load(mock_licence, mock_dataset, mock_user_type)
+
+        with patch.dict(app.config, {'REFERENCE_DATA_TTL': 300}):
+            first = reference_data.get_reference_data()
+            reference_data.expire_reference_data('ccod')
+            second = reference_data.get_reference_data()
+            third = reference_data.get_reference_data()
+
+        self.assertIsNot(first, second)
+        self.assertIs(second, third)
+        self.assertEqual(mock_licence.get_all_licences.call_count, 2)
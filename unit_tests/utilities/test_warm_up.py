@@ -0,0 +1,51 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from ulapd_api.app import app
+from ulapd_api.utilities import warm_up
+from unit_tests.utilities import helpers
+
+
+@patch('ulapd_api.utilities.warm_up.dataset_service')
+@patch('ulapd_api.utilities.warm_up.reload_reference_data')
+@patch('ulapd_api.utilities.warm_up.S3')
+@patch('ulapd_api.utilities.warm_up.db')
+class TestWarmUp(unittest.TestCase):
+
+    def test_warm_up(self, mock_db, mock_s3, mock_reload, mock_service):
+        mock_db.engine.pool.size.return_value = 3
+        connections = [MagicMock(), MagicMock(), MagicMock()]
+        mock_db.engine.connect.side_effect = connections
+
+        with patch.object(app, 'logger') as mock_logger:
+            warm_up.warm_up(app)
+
+        for connection in connections:
+            connection.close.assert_called_once_with()
+        mock_s3.return_value.get_s3_session.assert_called_once_with()
+        mock_reload.assert_called_once_with()
+        mock_service.get_datasets.assert_called_once_with()
+        mock_db.session.remove.assert_called_once_with()
+        self.assertIn('Warm-up finished in', mock_logger.info.call_args[0][0])
+        mock_logger.error.assert_not_called()
+
+    def test_failed_step_is_skipped(self, mock_db, mock_s3, mock_reload, mock_service):
+        mock_db.engine.pool.size.return_value = 1
+        mock_s3.return_value.get_s3_session.side_effect = Exception('no credentials')
+
+        with patch.object(app, 'logger') as mock_logger:
+            warm_up.warm_up(app)
+
+        mock_logger.error.assert_called_once_with('Warm-up of S3 client failed: no credentials')
+        mock_service.get_datasets.assert_called_once_with()
+
+    def test_failed_step_is_logged(self, mock_db, mock_s3, mock_reload, mock_service):
+        mock_db.engine.connect.side_effect = Exception('could not connect to server')
+
+        with helpers.contextual_filter(app.logger), self.assertLogs(app.logger) as logs:
+            warm_up.warm_up(app)
+
+        self.assertEqual(logs.records[0].getMessage(),
+                         'Warm-up of database connections failed: could not connect to server')
+        self.assertEqual(logs.records[0].trace_id, 'N/A')
+        self.assertIn('Warm-up finished in', logs.records[-1].getMessage())
+        mock_service.get_datasets.assert_called_once_with()